@@ -0,0 +1,32 @@
+"""
+Cost of Apple response parsing depending on length of subscription history
+
+Run from repository root:
+    python -m benchmarks.apple_parser
+"""
+
+import argparse
+import timeit
+
+from benchmarks.synthetic import apple_response
+from subinapp.core.providers.apple import Parser
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    arg_parser.add_argument('--lengths', type=int, nargs='+', default=[1, 12, 60, 120, 600, 1200, 6000])
+    arg_parser.add_argument('--pending-renewals', type=int, default=3)
+    arg_parser.add_argument('--repeat', type=int, default=5)
+    args = arg_parser.parse_args()
+
+    parser = Parser()
+    print('{:>8} {:>14} {:>14}'.format('renewals', 'us per parse', 'ns per renewal'))
+    for length in args.lengths:
+        response = apple_response(length, args.pending_renewals)
+        number = max(1, 20000 // length)
+        best = min(timeit.repeat(lambda: parser.parse(response), number=number, repeat=args.repeat)) / number
+        print('{:>8} {:>14.2f} {:>14.1f}'.format(length, best * 1e6, best * 1e9 / length))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,81 @@
+"""
+Cold start benchmark: time from fresh interpreter to first verified receipt with eager and lazy configuration
+
+Each measurement runs in new process, first Apple request is sent to local stub.
+
+Run from repository root:
+    python -m benchmarks.cold_start --runs 5
+"""
+
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+from typing import Dict, List
+
+from benchmarks import stubs, synthetic
+
+# Runs in fresh interpreter, prints timings in seconds as json
+CHILD_CODE = '''
+import json, logging, sys, time
+logging.disable(logging.CRITICAL)
+started = time.perf_counter()
+from subinapp.core.controllers import SubscriptionsBasicController
+from subinapp.interface.entities import SubscriptionManagerConfig, AppleVerifierConfig, AppleExtraArgs, \\
+    GoogleVerifierConfig
+imported = time.perf_counter()
+mode, apple_url, private_key_path, receipt = sys.argv[1:5]
+config = SubscriptionManagerConfig(
+    apple=AppleVerifierConfig(bundle_id='com.company.myapp', extra=AppleExtraArgs(shared_secret='secret')),
+    google=GoogleVerifierConfig(bundle_id='com.company.myapp', private_key_path=private_key_path),
+)
+SubscriptionsBasicController.configure(config, lazy=mode != 'eager')
+configured = time.perf_counter()
+if mode == 'lazy+warm':
+    SubscriptionsBasicController.warm(['apple'])
+warmed = time.perf_counter()
+SubscriptionsBasicController.verifiers.apple.verifier.production_url = apple_url + '/production'
+SubscriptionsBasicController.verify_receipt('apple', receipt)
+verified = time.perf_counter()
+print(json.dumps({
+    'import_ms': (imported - started) * 1000,
+    'configure_ms': (configured - imported) * 1000,
+    'warm_ms': (warmed - configured) * 1000,
+    'first_verify_ms': (verified - warmed) * 1000,
+    'total_ms': (verified - started) * 1000,
+    'modules': len(sys.modules),
+}))
+'''
+
+MODES = ('eager', 'lazy', 'lazy+warm')
+
+
+def run_child(mode: str, apple_url: str, private_key_path: str) -> Dict[str, float]:
+    output = subprocess.check_output([sys.executable, '-c', CHILD_CODE, mode, apple_url, private_key_path,
+                                      synthetic.apple_receipt()])
+    return json.loads(output)
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    arg_parser.add_argument('--runs', type=int, default=5)
+    arg_parser.add_argument('--private-key-path', default='subinapp/core/tests/keyfile.json',
+                            help='Service key of Google, it is loaded only by eager configuration')
+    args = arg_parser.parse_args()
+
+    with stubs.apple_stub(stubs.Latency(0, 0)) as apple_server:
+        results: Dict[str, List[Dict[str, float]]] = {
+            mode: [run_child(mode, apple_server.url, args.private_key_path) for _ in range(args.runs)]
+            for mode in MODES
+        }
+
+    names = list(results[MODES[0]][0].keys())
+    print('{:<10}'.format('mode') + ''.join('{:>17}'.format(name) for name in names))
+    for mode, runs in results.items():
+        medians = [statistics.median(run[name] for run in runs) for name in names]
+        print('{:<10}'.format(mode) + ''.join('{:>17.1f}'.format(value) for value in medians))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,209 @@
+"""
+End-to-end verify_receipt benchmark against local App Store and Google Play stubs
+
+Measures throughput, p50/p99 latency, cost of parse and serialize stages
+and memory allocated per request for each scenario.
+
+Run from repository root:
+    python -m benchmarks.end_to_end --requests 1000 --output results.json
+    python -m benchmarks.end_to_end --compare results.json
+"""
+
+import argparse
+import asyncio
+import json
+import random
+import sys
+import time
+import tracemalloc
+from typing import Callable, Dict, List
+
+from benchmarks import stubs, synthetic
+from subinapp.core import batch
+from subinapp.core.controllers import SubscriptionsBasicController, AsyncSubscriptionsController
+from subinapp.core.metrics import InMemoryHistogramSink, Metrics
+from subinapp.core.tokens import GoogleTokenManager
+from subinapp.interface.entities import SubscriptionManagerConfig, AppleVerifierConfig, AppleExtraArgs, \
+    GoogleVerifierConfig
+
+SCENARIOS = ('sync-apple', 'async-apple', 'async-google')
+# Relative change of metric that is reported as regression
+REGRESSION_THRESHOLD = 0.2
+
+
+def percentile(values: List[float], q: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def make_receipts(provider: str, count: int, sandbox_rate: float) -> List[tuple]:
+    if provider == 'google':
+        return [('google', synthetic.google_receipt(i)) for i in range(count)]
+    return [('apple', synthetic.apple_receipt(sandbox=random.random() < sandbox_rate)) for _ in range(count)]
+
+
+def make_config(concurrency: int) -> SubscriptionManagerConfig:
+    return SubscriptionManagerConfig(
+        apple=AppleVerifierConfig(bundle_id='com.company.myapp',
+                                  extra=AppleExtraArgs(shared_secret='secret', pool_size=concurrency,
+                                                       max_retries=0, learn_environment=False)),
+        google=GoogleVerifierConfig(bundle_id='com.company.myapp', private_key_path='/dev/null'),
+    )
+
+
+def configure_controller(controller, scenario: str, apple_url: str, google_url: str, concurrency: int):
+    controller.configure(make_config(concurrency), metrics_sinks=[InMemoryHistogramSink()])
+    google = controller.verifiers.google
+    if scenario == 'sync-apple':
+        controller.verifiers.apple.verifier.production_url = apple_url + '/production'
+        controller.verifiers.apple.verifier.sandbox_url = apple_url + '/sandbox'
+        return
+    controller.verifiers.apple.production_url = apple_url + '/production'
+    controller.verifiers.apple.sandbox_url = apple_url + '/sandbox'
+    google.token_manager = GoogleTokenManager('/dev/null', fetch_token=lambda: ('token', 3600))
+    google.api_url = google_url + '/{package_name}/purchases/subscriptions/{subscription_id}/tokens/{token}'
+
+
+def run_sync(controller, receipts: List[tuple], concurrency: int, latencies: List[float]) -> int:
+    def timed_verify(provider: str, receipt: str):
+        started = time.perf_counter()
+        try:
+            result = controller.verify_receipt(provider=provider, receipt=receipt)
+            # payloads are stored by application
+            len(result.provider_response)
+            return result
+        finally:
+            latencies.append(time.perf_counter() - started)
+
+    results = batch.verify_receipts(timed_verify, receipts, concurrency=concurrency)
+    return sum(1 for result in results if not result.is_verified)
+
+
+def run_async(controller, receipts: List[tuple], concurrency: int, latencies: List[float]) -> int:
+    async def timed_verify(provider: str, receipt: str):
+        started = time.perf_counter()
+        try:
+            result = await controller.verify_receipt(provider=provider, receipt=receipt)
+            len(result.provider_response)
+            return result
+        finally:
+            latencies.append(time.perf_counter() - started)
+
+    async def run():
+        try:
+            results = batch.averify_receipts(timed_verify, receipts, concurrency=concurrency)
+            return sum([1 async for result in results if not result.is_verified])
+        finally:
+            await controller.close()
+
+    return asyncio.run(run())
+
+
+def memory_per_request(run: Callable, receipts: List[tuple]) -> float:
+    """Average peak of memory allocated by sequential verifications"""
+    tracemalloc.start()
+    try:
+        peaks = []
+        for item in receipts:
+            tracemalloc.reset_peak()
+            before = tracemalloc.get_traced_memory()[0]
+            run([item], 1, [])
+            peaks.append(tracemalloc.get_traced_memory()[1] - before)
+        return sum(peaks) / len(peaks)
+    finally:
+        tracemalloc.stop()
+
+
+def run_scenario(scenario: str, args) -> Dict[str, float]:
+    latency = stubs.Latency(args.latency, args.jitter)
+    with stubs.apple_stub(latency, args.error_rate, args.renewals, args.pending_renewals) as apple_server, \
+            stubs.google_stub(latency, args.error_rate) as google_server:
+        controller_class = SubscriptionsBasicController if scenario == 'sync-apple' else AsyncSubscriptionsController
+        controller = type('BenchmarkController', (controller_class,), {})
+        configure_controller(controller, scenario, apple_server.url, google_server.url, args.concurrency)
+        run = run_sync if scenario == 'sync-apple' else run_async
+        provider = scenario.split('-')[1]
+
+        # warm up connections
+        run(controller, make_receipts(provider, args.concurrency, args.sandbox_rate), args.concurrency, [])
+        sink = InMemoryHistogramSink()
+        controller.metrics = Metrics([sink])
+        latencies = []
+        receipts = make_receipts(provider, args.requests, args.sandbox_rate)
+        started = time.perf_counter()
+        errors = run(controller, receipts, args.concurrency, latencies)
+        elapsed = time.perf_counter() - started
+
+        controller.metrics = Metrics()
+        memory = memory_per_request(lambda items, concurrency, result: run(controller, items, concurrency, result),
+                                    make_receipts(provider, args.memory_requests, args.sandbox_rate))
+
+    def stage_mean(stage: str) -> float:
+        histogram = sink.durations.get((provider, stage))
+        return histogram.sum / histogram.count if histogram and histogram.count else 0.0
+
+    return {
+        'throughput_rps': args.requests / elapsed,
+        'latency_p50_ms': percentile(latencies, 0.5) * 1000,
+        'latency_p99_ms': percentile(latencies, 0.99) * 1000,
+        'parse_mean_us': stage_mean('parse') * 1e6,
+        'serialize_mean_us': stage_mean('serialize') * 1e6,
+        'memory_per_request_kb': memory / 1024,
+        'errors': errors,
+    }
+
+
+def compare(results: Dict[str, dict], baseline: Dict[str, dict]) -> List[str]:
+    """Descriptions of metrics that became worse than baseline more than threshold"""
+    regressions = []
+    for scenario, metrics in results.items():
+        for name, value in metrics.items():
+            base = baseline.get(scenario, {}).get(name)
+            if not base or name == 'errors':
+                continue
+            change = (value - base) / base
+            # throughput is better when higher, other metrics when lower
+            worse = -change if name == 'throughput_rps' else change
+            if worse > REGRESSION_THRESHOLD:
+                regressions.append('{} {}: {:.2f} -> {:.2f} ({:+.0%})'.format(scenario, name, base, value, change))
+    return regressions
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    arg_parser.add_argument('--scenarios', nargs='+', choices=SCENARIOS, default=list(SCENARIOS))
+    arg_parser.add_argument('--requests', type=int, default=500)
+    arg_parser.add_argument('--memory-requests', type=int, default=50)
+    arg_parser.add_argument('--concurrency', type=int, default=20)
+    arg_parser.add_argument('--latency', type=float, default=0.02, help='Base latency of stubs in seconds')
+    arg_parser.add_argument('--jitter', type=float, default=0.01, help='Mean of exponential jitter in seconds')
+    arg_parser.add_argument('--error-rate', type=float, default=0.0)
+    arg_parser.add_argument('--sandbox-rate', type=float, default=0.1, help='Part of Apple sandbox receipts')
+    arg_parser.add_argument('--renewals', type=int, default=12, help='Length of latest_receipt_info')
+    arg_parser.add_argument('--pending-renewals', type=int, default=1, help='Length of pending_renewal_info')
+    arg_parser.add_argument('--seed', type=int, default=0)
+    arg_parser.add_argument('--output', help='Save results to json file')
+    arg_parser.add_argument('--compare', help='Compare results with json file of previous run')
+    args = arg_parser.parse_args()
+    random.seed(args.seed)
+
+    results = {scenario: run_scenario(scenario, args) for scenario in args.scenarios}
+    names = list(next(iter(results.values())).keys())
+    print('{:<14}'.format('scenario') + ''.join('{:>22}'.format(name) for name in names))
+    for scenario, metrics in results.items():
+        print('{:<14}'.format(scenario) + ''.join('{:>22.2f}'.format(metrics[name]) for name in names))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f))
+        for regression in regressions:
+            print('REGRESSION', regression)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
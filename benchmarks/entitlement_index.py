@@ -0,0 +1,99 @@
+"""
+Entitlement index benchmark: memory per entry and time of lookups, updates and expiration
+
+Memory of dict of VerifiedSubscriptionInfo is measured on sample and extrapolated for comparison.
+Tokens are long like purchase tokens of Google Play, they are created in chunks and dropped after indexing,
+as application would read them from database.
+
+Run from repository root:
+    python -m benchmarks.entitlement_index --entries 10000000
+"""
+
+import argparse
+import random
+import resource
+import time
+import tracemalloc
+from datetime import datetime
+from typing import List
+
+from subinapp.core.entitlements import EntitlementIndex
+from subinapp.interface.entities import VerifiedSubscriptionInfo
+
+NOW = 1600000000
+DAY = 24 * 3600
+PRODUCTS = ['com.product.monthly', 'com.product.yearly', 'com.product.weekly']
+CHUNK = 100000
+
+
+def token(index: int) -> str:
+    return 'token-{:0>140}'.format(index)
+
+
+def subscription(index: int) -> VerifiedSubscriptionInfo:
+    # expirations are spread from 30 days ago to 335 days ahead
+    return VerifiedSubscriptionInfo(
+        product_id=PRODUCTS[index % len(PRODUCTS)], purchase_token=token(index),
+        expiration_date=datetime.fromtimestamp(NOW + (index * 7919 % 365 - 30) * DAY + index % DAY),
+        is_renewable=index % 5 != 0)
+
+
+def dict_bytes_per_entry(sample: int) -> float:
+    tracemalloc.start()
+    subscriptions = {}
+    for index in range(sample):
+        info = subscription(index)
+        subscriptions[info.purchase_token] = info
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return size / sample
+
+
+def max_rss_mb() -> float:
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def measure_lookups(index: EntitlementIndex, tokens: List[str]) -> float:
+    started = time.perf_counter()
+    for purchase_token in tokens:
+        index.is_active(purchase_token, NOW)
+    return (time.perf_counter() - started) / len(tokens) * 1e9
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    arg_parser.add_argument('--entries', type=int, default=10000000)
+    arg_parser.add_argument('--lookups', type=int, default=1000000)
+    arg_parser.add_argument('--sample', type=int, default=100000,
+                            help='Number of entries of dict to measure its memory')
+    args = arg_parser.parse_args()
+
+    print('dict of VerifiedSubscriptionInfo: {:.0f} bytes per entry'.format(dict_bytes_per_entry(args.sample)))
+
+    rss_before = max_rss_mb()
+    index = EntitlementIndex()
+    started = time.perf_counter()
+    for chunk_start in range(0, args.entries, CHUNK):
+        for info in [subscription(i) for i in range(chunk_start, min(chunk_start + CHUNK, args.entries))]:
+            index.update(info)
+    built = time.perf_counter() - started
+    stats = index.stats()
+    print('index of {} entries: {:.0f} bytes per entry, {:.0f} MB, max RSS grew by {:.0f} MB'.format(
+        stats['entries'], stats['memory_bytes'] / stats['entries'], stats['memory_bytes'] / 2 ** 20,
+        max_rss_mb() - rss_before))
+    print('update: {:.0f} ns per entry including creation of VerifiedSubscriptionInfo'.format(
+        built / args.entries * 1e9))
+
+    random.seed(0)
+    hits = [token(random.randrange(args.entries)) for _ in range(args.lookups)]
+    misses = [token(args.entries + i) for i in range(args.lookups)]
+    print('is_active of indexed token: {:.0f} ns'.format(measure_lookups(index, hits)))
+    print('is_active of unknown token: {:.0f} ns'.format(measure_lookups(index, misses)))
+
+    started = time.perf_counter()
+    removed = index.expire(NOW)
+    print('expire: {} lapsed entries removed in {:.2f} s'.format(removed, time.perf_counter() - started))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,66 @@
+"""
+Throughput of bulk re-parsing of archived provider responses
+
+Compares parsing of each response into VerifiedSubscriptionInfo with columnar parse_batch
+in current process and in pool of processes. Archive is generated with fixed seed, so runs are comparable.
+
+Run from repository root:
+    python -m benchmarks.reparse --responses 200000 --workers 4
+"""
+
+import argparse
+import json
+import os
+import random
+import time
+
+from benchmarks.synthetic import apple_response, google_response
+from subinapp.core.providers.apple import Parser as AParser
+from subinapp.core.providers.google import Parser as GParser
+from subinapp.core.reparse import reparse
+from subinapp.interface.utils import dump_json
+
+
+def make_archive(responses: int, renewals: int, seed: int) -> list:
+    """Archived responses of Apple and Google in equal shares, like ProcessedReceipt.provider_response"""
+    random.seed(seed)
+    apple = [dump_json(apple_response(renewals, in_app=False)) for _ in range(100)]
+    return [('apple', apple[index % len(apple)]) if index % 2 else
+            ('google', dump_json(google_response('token-{}'.format(index))))
+            for index in range(responses)]
+
+
+def per_row(archive: list) -> int:
+    parsers = {'apple': AParser(), 'google': GParser()}
+    return len([parsers[provider].parse(json.loads(response)) for provider, response in archive])
+
+
+def columnar(archive: list, workers: int, batch_size: int) -> int:
+    return sum(len(batch) for batch in reparse(archive, workers=workers, batch_size=batch_size))
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    arg_parser.add_argument('--responses', type=int, default=200000)
+    arg_parser.add_argument('--renewals', type=int, default=12, help='Length of history of Apple responses')
+    arg_parser.add_argument('--workers', type=int, default=os.cpu_count())
+    arg_parser.add_argument('--batch-size', type=int, default=10000)
+    arg_parser.add_argument('--seed', type=int, default=42)
+    args = arg_parser.parse_args()
+
+    archive = make_archive(args.responses, args.renewals, args.seed)
+    cases = [
+        ('per row', lambda: per_row(archive)),
+        ('columnar', lambda: columnar(archive, 0, args.batch_size)),
+        ('columnar x{}'.format(args.workers), lambda: columnar(archive, args.workers, args.batch_size)),
+    ]
+    print('{:>14} {:>14} {:>12}'.format('mode', 'responses/s', 'seconds'))
+    for name, run in cases:
+        started = time.perf_counter()
+        count = run()
+        elapsed = time.perf_counter() - started
+        print('{:>14} {:>14.0f} {:>12.2f}'.format(name, count / elapsed, elapsed))
+
+
+if __name__ == '__main__':
+    main()
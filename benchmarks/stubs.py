@@ -0,0 +1,62 @@
+"""
+Local stand-ins of App Store verifyReceipt and Google Play Developer API
+with configurable latency and error rate
+"""
+
+import json
+import random
+import time
+from typing import Tuple
+
+from benchmarks import synthetic
+from subinapp.core.tests.stubs import StubServer
+
+
+class Latency:
+    """Random delay of response: base seconds plus exponential jitter with given mean"""
+
+    def __init__(self, base: float = 0.05, jitter: float = 0.02):
+        self.base = base
+        self.jitter = jitter
+
+    def sleep(self):
+        time.sleep(self.base + (random.expovariate(1 / self.jitter) if self.jitter else 0))
+
+
+def apple_stub(latency: Latency, error_rate: float = 0.0, renewals: int = 12, pending_renewals: int = 1) -> StubServer:
+    """
+    verifyReceipt on /production and /sandbox
+    Receipts starting with 'sandbox-' get 21007 from production
+    Errors are 503 or status 21005 (server is unavailable)
+    """
+    responses = {sandbox: synthetic.apple_response(renewals, pending_renewals, sandbox=sandbox)
+                 for sandbox in (False, True)}
+
+    def handler(method: str, path: str, body: bytes) -> Tuple[int, dict]:
+        latency.sleep()
+        if random.random() < error_rate:
+            return random.choice(((503, {}), (200, {'status': 21005})))
+        sandbox_receipt = json.loads(body)['receipt-data'].startswith('sandbox-')
+        if path == '/production' and sandbox_receipt:
+            return 200, {'status': 21007}
+        if path == '/sandbox' and not sandbox_receipt:
+            return 200, {'status': 21008}
+        return 200, responses[sandbox_receipt]
+
+    return StubServer(handler)
+
+
+def google_stub(latency: Latency, error_rate: float = 0.0) -> StubServer:
+    """
+    purchases.subscriptions.get on /{package}/purchases/subscriptions/{sku}/tokens/{token}
+    Errors are 500 or 410 (purchase token is no longer valid)
+    """
+
+    def handler(method: str, path: str, body: bytes) -> Tuple[int, dict]:
+        latency.sleep()
+        if random.random() < error_rate:
+            return random.choice(((500, {'error': {'code': 500}}), (410, {'error': {'code': 410}})))
+        parts = path.split('/')
+        return 200, synthetic.google_response(parts[-1], parts[-3])
+
+    return StubServer(handler)
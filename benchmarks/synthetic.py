@@ -0,0 +1,86 @@
+"""
+Synthetic receipts and provider responses of growing size
+"""
+
+import base64
+import json
+import os
+import random
+
+DAY_MS = 24 * 60 * 60 * 1000
+START_MS = 1500000000000
+
+
+def apple_receipt(size: int = 6000, sandbox: bool = False) -> str:
+    """Base64 blob like receipt from device, sandbox receipts are marked with prefix for stub"""
+    blob = base64.b64encode(os.urandom(size * 3 // 4)).decode('ascii')
+    return ('sandbox-' if sandbox else '') + blob
+
+
+def google_receipt(index: int, product_id: str = 'com.product.monthly') -> str:
+    return json.dumps({'purchaseToken': 'token-{}'.format(index), 'productId': product_id,
+                       'packageName': 'com.company.myapp'})
+
+
+def apple_response(renewals: int = 12, pending_renewals: int = 1, in_app: bool = True,
+                   sandbox: bool = False) -> dict:
+    """
+    Response of subscriber with monthly renewals, history is shuffled like in real responses
+    :param renewals: Length of latest_receipt_info
+    :param pending_renewals: Length of pending_renewal_info
+    :param in_app: Add history to receipt.in_app too
+    """
+    latest_receipt_info = [
+        {
+            'quantity': '1',
+            'product_id': 'com.product.{}'.format(i % max(pending_renewals, 1)),
+            'transaction_id': str(100000000000 + i),
+            'original_transaction_id': '100000000000',
+            'purchase_date_ms': str(START_MS + (i * 7919 % renewals) * 30 * DAY_MS),
+            'expires_date_ms': str(START_MS + ((i * 7919 % renewals) + 1) * 30 * DAY_MS),
+            'is_trial_period': 'false',
+            'is_in_intro_offer_period': 'false',
+            'web_order_line_item_id': str(200000000000 + i),
+        }
+        for i in range(renewals)
+    ]
+    pending_renewal_info = [
+        {
+            'auto_renew_product_id': 'com.product.{}'.format(i),
+            'product_id': 'com.product.{}'.format(i),
+            'original_transaction_id': '100000000000',
+            'auto_renew_status': random.choice(('0', '1')),
+        }
+        for i in range(pending_renewals)
+    ]
+    return {
+        'status': 0,
+        'environment': 'Sandbox' if sandbox else 'Production',
+        'receipt': {
+            'receipt_type': 'ProductionSandbox' if sandbox else 'Production',
+            'bundle_id': 'com.company.myapp',
+            'application_version': '42',
+            'in_app': latest_receipt_info if in_app else [],
+        },
+        'latest_receipt_info': latest_receipt_info,
+        'pending_renewal_info': pending_renewal_info,
+        'latest_receipt': apple_receipt(),
+    }
+
+
+def google_response(purchase_token: str, product_id: str = 'com.product.monthly') -> dict:
+    return {
+        'kind': 'androidpublisher#subscriptionPurchase',
+        'startTimeMillis': START_MS,
+        'expiryTimeMillis': START_MS + 10000 * DAY_MS,
+        'autoRenewing': True,
+        'priceCurrencyCode': 'USD',
+        'priceAmountMicros': '4990000',
+        'countryCode': 'US',
+        'paymentState': 1,
+        'orderId': 'GPA.1234-5678-9012-34567',
+        'acknowledgementState': 1,
+        'purchaseType': 0,
+        'productId': product_id,
+        'purchaseToken': purchase_token,
+    }
@@ -1,6 +1,6 @@
 #!/usr/bin/env python
 
-from distutils.core import setup
+from setuptools import setup
 
 setup(
     name='subinapp',
@@ -9,6 +9,10 @@ setup(
     author='sealwing',
     author_email='sealinsky@gmail.com',
     license='MIT',
-    requires=['inapppy'],
+    install_requires=['inapppy', 'cryptography'],
+    extras_require={
+        'async': ['aiohttp'],
+        'numpy': ['numpy'],
+    },
     packages=['subinapp', 'subinapp.core', 'subinapp.core.providers', 'subinapp.interface']
 )
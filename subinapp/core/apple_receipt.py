@@ -0,0 +1,302 @@
+"""
+Local decoding of App Store receipts: base64 of PKCS#7 container with ASN.1 set of receipt attributes
+Receipts are decoded to reject garbage before request to App Store and to route them between environments,
+signature isn't checked, App Store remains the only source of verified data
+"""
+
+import base64
+import binascii
+import logging
+import threading
+from collections import OrderedDict
+from datetime import datetime, timezone
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from subinapp.core.forking import register_after_fork
+from subinapp.core.routing import receipt_digest, receipt_digest_keys
+from subinapp.interface.entities import AppleReceipt, AppleInAppPurchase
+from subinapp.interface.exceptions import VerificationFailed
+
+log = logging.getLogger(__name__)
+
+# ASN.1 tags
+INTEGER = 0x02
+OCTET_STRING = 0x04
+CONSTRUCTED_OCTET_STRING = 0x24
+OBJECT_IDENTIFIER = 0x06
+UTF8_STRING = 0x0c
+IA5_STRING = 0x16
+SEQUENCE = 0x30
+SET = 0x31
+CONTEXT_0 = 0xa0
+
+# Encoded object identifiers of PKCS#7 content types
+SIGNED_DATA_OID = bytes.fromhex('2a864886f70d010702')
+DATA_OID = bytes.fromhex('2a864886f70d010701')
+
+# Types of receipt attributes
+BUNDLE_ID = 2
+APPLICATION_VERSION = 3
+IN_APP = 17
+ORIGINAL_APPLICATION_VERSION = 19
+CREATION_DATE = 12
+
+# Types of in-app purchase attributes
+QUANTITY = 1701
+PRODUCT_ID = 1702
+TRANSACTION_ID = 1703
+PURCHASE_DATE = 1704
+ORIGINAL_TRANSACTION_ID = 1705
+EXPIRES_DATE = 1708
+WEB_ORDER_LINE_ITEM_ID = 1711
+CANCELLATION_DATE = 1712
+
+# Nesting of receipt is 7 levels, deeper data isn't receipt
+MAX_DEPTH = 16
+# Receipts with thousands of purchases take hundreds of kilobytes
+MAX_RECEIPT_SIZE = 4 * 1024 * 1024
+# Number of recently decoded receipts kept by their digests
+DECODED_CACHE_SIZE = 256
+
+# (tag, start of content, end of content, start of next element)
+_Element = Tuple[int, int, int, int]
+
+
+def _read_element(data: bytes, offset: int, limit: int, depth: int = 0) -> _Element:
+    """
+    Reads tag and length of BER element, App Store uses indefinite lengths in outer layers
+    :raises ValueError: Element is truncated or isn't supported
+    """
+    if depth > MAX_DEPTH:
+        raise ValueError('too deep nesting')
+    if offset + 2 > limit:
+        raise ValueError('truncated element')
+    tag = data[offset]
+    if tag & 0x1f == 0x1f:
+        raise ValueError('high tag numbers are not used in receipts')
+    length = data[offset + 1]
+    offset += 2
+    if length == 0x80:
+        if not tag & 0x20:
+            raise ValueError('indefinite length of primitive element')
+        # content is ended by two zero bytes
+        position = offset
+        while data[position:position + 2] != b'\x00\x00':
+            position = _read_element(data, position, limit, depth + 1)[3]
+        return tag, offset, position, position + 2
+    if length & 0x80:
+        size = length & 0x7f
+        if size > 4 or offset + size > limit:
+            raise ValueError('bad length')
+        length = int.from_bytes(data[offset:offset + size], 'big')
+        offset += size
+    if offset + length > limit:
+        raise ValueError('truncated element')
+    return tag, offset, offset + length, offset + length
+
+
+def _children(data: bytes, element: _Element, depth: int = 0) -> Iterator[_Element]:
+    _, position, end, _ = element
+    while position < end:
+        child = _read_element(data, position, end, depth + 1)
+        yield child
+        position = child[3]
+
+
+def _expect(element: _Element, tag: int) -> _Element:
+    if element[0] != tag:
+        raise ValueError('unexpected tag {:#x} instead of {:#x}'.format(element[0], tag))
+    return element
+
+
+def _octets(data: bytes, element: _Element) -> bytes:
+    """Content of octet string, constructed ones are concatenated from their chunks"""
+    if element[0] == OCTET_STRING:
+        return data[element[1]:element[2]]
+    _expect(element, CONSTRUCTED_OCTET_STRING)
+    return b''.join(_octets(data, child) for child in _children(data, element))
+
+
+def _integer(data: bytes, element: _Element) -> int:
+    _expect(element, INTEGER)
+    return int.from_bytes(data[element[1]:element[2]], 'big', signed=True)
+
+
+def _attributes(payload: bytes) -> Iterator[Tuple[int, bytes]]:
+    """Pairs of type and value of attributes in set of SEQUENCE {type, version, value}"""
+    attributes = _expect(_read_element(payload, 0, len(payload)), SET)
+    position, end = attributes[1], attributes[2]
+    while position < end:
+        attribute = _expect(_read_element(payload, position, end), SEQUENCE)
+        position = attribute[3]
+        attribute_type = _read_element(payload, attribute[1], attribute[2])
+        version = _read_element(payload, attribute_type[3], attribute[2])
+        value = _read_element(payload, version[3], attribute[2])
+        if value[3] != attribute[2]:
+            raise ValueError('attribute has extra fields')
+        yield _integer(payload, attribute_type), _octets(payload, value)
+
+
+def _value(value: bytes) -> bytes:
+    """Values of attributes are DER encoded too"""
+    element = _read_element(value, 0, len(value))
+    return value[element[1]:element[2]]
+
+
+def _string(value: bytes) -> str:
+    return _value(value).decode('utf-8')
+
+
+def _number(value: bytes) -> int:
+    return int.from_bytes(_value(value), 'big', signed=True)
+
+
+def _date(value: bytes) -> Optional[datetime]:
+    """Dates are RFC 3339 strings, empty if there is no date"""
+    text = _string(value)
+    if not text:
+        return None
+    # strptime takes most of decoding time of receipt with many purchases
+    if len(text) != 20 or text[4] != '-' or text[7] != '-' or text[10] != 'T' or text[19] != 'Z':
+        raise ValueError('bad date {!r}'.format(text))
+    return datetime(int(text[:4]), int(text[5:7]), int(text[8:10]),
+                    int(text[11:13]), int(text[14:16]), int(text[17:19]), tzinfo=timezone.utc)
+
+
+def _in_app_purchase(payload: bytes) -> AppleInAppPurchase:
+    fields: Dict[str, object] = {}
+    for attribute_type, value in _attributes(payload):
+        if attribute_type == PRODUCT_ID:
+            fields['product_id'] = _string(value)
+        elif attribute_type == TRANSACTION_ID:
+            fields['transaction_id'] = _string(value)
+        elif attribute_type == ORIGINAL_TRANSACTION_ID:
+            fields['original_transaction_id'] = _string(value)
+        elif attribute_type == PURCHASE_DATE:
+            fields['purchase_date'] = _date(value)
+        elif attribute_type == EXPIRES_DATE:
+            fields['expires_date'] = _date(value)
+        elif attribute_type == CANCELLATION_DATE:
+            fields['cancellation_date'] = _date(value)
+        elif attribute_type == QUANTITY:
+            fields['quantity'] = _number(value)
+        elif attribute_type == WEB_ORDER_LINE_ITEM_ID:
+            fields['web_order_line_item_id'] = _number(value)
+    return AppleInAppPurchase(**fields)
+
+
+def _signed_content(data: bytes) -> bytes:
+    """Receipt payload from PKCS#7 ContentInfo with SignedData"""
+    content_info = list(_children(data, _expect(_read_element(data, 0, len(data)), SEQUENCE)))
+    if len(content_info) < 2 or data[content_info[0][1]:content_info[0][2]] != SIGNED_DATA_OID:
+        raise ValueError('not signed data')
+    signed_data = _expect(next(_children(data, _expect(content_info[1], CONTEXT_0))), SEQUENCE)
+    # version, digest algorithms, content
+    content = list(_children(data, signed_data))[2]
+    content_type, explicit_content = list(_children(data, _expect(content, SEQUENCE)))[:2]
+    if data[content_type[1]:content_type[2]] != DATA_OID:
+        raise ValueError('content is not data')
+    return _octets(data, next(_children(data, _expect(explicit_content, CONTEXT_0))))
+
+
+class _DecodedReceipts:
+    """
+    Recently decoded receipts in LRU order
+    Keys are digests, so large receipts aren't kept in memory after request
+    """
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self._receipts: 'OrderedDict[str, AppleReceipt]' = OrderedDict()
+        self._lock = threading.Lock()
+        register_after_fork(self)
+
+    def _after_fork(self):
+        self._lock = threading.Lock()
+
+    def get(self, digest: str) -> Optional[AppleReceipt]:
+        with self._lock:
+            decoded = self._receipts.get(digest)
+            if decoded is not None:
+                self._receipts.move_to_end(digest)
+            return decoded
+
+    def put(self, digest: str, decoded: AppleReceipt):
+        with self._lock:
+            self._receipts[digest] = decoded
+            while len(self._receipts) > self.max_size:
+                self._receipts.popitem(last=False)
+
+
+_decoded = _DecodedReceipts(DECODED_CACHE_SIZE)
+
+
+def decode_receipt(receipt: str) -> AppleReceipt:
+    """
+    Decodes receipt from device, results of recent receipts are cached, because receipt is decoded
+        both for pre-screening and for routing
+    :raises VerificationFailed: Receipt is malformed
+    """
+    digest = receipt_digest(receipt)
+    decoded = _decoded.get(digest)
+    if decoded is None:
+        decoded = _decode(receipt)
+        _decoded.put(digest, decoded)
+    return decoded
+
+
+def _decode(receipt: str) -> AppleReceipt:
+    try:
+        data = base64.b64decode(''.join(receipt.split()), validate=True)
+        if len(data) > MAX_RECEIPT_SIZE:
+            raise ValueError('receipt is too large')
+        fields: Dict[str, object] = {}
+        in_app: List[AppleInAppPurchase] = []
+        for attribute_type, value in _attributes(_signed_content(data)):
+            if attribute_type == BUNDLE_ID:
+                fields['bundle_id'] = _string(value)
+            elif attribute_type == APPLICATION_VERSION:
+                fields['application_version'] = _string(value)
+            elif attribute_type == ORIGINAL_APPLICATION_VERSION:
+                fields['original_application_version'] = _string(value)
+            elif attribute_type == CREATION_DATE:
+                fields['creation_date'] = _date(value)
+            elif attribute_type == IN_APP:
+                in_app.append(_in_app_purchase(value))
+        return AppleReceipt(in_app=tuple(in_app), **fields)
+    except (binascii.Error, ValueError, TypeError, IndexError, StopIteration) as e:
+        raise VerificationFailed('Malformed App Store receipt: %s', e)
+
+
+def check_receipt(receipt: str, bundle_id: str) -> AppleReceipt:
+    """
+    Decodes receipt and checks that it belongs to application
+    :raises VerificationFailed: Receipt is malformed or it is receipt of other application
+    """
+    decoded = decode_receipt(receipt)
+    if decoded.bundle_id != bundle_id:
+        raise VerificationFailed('Receipt of %s is not for %s', decoded.bundle_id, bundle_id)
+    return decoded
+
+
+def receipt_keys(decoded: AppleReceipt) -> List[str]:
+    """Keys of decoded receipt in format of routing.response_keys"""
+    keys = {'original_transaction:{}'.format(purchase.original_transaction_id)
+            for purchase in decoded.in_app if purchase.original_transaction_id}
+    keys = sorted(keys)
+    if decoded.application_version:
+        keys.append('app_version:{}:{}'.format(decoded.bundle_id, decoded.application_version))
+    return keys
+
+
+def decoded_receipt_keys(receipt: str) -> List[str]:
+    """
+    Key extractor of routing.EnvironmentRouter using decoded receipt
+    Digest of receipt goes first, then its transactions, version of application is the least specific key
+    """
+    keys = receipt_digest_keys(receipt)
+    try:
+        keys.extend(receipt_keys(decode_receipt(receipt)))
+    except VerificationFailed:
+        pass
+    return keys
@@ -0,0 +1,153 @@
+"""
+Verification of receipts in batches with limited concurrency per provider
+"""
+
+import asyncio
+import logging
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, Future, wait, FIRST_COMPLETED
+from typing import Callable, Awaitable, Iterable, Iterator, AsyncIterator, Tuple, Union, Dict
+
+from subinapp.interface.entities import ProcessedReceipt, BatchVerificationResult
+
+log = logging.getLogger(__name__)
+
+# Verification of one receipt: (provider, receipt) -> ProcessedReceipt
+VerifyFunction = Callable[[str, str], ProcessedReceipt]
+AsyncVerifyFunction = Callable[[str, str], Awaitable[ProcessedReceipt]]
+# Same limit for every provider or limits by provider name, providers missing in dict have DEFAULT_CONCURRENCY
+Concurrency = Union[int, Dict[str, int]]
+
+DEFAULT_CONCURRENCY = 10
+
+
+def _get_limit(concurrency: Concurrency, provider: str) -> int:
+    if isinstance(concurrency, int):
+        return concurrency
+    return concurrency.get(provider, DEFAULT_CONCURRENCY)
+
+
+def _total_limit(concurrency: Concurrency, providers: Iterable[str] = ()) -> int:
+    """Sum of limits of providers, including default limit of providers missing in dict"""
+    if isinstance(concurrency, int):
+        return concurrency
+    unlisted = set(providers) - set(concurrency)
+    return sum(concurrency.values()) + DEFAULT_CONCURRENCY * len(unlisted) or DEFAULT_CONCURRENCY
+
+
+def _verify_item(verify: VerifyFunction, index: int, provider: str, receipt: str) -> BatchVerificationResult:
+    """Any exception of item is returned in result, so batch is not aborted"""
+    try:
+        return BatchVerificationResult(index=index, provider=provider, processed_receipt=verify(provider, receipt))
+    except (KeyboardInterrupt, SystemExit, GeneratorExit):
+        raise
+    except BaseException as e:
+        # exceptions from subinapp.interface.exceptions are not subclasses of Exception
+        log.warning('Receipt %s of batch is not verified: %s', index, e)
+        return BatchVerificationResult(index=index, provider=provider, error=e)
+
+
+def verify_receipts(verify: VerifyFunction,
+                    receipts: Iterable[Tuple[str, str]],
+                    concurrency: Concurrency = DEFAULT_CONCURRENCY,
+                    ordered: bool = True,
+                    max_pending: int = None,
+                    providers: Iterable[str] = ()) -> Iterator[BatchVerificationResult]:
+    """
+    Verifies receipts in thread pool of each provider and yields results
+    Receipts are taken from iterable lazily, so not more than max_pending of them are kept in memory
+    :param verify: Function verifying one receipt
+    :param receipts: Pairs of provider and receipt
+    :param concurrency: Max number of simultaneous verifications for each provider
+    :param ordered: Yield results in order of receipts, otherwise as they are completed
+    :param max_pending: Max number of submitted, but not yielded receipts, by default twice of total concurrency
+    :param providers: Providers of receipts, the ones missing in dict of concurrency add default limit to total
+    """
+    max_pending = max_pending or 2 * _total_limit(concurrency, providers)
+    executors: Dict[str, ThreadPoolExecutor] = {}
+    pending = deque()
+
+    def submit(index: int, provider: str, receipt: str) -> Future:
+        if provider not in executors:
+            executors[provider] = ThreadPoolExecutor(max_workers=_get_limit(concurrency, provider),
+                                                     thread_name_prefix='subinapp-{}'.format(provider))
+        return executors[provider].submit(_verify_item, verify, index, provider, receipt)
+
+    try:
+        for index, (provider, receipt) in enumerate(receipts):
+            pending.append(submit(index, provider, receipt))
+            while len(pending) >= max_pending:
+                yield from _pop_completed(pending, ordered)
+        while pending:
+            yield from _pop_completed(pending, ordered)
+    finally:
+        for future in pending:
+            future.cancel()
+        for executor in executors.values():
+            executor.shutdown(wait=True)
+
+
+def _pop_completed(pending: deque, ordered: bool) -> Iterator[BatchVerificationResult]:
+    """Waits for first pending future or any of them and yields their results"""
+    if ordered:
+        yield pending.popleft().result()
+        return
+    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+    for future in done:
+        pending.remove(future)
+        yield future.result()
+
+
+async def _averify_item(verify: AsyncVerifyFunction, semaphore: asyncio.Semaphore,
+                        index: int, provider: str, receipt: str) -> BatchVerificationResult:
+    async with semaphore:
+        try:
+            return BatchVerificationResult(index=index, provider=provider,
+                                           processed_receipt=await verify(provider, receipt))
+        except (KeyboardInterrupt, SystemExit, GeneratorExit, asyncio.CancelledError):
+            raise
+        except BaseException as e:
+            log.warning('Receipt %s of batch is not verified: %s', index, e)
+            return BatchVerificationResult(index=index, provider=provider, error=e)
+
+
+async def averify_receipts(verify: AsyncVerifyFunction,
+                           receipts: Iterable[Tuple[str, str]],
+                           concurrency: Concurrency = DEFAULT_CONCURRENCY,
+                           ordered: bool = True,
+                           max_pending: int = None,
+                           providers: Iterable[str] = ()) -> AsyncIterator[BatchVerificationResult]:
+    """
+    Asyncio version of verify_receipts
+    Concurrency of each provider is limited by semaphore instead of thread pool
+    """
+    max_pending = max_pending or 2 * _total_limit(concurrency, providers)
+    semaphores: Dict[str, asyncio.Semaphore] = {}
+    pending = deque()
+
+    def submit(index: int, provider: str, receipt: str) -> asyncio.Task:
+        if provider not in semaphores:
+            semaphores[provider] = asyncio.Semaphore(_get_limit(concurrency, provider))
+        return asyncio.ensure_future(_averify_item(verify, semaphores[provider], index, provider, receipt))
+
+    async def pop_completed():
+        if ordered:
+            return [await pending.popleft()]
+        done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+        for task in done:
+            pending.remove(task)
+        return [task.result() for task in done]
+
+    try:
+        for index, (provider, receipt) in enumerate(receipts):
+            pending.append(submit(index, provider, receipt))
+            while len(pending) >= max_pending:
+                for result in await pop_completed():
+                    yield result
+        while pending:
+            for result in await pop_completed():
+                yield result
+    finally:
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
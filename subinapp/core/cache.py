@@ -0,0 +1,74 @@
+"""
+Caching of verification results
+"""
+
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+from typing import Optional, Tuple
+
+from subinapp.core.forking import register_after_fork
+from subinapp.interface.api import BaseReceiptCache
+from subinapp.interface.entities import ProcessedReceipt
+
+
+def receipt_cache_key(provider: str, receipt: str) -> str:
+    """Key of receipt in cache: provider and sha256 of receipt"""
+    return '{}:{}'.format(provider, hashlib.sha256(receipt.encode('utf-8')).hexdigest())
+
+
+def receipt_cache_ttl(processed_receipt: ProcessedReceipt, max_ttl: float) -> float:
+    """
+    Time to keep result in cache
+    It is never longer than time left before subscription expiration
+    """
+    expiration_date = processed_receipt.subscription_info.expiration_date
+    now = datetime.now(expiration_date.tzinfo)
+    return min(max_ttl, (expiration_date - now).total_seconds())
+
+
+class InMemoryCache(BaseReceiptCache):
+    """
+    Thread safe LRU cache in memory of process
+    Least recently used results are evicted when max_size is reached
+    """
+
+    def __init__(self, max_size: int = 10000):
+        self.max_size = max_size
+        # key -> (monotonic time of expiration, result)
+        self._items: 'OrderedDict[str, Tuple[float, ProcessedReceipt]]' = OrderedDict()
+        self._lock = threading.Lock()
+        register_after_fork(self)
+
+    def _after_fork(self):
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[ProcessedReceipt]:
+        with self._lock:
+            item = self._items.get(key)
+            if item is None:
+                return None
+            expires_at, value = item
+            if expires_at <= time.monotonic():
+                del self._items[key]
+                return None
+            self._items.move_to_end(key)
+            return value
+
+    def set(self, key: str, value: ProcessedReceipt, ttl: float):
+        if ttl <= 0:
+            return
+        with self._lock:
+            self._items[key] = (time.monotonic() + ttl, value)
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+
+    def delete(self, key: str):
+        with self._lock:
+            self._items.pop(key, None)
+
+    def __len__(self):
+        return len(self._items)
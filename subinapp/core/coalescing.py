@@ -0,0 +1,143 @@
+"""
+Coalescing of concurrent identical calls: one of them does the work, others get its result
+If the call failed because of its own deadline or rate limit of its priority,
+others with time left do the work themselves
+"""
+
+import asyncio
+import threading
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+from subinapp.core.deadlines import Deadline
+from subinapp.core.forking import register_after_fork
+from subinapp.interface.exceptions import DeadlineExceeded, RateLimitExceeded, ProviderThrottled
+
+
+def _is_retried(error: BaseException, deadline: Optional[Deadline]) -> bool:
+    """Error is of budget or priority of leading call, not of the work, so call with time left retries it"""
+    if isinstance(error, ProviderThrottled) or not isinstance(error, (DeadlineExceeded, RateLimitExceeded)):
+        return False
+    return deadline is None or not deadline.expired
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.value: Any = None
+        self.error: Optional[BaseException] = None
+
+
+class SingleFlight:
+    """
+    Calls with the same key made while first of them is in progress
+    wait for it and get its result or exception instead of calling function again
+    Thread safe
+    """
+
+    def __init__(self):
+        self._calls: Dict[str, _Call] = {}
+        self._lock = threading.Lock()
+        # number of calls that got result of another call
+        self.collapsed = 0
+        register_after_fork(self)
+
+    def _after_fork(self):
+        # calls in progress belong to threads of parent
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key: str, func: Callable[[], Any], on_collapsed: Optional[Callable[[], None]] = None,
+           deadline: Optional[Deadline] = None) -> Any:
+        """
+        Returns result of func or of call with the same key that is in progress
+        :param key: Identity of call
+        :param func: Does the work
+        :param on_collapsed: Is called if result of another call is used
+        :param deadline: Result of another call isn't waited after it
+        :raises DeadlineExceeded: Call in progress isn't finished before deadline
+        """
+        while True:
+            with self._lock:
+                call = self._calls.get(key)
+                if call is None:
+                    call = self._calls[key] = _Call()
+                    break
+                self.collapsed += 1
+            if on_collapsed is not None:
+                on_collapsed()
+            if not call.done.wait(deadline.remaining() if deadline is not None else None):
+                raise deadline.error('end of the same verification in progress')
+            if call.error is None:
+                return call.value
+            if not _is_retried(call.error, deadline):
+                raise call.error
+        try:
+            call.value = func()
+            return call.value
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+
+def _retrieve_exception(task: asyncio.Task):
+    """Marks exception as retrieved, so it isn't logged if all waiting calls were cancelled"""
+    if not task.cancelled():
+        task.exception()
+
+
+class AsyncSingleFlight:
+    """
+    Asyncio version of SingleFlight, it should be used from one event loop
+    Work is done in separate task, so cancellation of first call doesn't cancel others
+    """
+
+    def __init__(self):
+        self._tasks: Dict[str, asyncio.Task] = {}
+        self.collapsed = 0
+        register_after_fork(self)
+
+    def _after_fork(self):
+        # tasks belong to event loop of parent
+        self._tasks = {}
+
+    def _forget(self, key: str, task: asyncio.Task):
+        # task of next call with the same key may be started already
+        if self._tasks.get(key) is task:
+            del self._tasks[key]
+
+    async def do(self, key: str, func: Callable[[], Awaitable[Any]],
+                 on_collapsed: Optional[Callable[[], None]] = None,
+                 deadline: Optional[Deadline] = None) -> Any:
+        """
+        Returns result of func or of call with the same key that is in progress
+        :param key: Identity of call
+        :param func: Coroutine function doing the work
+        :param on_collapsed: Is called if result of another call is used
+        :param deadline: Result of another call isn't waited after it
+        :raises DeadlineExceeded: Call in progress isn't finished before deadline
+        """
+        while True:
+            task = self._tasks.get(key)
+            if task is None or task.done():
+                task = self._tasks[key] = asyncio.ensure_future(func())
+                task.add_done_callback(lambda done: self._forget(key, done))
+                task.add_done_callback(_retrieve_exception)
+                return await asyncio.shield(task)
+            self.collapsed += 1
+            if on_collapsed is not None:
+                on_collapsed()
+            try:
+                if deadline is None:
+                    return await asyncio.shield(task)
+                return await asyncio.wait_for(asyncio.shield(task), deadline.remaining())
+            except asyncio.TimeoutError:
+                if task.done():
+                    raise
+                raise deadline.error('end of the same verification in progress')
+            except (DeadlineExceeded, RateLimitExceeded) as e:
+                if not _is_retried(e, deadline):
+                    raise
@@ -2,16 +2,28 @@
 Controllers to use from application
 """
 
+import asyncio
+import copy
 import dataclasses
-import json
+import functools
 import logging
 from collections import namedtuple
+from contextlib import contextmanager, nullcontext
 from importlib import import_module
-from typing import Optional
+from typing import Optional, Iterable, Iterator, AsyncIterator, Tuple, Union, Dict
 
-from subinapp.interface.api import BaseVerifier, BaseParser
-from subinapp.interface.entities import SubscriptionManagerConfig, ProcessedReceipt, VerifiedSubscriptionInfo
-from subinapp.interface.exceptions import ConfigurationIsMissing, UndefinedProvider
+from subinapp.core import batch
+from subinapp.core.cache import receipt_cache_key, receipt_cache_ttl
+from subinapp.core.coalescing import SingleFlight, AsyncSingleFlight
+from subinapp.core.deadlines import Deadline, DeadlineArg, to_deadline, deadline_scope
+from subinapp.core.lazy import LazyProviders
+from subinapp.core.metrics import Metrics, InstrumentedSerialization, VERIFIED, CACHE_HIT, COALESCED
+from subinapp.core.resilience import CircuitBreaker, Hedger
+from subinapp.core.scheduling import ProviderScheduler, AsyncProviderScheduler, INTERACTIVE, BACKGROUND
+from subinapp.interface.api import BaseVerifier, BaseParser, AsyncBaseVerifier, BaseReceiptCache, BaseMetricsSink
+from subinapp.interface.entities import SubscriptionManagerConfig, ProcessedReceipt, VerifiedSubscriptionInfo, \
+    BatchVerificationResult, SerializationOptions, RateLimit, HedgePolicy, CircuitBreakerPolicy
+from subinapp.interface.exceptions import ConfigurationIsMissing, UndefinedProvider, ProviderUnavailable
 
 log = logging.getLogger(__name__)
 
@@ -25,49 +37,397 @@ class SubscriptionsBasicController:
     providers: Optional[set] = None
     verifiers = None
     parsers = None
+    # Name of verifier class in provider module
+    verifier_class_name = 'Verifier'
+    # Storage of verification results, results are not cached if it is None
+    cache: Optional[BaseReceiptCache] = None
+    # Max seconds to keep result in cache
+    cache_ttl: float = 3600
+    # How receipt and provider response are serialized in ProcessedReceipt
+    serialization: SerializationOptions = SerializationOptions()
+    # Sinks of timings, outcomes and sizes, nothing is measured without them
+    metrics: Metrics = Metrics()
+    # Verifications in progress, concurrent verifications of the same receipt share one of them
+    in_flight: Optional[SingleFlight] = None
+    single_flight_class = SingleFlight
+    # Rate limits of requests by provider, requests aren't limited for providers without scheduler
+    schedulers: Optional[Dict[str, ProviderScheduler]] = None
+    scheduler_class = ProviderScheduler
+    # Hedging of slow requests and circuit breakers by provider
+    hedgers: Optional[Dict[str, Hedger]] = None
+    breakers: Optional[Dict[str, CircuitBreaker]] = None
 
     @classmethod
-    def configure(cls, config: SubscriptionManagerConfig):
+    def configure(cls, config: SubscriptionManagerConfig,
+                  cache: Optional[BaseReceiptCache] = None,
+                  cache_ttl: float = 3600,
+                  serialization: Optional[SerializationOptions] = None,
+                  metrics_sinks: Iterable[BaseMetricsSink] = (),
+                  lazy: bool = False,
+                  coalesce: bool = True,
+                  rate_limits: Optional[Dict[str, RateLimit]] = None,
+                  hedging: Optional[Dict[str, HedgePolicy]] = None,
+                  circuit_breakers: Optional[Dict[str, CircuitBreakerPolicy]] = None):
         """
         Gets providers to be configured from not None config field names
         Sets validators and parsers for each provider as class properties
         Validator and Parser is taken from subinapp.core
+        :param config: Configuration of providers
+        :param cache: Storage of verification results, e.g. subinapp.core.cache.InMemoryCache
+        :param cache_ttl: Max seconds to keep result in cache, anyway it's not kept after subscription expiration
+        :param serialization: Options of receipt and provider response serialization
+        :param metrics_sinks: Receivers of metrics, e.g. subinapp.core.metrics.InMemoryHistogramSink
+        :param lazy: Import provider module and create its verifier and parser on first use or in warm()
+        :param coalesce: Concurrent verifications of the same receipt share one request to provider
+        :param rate_limits: Limits of requests by provider
+        :param hedging: Policies of hedging slow requests by provider
+        :param circuit_breakers: Policies of failing fast while provider is failing, by provider
         """
         cls.config = config
+        cls.cache = cache
+        cls.cache_ttl = cache_ttl
+        cls.serialization = serialization or SerializationOptions()
+        cls.metrics = Metrics(metrics_sinks)
+        cls.in_flight = cls.single_flight_class() if coalesce else None
+        cls.schedulers = {p: cls.scheduler_class(p, limit) for p, limit in (rate_limits or {}).items()}
+        cls.hedgers = {p: Hedger(p, policy) for p, policy in (hedging or {}).items()}
+        cls.breakers = {p: CircuitBreaker(p, policy) for p, policy in (circuit_breakers or {}).items()}
+        for component in (*cls.schedulers.values(), *cls.hedgers.values(), *cls.breakers.values()):
+            component.metrics = cls.metrics
         providers = {k for k, v in dataclasses.asdict(config).items() if v}
         if len(providers) == 0:
             raise ConfigurationIsMissing('No provider configurations found')
         cls.providers = providers
+        if lazy:
+            log.info('Validators and parsers for providers %s are loaded on first use', ', '.join(cls.providers))
+            cls.verifiers = LazyProviders(cls.providers, cls._load_verifier)
+            cls.parsers = LazyProviders(cls.providers, cls._load_parser)
+            return
         log.info('Configuring validators and parsers for providers: %s', ', '.join(cls.providers))
-        provider_modules = {p: import_module('subinapp.core.providers.{}'.format(p)) for p in cls.providers}
         # Prepare namedtuple class instances
         ProviderVerifiers = namedtuple('ProviderVerifiers', cls.providers)
         ProviderParsers = namedtuple('ProviderParsers', cls.providers)
-        cls.verifiers = ProviderVerifiers(**{p: provider_modules[p].Verifier(cls.config) for p in cls.providers})
-        cls.parsers = ProviderParsers(**{p: provider_modules[p].Parser() for p in cls.providers})
+        cls.verifiers = ProviderVerifiers(**{p: cls._load_verifier(p) for p in cls.providers})
+        cls.parsers = ProviderParsers(**{p: cls._load_parser(p) for p in cls.providers})
 
     @classmethod
-    def verify_receipt(cls, provider: str, receipt: str) -> ProcessedReceipt:
+    def warm(cls, providers: Optional[Iterable[str]] = None):
+        """
+        Loads verifiers and parsers of providers and credentials of verifiers, so first requests don't wait for it
+        With lazy configuration call it in master process of pre-fork server to share loaded modules with workers
+        :param providers: Providers to load, all configured by default
+        :raises UndefinedProvider: Provider is not configured
+        """
+        for provider in providers or cls.providers or ():
+            cls._is_provider_in_list(provider)
+            getattr(cls.parsers, provider)
+            getattr(cls.verifiers, provider).warm()
+
+    @classmethod
+    def _load_verifier(cls, provider: str) -> Union[BaseVerifier, AsyncBaseVerifier]:
+        module = import_module('subinapp.core.providers.{}'.format(provider))
+        verifier = getattr(module, cls.verifier_class_name)(cls.config)
+        verifier.metrics = cls.metrics
+        return verifier
+
+    @classmethod
+    def _load_parser(cls, provider: str) -> BaseParser:
+        return import_module('subinapp.core.providers.{}'.format(provider)).Parser()
+
+    @classmethod
+    def verify_receipt(cls, provider: str, receipt: str, priority: int = INTERACTIVE,
+                       deadline: DeadlineArg = None) -> ProcessedReceipt:
         """
         Returns verified and parsed receipt or raises exception from verifier or parser
         :param provider: Provider title in lowercase
         :param receipt: In app purchase receipt from device
+        :param priority: Priority of request to rate limited provider, INTERACTIVE or BACKGROUND
+        :param deadline: Seconds given to verification or Deadline shared with other calls,
+            HTTP timeouts are cut to it and it is checked before each stage of verification
+        :raises RateLimitExceeded: Request is rejected by rate limit or provider throttled it
+        :raises DeadlineExceeded: Verification isn't finished before deadline
         """
-        cls._is_provider_in_list(provider)
+        deadline = to_deadline(deadline)
+        with cls.metrics.outcomes(provider):
+            cls._is_provider_in_list(provider)
+            cache_key, cached = cls._get_cached(provider, receipt)
+            if cached is not None:
+                return cached
+            if deadline is not None:
+                deadline.check('verification')
+            if cls.in_flight is None:
+                return cls._verify_and_process(provider, receipt, cache_key, priority, deadline)
+            return cls.in_flight.do(cache_key or receipt_cache_key(provider, receipt),
+                                    lambda: cls._verify_and_process(provider, receipt, cache_key, priority, deadline),
+                                    cls._collapsed_counter(provider),
+                                    deadline)
+
+    @classmethod
+    def _verify_and_process(cls, provider: str, receipt: str, cache_key: Optional[str],
+                            priority: int, deadline: Optional[Deadline] = None) -> ProcessedReceipt:
+        breaker = cls._get_breaker(provider)
+        scheduler = cls._get_scheduler(provider)
+        try:
+            with breaker.guard() if breaker is not None else nullcontext():
+                with scheduler.slot(priority, deadline) if scheduler is not None else nullcontext():
+                    provider_response = cls._request_provider(provider, receipt, deadline)
+        except ProviderUnavailable as e:
+            return cls._serve_stale(breaker, provider, receipt, cache_key, e)
+        result = cls._process_response(provider, receipt, provider_response, cache_key, deadline)
+        if breaker is not None:
+            breaker.remember(cls._stale_key(provider, receipt, cache_key), result)
+        return result
+
+    @classmethod
+    def _request_provider(cls, provider: str, receipt: str, deadline: Optional[Deadline] = None) -> dict:
         verifier: BaseVerifier = getattr(cls.verifiers, provider)
-        provider_response: dict = verifier.verify(receipt)
+        hedger = cls._get_hedger(provider)
+        with cls.metrics.timer(provider, 'verify'), deadline_scope(deadline, 'answer of {}'.format(provider)):
+            if hedger is None:
+                return verifier.verify(receipt)
+            return hedger.call(verifier.verify, receipt, guard=functools.partial(cls._hedge_guard, provider))
+
+    @classmethod
+    def verify_receipts(cls,
+                        receipts: Iterable[Tuple[str, str]],
+                        concurrency: batch.Concurrency = batch.DEFAULT_CONCURRENCY,
+                        ordered: bool = True,
+                        max_pending: int = None,
+                        priority: int = BACKGROUND,
+                        deadline: DeadlineArg = None) -> Iterator[BatchVerificationResult]:
+        """
+        Verifies a lot of receipts at once and yields result for each of them
+        Failed receipt doesn't abort batch, exception is returned in its result
+        :param receipts: Pairs of provider and receipt
+        :param concurrency: Max number of simultaneous verifications for all or each provider,
+            providers missing in dict have batch.DEFAULT_CONCURRENCY
+        :param ordered: Yield results in order of receipts, otherwise as they are completed
+        :param max_pending: Max number of receipts in progress or waiting to be yielded
+        :param priority: Priority of requests to rate limited providers
+        :param deadline: Seconds given to the whole batch, receipts not verified by then get DeadlineExceeded
+        """
+        deadline = to_deadline(deadline)
+        return batch.verify_receipts(
+            lambda provider, receipt: cls.verify_receipt(provider, receipt, priority, deadline),
+            receipts, concurrency=concurrency, ordered=ordered, max_pending=max_pending, providers=cls.providers or ())
+
+    @classmethod
+    def _get_cached(cls, provider: str, receipt: str) -> Tuple[Optional[str], Optional[ProcessedReceipt]]:
+        """Returns key of receipt in cache and cached result if there is any"""
+        if cls.cache is None:
+            return None, None
+        cache_key = receipt_cache_key(provider, receipt)
+        cached = cls.cache.get(cache_key)
+        if cached is not None and cls.metrics:
+            cls.metrics.increment(provider, CACHE_HIT)
+        return cache_key, cached
+
+    @classmethod
+    def _get_scheduler(cls, provider: str) -> Optional[ProviderScheduler]:
+        return cls.schedulers.get(provider) if cls.schedulers else None
+
+    @classmethod
+    def _get_hedger(cls, provider: str) -> Optional[Hedger]:
+        return cls.hedgers.get(provider) if cls.hedgers else None
+
+    @classmethod
+    def _get_breaker(cls, provider: str) -> Optional[CircuitBreaker]:
+        return cls.breakers.get(provider) if cls.breakers else None
+
+    @classmethod
+    @contextmanager
+    def _hedge_guard(cls, provider: str):
+        """Hedge is charged to rate limit and circuit breaker of provider like first request"""
+        breaker = cls._get_breaker(provider)
+        scheduler = cls._get_scheduler(provider)
+        with breaker.guard() if breaker is not None else nullcontext():
+            with scheduler.hedge_slot() if scheduler is not None else nullcontext():
+                yield
+
+    @classmethod
+    def _stale_key(cls, provider: str, receipt: str, cache_key: Optional[str]) -> str:
+        """Key of last successful result of receipt in circuit breaker"""
+        return cache_key or receipt_cache_key(provider, receipt)
+
+    @classmethod
+    def _serve_stale(cls, breaker: Optional[CircuitBreaker], provider: str, receipt: str,
+                     cache_key: Optional[str], error: ProviderUnavailable) -> ProcessedReceipt:
+        """
+        Last successful result of receipt while provider is unavailable
+        :raises ProviderUnavailable: Given error, if there is no known result of receipt
+        """
+        stale = breaker.stale(cls._stale_key(provider, receipt, cache_key)) if breaker is not None else None
+        if stale is None:
+            raise error
+        log.warning('Last known result of receipt is returned, because %s is unavailable', provider)
+        # remembered result isn't changed, it may be returned to other callers
+        stale = copy.copy(stale)
+        stale.is_stale = True
+        return stale
+
+    @classmethod
+    def _collapsed_counter(cls, provider: str):
+        """Counts verifications that got result of the same one in progress"""
+        if not cls.metrics:
+            return None
+        return lambda: cls.metrics.increment(provider, COALESCED)
+
+    @classmethod
+    def _process_response(cls, provider: str, receipt: str, provider_response: dict,
+                          cache_key: Optional[str] = None, deadline: Optional[Deadline] = None) -> ProcessedReceipt:
+        """
+        Parses response from provider and packs it with receipt
+        Result is stored in cache if key is given
+        :raises ParsingFailed: Response from provider can't be parsed
+        :raises DeadlineExceeded: Deadline has come before parsing or serialization
+        """
         parser: BaseParser = getattr(cls.parsers, provider)
-        subscription_info: VerifiedSubscriptionInfo = parser.parse(provider_response)
-        return ProcessedReceipt(provider=provider,
-                                subscription_info=subscription_info,
-                                receipt=json.dumps(receipt).encode('utf-8'),
-                                provider_response=json.dumps(provider_response).encode('utf-8'))
+        if deadline is not None:
+            deadline.check('parsing')
+        with cls.metrics.timer(provider, 'parse'):
+            subscription_info: VerifiedSubscriptionInfo = parser.parse(provider_response)
+        if deadline is not None:
+            deadline.check('serialization')
+        serialization = cls.serialization
+        if cls.metrics:
+            cls.metrics.increment(provider, VERIFIED)
+            serialization = InstrumentedSerialization(serialization, cls.metrics, provider)
+            raw = getattr(provider_response, 'raw', None)
+            if raw is not None:
+                cls.metrics.observe_size(provider, 'raw_provider_response', len(raw))
+        # receipt and response are serialized only if result is used for that
+        result = ProcessedReceipt(provider=provider,
+                                  subscription_info=subscription_info,
+                                  raw_receipt=receipt,
+                                  raw_provider_response=provider_response,
+                                  serialization=serialization)
+        if cache_key:
+            cls.cache.set(cache_key, result, receipt_cache_ttl(result, cls.cache_ttl))
+        return result
 
     @classmethod
     def _is_provider_in_list(cls, provider: str):
         """
-        Checks if provider in cls.parsers
+        Checks if provider in cls.providers
         :raises UndefinedProvider: If provider not in cls.providers
         """
-        if provider not in cls.parsers:
+        if not cls.providers or provider not in cls.providers:
             raise UndefinedProvider('Provider %s is not configured for class %s', provider, cls.__name__)
+
+
+class AsyncSubscriptionsController(SubscriptionsBasicController):
+    """
+    Asyncio version of SubscriptionsBasicController
+    Verifiers are taken from AsyncVerifier classes of providers, parsers are the same
+    Configured separately from SubscriptionsBasicController
+    """
+    config: Optional[SubscriptionManagerConfig] = None
+    providers: Optional[set] = None
+    verifiers = None
+    parsers = None
+    verifier_class_name = 'AsyncVerifier'
+    cache: Optional[BaseReceiptCache] = None
+    serialization: SerializationOptions = SerializationOptions()
+    metrics: Metrics = Metrics()
+    in_flight: Optional[AsyncSingleFlight] = None
+    single_flight_class = AsyncSingleFlight
+    schedulers: Optional[Dict[str, AsyncProviderScheduler]] = None
+    scheduler_class = AsyncProviderScheduler
+    hedgers: Optional[Dict[str, Hedger]] = None
+    breakers: Optional[Dict[str, CircuitBreaker]] = None
+
+    @classmethod
+    async def verify_receipt(cls, provider: str, receipt: str, priority: int = INTERACTIVE,
+                             deadline: DeadlineArg = None) -> ProcessedReceipt:
+        """
+        Returns verified and parsed receipt or raises exception from verifier or parser
+        Event loop is not blocked while waiting for provider's response
+        :param provider: Provider title in lowercase
+        :param receipt: In app purchase receipt from device
+        :param priority: Priority of request to rate limited provider, INTERACTIVE or BACKGROUND
+        :param deadline: Seconds given to verification or Deadline shared with other calls,
+            request to provider is cancelled when it comes
+        :raises RateLimitExceeded: Request is rejected by rate limit or provider throttled it
+        :raises DeadlineExceeded: Verification isn't finished before deadline
+        """
+        deadline = to_deadline(deadline)
+        with cls.metrics.outcomes(provider):
+            cls._is_provider_in_list(provider)
+            cache_key, cached = cls._get_cached(provider, receipt)
+            if cached is not None:
+                return cached
+            if deadline is not None:
+                deadline.check('verification')
+            if cls.in_flight is None:
+                return await cls._verify_and_process(provider, receipt, cache_key, priority, deadline)
+            return await cls.in_flight.do(
+                cache_key or receipt_cache_key(provider, receipt),
+                lambda: cls._verify_and_process(provider, receipt, cache_key, priority, deadline),
+                cls._collapsed_counter(provider),
+                deadline)
+
+    @classmethod
+    async def _verify_and_process(cls, provider: str, receipt: str, cache_key: Optional[str],
+                                  priority: int, deadline: Optional[Deadline] = None) -> ProcessedReceipt:
+        breaker = cls._get_breaker(provider)
+        scheduler = cls._get_scheduler(provider)
+        try:
+            with breaker.guard() if breaker is not None else nullcontext():
+                if scheduler is None:
+                    provider_response = await cls._request_provider(provider, receipt, deadline)
+                else:
+                    async with scheduler.slot(priority, deadline):
+                        provider_response = await cls._request_provider(provider, receipt, deadline)
+        except ProviderUnavailable as e:
+            return cls._serve_stale(breaker, provider, receipt, cache_key, e)
+        result = cls._process_response(provider, receipt, provider_response, cache_key, deadline)
+        if breaker is not None:
+            breaker.remember(cls._stale_key(provider, receipt, cache_key), result)
+        return result
+
+    @classmethod
+    async def _request_provider(cls, provider: str, receipt: str, deadline: Optional[Deadline] = None) -> dict:
+        verifier: AsyncBaseVerifier = getattr(cls.verifiers, provider)
+        hedger = cls._get_hedger(provider)
+        stage = 'answer of {}'.format(provider)
+        with cls.metrics.timer(provider, 'verify'), deadline_scope(deadline, stage):
+            request = verifier.verify(receipt) if hedger is None else \
+                hedger.acall(verifier.verify, receipt, guard=functools.partial(cls._hedge_guard, provider))
+            if deadline is None:
+                return await request
+            try:
+                return await asyncio.wait_for(request, deadline.remaining())
+            except asyncio.TimeoutError:
+                if deadline.expired:
+                    raise deadline.error(stage)
+                raise
+
+    @classmethod
+    def verify_receipts(cls,
+                        receipts: Iterable[Tuple[str, str]],
+                        concurrency: batch.Concurrency = batch.DEFAULT_CONCURRENCY,
+                        ordered: bool = True,
+                        max_pending: int = None,
+                        priority: int = BACKGROUND,
+                        deadline: DeadlineArg = None) -> AsyncIterator[BatchVerificationResult]:
+        """
+        Same as SubscriptionsBasicController.verify_receipts, but returns async iterator
+        :param receipts: Pairs of provider and receipt
+        :param concurrency: Max number of simultaneous verifications for all or each provider,
+            providers missing in dict have batch.DEFAULT_CONCURRENCY
+        :param ordered: Yield results in order of receipts, otherwise as they are completed
+        :param max_pending: Max number of receipts in progress or waiting to be yielded
+        :param priority: Priority of requests to rate limited providers
+        :param deadline: Seconds given to the whole batch, receipts not verified by then get DeadlineExceeded
+        """
+        deadline = to_deadline(deadline)
+        return batch.averify_receipts(
+            lambda provider, receipt: cls.verify_receipt(provider, receipt, priority, deadline),
+            receipts, concurrency=concurrency, ordered=ordered, max_pending=max_pending, providers=cls.providers or ())
+
+    @classmethod
+    async def close(cls):
+        """Closes sessions of all verifiers, should be called on application shutdown"""
+        if cls.verifiers:
+            for verifier in cls.verifiers:
+                await verifier.close()
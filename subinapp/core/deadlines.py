@@ -0,0 +1,107 @@
+"""
+Deadlines of verifications: time budget given by caller and shared by all stages of verification
+Deadline of current verification is kept in context variable, so verifiers cut their HTTP timeouts to it
+"""
+
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import TYPE_CHECKING, Optional, Union
+
+from subinapp.interface.exceptions import DeadlineExceeded, ProviderUnavailable
+
+if TYPE_CHECKING:
+    import aiohttp
+
+_current: ContextVar[Optional['Deadline']] = ContextVar('subinapp_deadline', default=None)
+
+
+class Deadline:
+    """Point of time verification should be finished by"""
+
+    def __init__(self, seconds: float):
+        """
+        :param seconds: Budget of verification from now
+        """
+        self.seconds = seconds
+        self.expires_at = time.monotonic() + seconds
+
+    def remaining(self) -> float:
+        """Seconds left before deadline"""
+        return max(0.0, self.expires_at - time.monotonic())
+
+    @property
+    def expired(self) -> bool:
+        return time.monotonic() >= self.expires_at
+
+    def error(self, stage: str) -> DeadlineExceeded:
+        return DeadlineExceeded('Deadline of %s seconds is exceeded before %s', self.seconds, stage)
+
+    def check(self, stage: str):
+        """
+        :param stage: Work that is going to be done, used in error
+        :raises DeadlineExceeded: There is no time left
+        """
+        if self.expired:
+            raise self.error(stage)
+
+    def cap(self, timeout: Optional[float], stage: str) -> float:
+        """
+        Timeout of operation cut to time left before deadline
+        :raises DeadlineExceeded: There is no time left
+        """
+        self.check(stage)
+        remaining = self.remaining()
+        return remaining if timeout is None else min(timeout, remaining)
+
+    def __repr__(self) -> str:
+        return 'Deadline({:.3f} of {} seconds left)'.format(self.remaining(), self.seconds)
+
+
+# Budget of call in seconds or deadline shared with other calls
+DeadlineArg = Union[None, float, Deadline]
+
+
+def to_deadline(value: DeadlineArg) -> Optional[Deadline]:
+    if value is None or isinstance(value, Deadline):
+        return value
+    return Deadline(value)
+
+
+def current_deadline() -> Optional[Deadline]:
+    """Deadline of verification in progress in current thread or task, None if it isn't limited"""
+    return _current.get()
+
+
+@contextmanager
+def deadline_scope(deadline: Optional[Deadline], stage: str):
+    """
+    Makes deadline current for verifiers
+    Unavailability of provider after deadline is timeout of request cut by deadline, it is raised as DeadlineExceeded
+    """
+    if deadline is None:
+        yield
+        return
+    token = _current.set(deadline)
+    try:
+        yield
+    except ProviderUnavailable as e:
+        if not deadline.expired:
+            raise
+        raise deadline.error(stage) from e
+    finally:
+        _current.reset(token)
+
+
+def client_timeout(timeout: 'aiohttp.ClientTimeout', stage: str) -> 'aiohttp.ClientTimeout':
+    """
+    Timeout of aiohttp request with total time cut to time left before deadline of current verification
+    :param timeout: Timeout of session
+    :raises DeadlineExceeded: There is no time left for request
+    """
+    deadline = current_deadline()
+    if deadline is None:
+        return timeout
+    # attr is dependency of aiohttp, it is imported only by async verifiers
+    import attr
+    return attr.evolve(timeout, total=deadline.cap(timeout.total, stage))
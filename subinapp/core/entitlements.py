@@ -0,0 +1,232 @@
+"""
+Compact index of subscriptions for fast checks of access
+"""
+
+import heapq
+import sys
+import threading
+import time
+from array import array
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple, TypeVar, Union
+
+from subinapp.core.forking import register_after_fork
+from subinapp.interface.entities import VerifiedSubscriptionInfo, ProcessedReceipt, BatchVerificationResult
+
+# Markers of slots of hash table, hash() of str never returns -1
+EMPTY = 0
+DELETED = -1
+# Table is rebuilt when live and deleted entries take this part of slots
+MAX_LOAD = 0.7
+MIN_CAPACITY = 8
+
+Result = TypeVar('Result', ProcessedReceipt, BatchVerificationResult)
+# Columns of hash table: keys, expirations, product codes
+_Table = Tuple[array, array, array]
+
+
+def _token_key(purchase_token: str) -> int:
+    # hash of str is 64 bit and is cached in str object, index lives in memory of one process
+    return hash(purchase_token) or 1
+
+
+def _new_table(capacity: int) -> _Table:
+    return array('q', bytes(8 * capacity)), array('d', bytes(8 * capacity)), array('I', bytes(4 * capacity))
+
+
+def _find(keys: array, key: int) -> int:
+    """Slot of key or -1 if it is missing"""
+    mask = len(keys) - 1
+    slot = key & mask
+    while True:
+        stored = keys[slot]
+        if stored == key:
+            return slot
+        if stored == EMPTY:
+            return -1
+        slot = (slot + 1) & mask
+
+
+class EntitlementIndex:
+    """
+    Expiration of subscriptions by purchase token in columns of open addressing hash table
+    Entry takes about 20 bytes per slot instead of hundreds for dict of VerifiedSubscriptionInfo,
+    purchase tokens aren't stored, only their 64 bit hashes, so tokens can't be listed.
+    Keys are also grouped in buckets by expiration time, so lapsed entries are removed without full scan.
+    Lookups don't take lock, updates are serialized
+    """
+
+    def __init__(self, capacity: int = 1024, bucket_seconds: float = 3600):
+        """
+        :param capacity: Expected number of entries, table grows when it is exceeded
+        :param bucket_seconds: Width of bucket of expiration times, lapsed entries are removed by whole buckets
+        """
+        self.bucket_seconds = bucket_seconds
+        self._table = _new_table(self._capacity_for(capacity))
+        self._size = 0
+        # live and deleted slots
+        self._used = 0
+        self._products: List[str] = []
+        self._product_codes: Dict[str, int] = {}
+        # bucket number -> keys of entries expiring in it, entries may be moved to other bucket since then
+        self._buckets: Dict[int, array] = {}
+        self._bucket_heap: List[int] = []
+        self._lock = threading.Lock()
+        register_after_fork(self)
+
+    def _after_fork(self):
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _capacity_for(size: int) -> int:
+        capacity = MIN_CAPACITY
+        while capacity * MAX_LOAD < size:
+            capacity *= 2
+        return capacity
+
+    def __len__(self):
+        return self._size
+
+    def __contains__(self, purchase_token: str) -> bool:
+        return _find(self._table[0], _token_key(purchase_token)) >= 0
+
+    def expires_at(self, purchase_token: str) -> Optional[float]:
+        """Unix time of expiration of subscription or None if it isn't indexed"""
+        keys, expirations, _ = self._table
+        slot = _find(keys, _token_key(purchase_token))
+        return expirations[slot] if slot >= 0 else None
+
+    def is_active(self, purchase_token: str, at: float = None, product_id: str = None) -> bool:
+        """
+        Checks that subscription doesn't expire before the time
+        :param purchase_token: Purchase token of subscription
+        :param at: Unix time, current time by default
+        :param product_id: Subscription has to be of this product if it is given
+        """
+        keys, expirations, products = self._table
+        slot = _find(keys, _token_key(purchase_token))
+        if slot < 0 or expirations[slot] <= (time.time() if at is None else at):
+            return False
+        return product_id is None or self._products[products[slot]] == product_id
+
+    def update(self, subscription_info: VerifiedSubscriptionInfo):
+        """Adds subscription or replaces its expiration"""
+        key = _token_key(subscription_info.purchase_token)
+        expiration = subscription_info.expiration_date.timestamp()
+        with self._lock:
+            product = self._product_codes.get(subscription_info.product_id)
+            if product is None:
+                product = self._product_codes[subscription_info.product_id] = len(self._products)
+                self._products.append(subscription_info.product_id)
+            self._insert(key, expiration, product)
+            self._add_to_bucket(key, expiration)
+
+    def track(self, results: Iterable[Result]) -> Iterator[Result]:
+        """
+        Updates index with results of verification as they are consumed
+        :param results: ProcessedReceipt from verify_receipt or BatchVerificationResult from verify_receipts
+        """
+        for result in results:
+            processed_receipt = getattr(result, 'processed_receipt', result)
+            if processed_receipt is not None:
+                self.update(processed_receipt.subscription_info)
+            yield result
+
+    def discard(self, purchase_token: str):
+        """Removes subscription if it is indexed"""
+        with self._lock:
+            self._delete(_find(self._table[0], _token_key(purchase_token)))
+
+    def expire(self, now: float = None) -> int:
+        """
+        Removes lapsed entries of buckets which are over
+        :param now: Unix time, current time by default
+        :return: Number of removed entries
+        """
+        now = time.time() if now is None else now
+        current_bucket = int(now // self.bucket_seconds)
+        removed = 0
+        with self._lock:
+            while self._bucket_heap and self._bucket_heap[0] < current_bucket:
+                keys = self._buckets.pop(heapq.heappop(self._bucket_heap))
+                table_keys, expirations, _ = self._table
+                for key in keys:
+                    slot = _find(table_keys, key)
+                    # entry is renewed if its expiration is later
+                    if slot >= 0 and expirations[slot] <= now:
+                        self._delete(slot)
+                        removed += 1
+        return removed
+
+    def _insert(self, key: int, expiration: float, product: int):
+        keys, expirations, products = self._table
+        mask = len(keys) - 1
+        slot = key & mask
+        free = -1
+        while True:
+            stored = keys[slot]
+            if stored == key:
+                expirations[slot] = expiration
+                products[slot] = product
+                return
+            if stored == EMPTY:
+                break
+            if stored == DELETED and free < 0:
+                free = slot
+            slot = (slot + 1) & mask
+        if free < 0:
+            free = slot
+            self._used += 1
+        # key is set last, so lookup doesn't see entry before its values
+        expirations[free] = expiration
+        products[free] = product
+        keys[free] = key
+        self._size += 1
+        if self._used > len(keys) * MAX_LOAD:
+            self._rebuild()
+
+    def _delete(self, slot: int):
+        if slot >= 0:
+            self._table[0][slot] = DELETED
+            self._size -= 1
+
+    def _rebuild(self):
+        """Moves live entries to new table, it is swapped at once, so lookups see either old or new one"""
+        old_keys, old_expirations, old_products = self._table
+        capacity = len(old_keys)
+        if self._size > capacity * MAX_LOAD / 2:
+            capacity *= 2
+        table = keys, expirations, products = _new_table(capacity)
+        mask = len(keys) - 1
+        for old_slot, key in enumerate(old_keys):
+            if key == EMPTY or key == DELETED:
+                continue
+            slot = key & mask
+            while keys[slot] != EMPTY:
+                slot = (slot + 1) & mask
+            keys[slot] = key
+            expirations[slot] = old_expirations[old_slot]
+            products[slot] = old_products[old_slot]
+        self._table = table
+        self._used = self._size
+
+    def _add_to_bucket(self, key: int, expiration: float):
+        bucket = int(expiration // self.bucket_seconds)
+        keys = self._buckets.get(bucket)
+        if keys is None:
+            keys = self._buckets[bucket] = array('q')
+            heapq.heappush(self._bucket_heap, bucket)
+        keys.append(key)
+
+    def memory_bytes(self) -> int:
+        """Approximate memory taken by index"""
+        return (sum(sys.getsizeof(column) for column in self._table)
+                + sum(sys.getsizeof(keys) for keys in self._buckets.values())
+                + sys.getsizeof(self._buckets) + sys.getsizeof(self._bucket_heap))
+
+    def stats(self) -> Dict[str, Union[int, float]]:
+        return {
+            'entries': self._size,
+            'capacity': len(self._table[0]),
+            'buckets': len(self._buckets),
+            'memory_bytes': self.memory_bytes(),
+        }
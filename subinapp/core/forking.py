@@ -0,0 +1,32 @@
+"""
+Reinitialization of objects created before fork, e.g. in master process of pre-fork server
+"""
+
+import logging
+import os
+import weakref
+
+log = logging.getLogger(__name__)
+
+# Objects with _after_fork method, they are referenced weakly
+_registered = weakref.WeakSet()
+
+
+def register_after_fork(obj):
+    """
+    Calls obj._after_fork() in child process after fork
+    It should replace locks, connections and threads inherited from parent
+    """
+    _registered.add(obj)
+
+
+def _after_fork_in_child():
+    for obj in list(_registered):
+        try:
+            obj._after_fork()
+        except Exception as e:
+            log.warning('Failed to reinitialize %r after fork: %s', obj, e)
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_after_fork_in_child)
@@ -0,0 +1,54 @@
+"""
+Objects of providers created on first use
+"""
+
+import threading
+from typing import Any, Callable, Dict, Iterable, Iterator
+
+from subinapp.core.forking import register_after_fork
+
+
+class LazyProviders:
+    """
+    Container of objects by provider, object is created by factory on first access
+    Has the same interface as namedtuple of eagerly created objects: attribute per provider and iteration
+    Iteration yields only created objects, so it never triggers loading
+    """
+
+    def __init__(self, providers: Iterable[str], factory: Callable[[str], Any]):
+        """
+        :param providers: Names of providers
+        :param factory: Creates object for provider name
+        """
+        self._fields = tuple(sorted(providers))
+        self._factory = factory
+        self._loaded: Dict[str, Any] = {}
+        self._locks = {provider: threading.Lock() for provider in self._fields}
+        register_after_fork(self)
+
+    def _after_fork(self):
+        self._locks = {provider: threading.Lock() for provider in self._fields}
+
+    def __getattr__(self, provider: str) -> Any:
+        # it is called only for names that aren't attributes of container
+        if provider.startswith('_') or provider not in self._fields:
+            raise AttributeError(provider)
+        loaded = self._loaded.get(provider)
+        if loaded is not None:
+            return loaded
+        with self._locks[provider]:
+            if provider not in self._loaded:
+                self._loaded[provider] = self._factory(provider)
+            return self._loaded[provider]
+
+    def __iter__(self) -> Iterator[Any]:
+        return iter(list(self._loaded.values()))
+
+    def __bool__(self):
+        return bool(self._fields)
+
+    def is_loaded(self, provider: str) -> bool:
+        return provider in self._loaded
+
+    def load(self, provider: str) -> Any:
+        return getattr(self, provider)
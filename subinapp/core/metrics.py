@@ -0,0 +1,259 @@
+"""
+Instrumentation of verification process: timings of stages, outcomes and sizes of payloads
+"""
+
+import bisect
+import threading
+import time
+from collections import defaultdict
+from typing import Iterable, List, Dict, Tuple, Optional
+
+from subinapp.core.forking import register_after_fork
+from subinapp.interface.api import BaseMetricsSink
+from subinapp.interface.entities import SerializationOptions
+from subinapp.interface.exceptions import VerificationFailed, ParsingFailed, UndefinedProvider, RateLimitExceeded, \
+    ProviderUnavailable, DeadlineExceeded
+
+# Outcomes of verify_receipt
+VERIFIED = 'verified'
+CACHE_HIT = 'cache_hit'
+# verification got result of the same one in progress
+COALESCED = 'coalesced'
+OUTCOMES = (
+    (DeadlineExceeded, 'deadline_exceeded'),
+    (RateLimitExceeded, 'rate_limited'),
+    (ProviderUnavailable, 'provider_unavailable'),
+    (VerificationFailed, 'verification_failed'),
+    (ParsingFailed, 'parsing_failed'),
+    (UndefinedProvider, 'undefined_provider'),
+)
+
+DURATION_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+
+
+class _NullContext:
+    """Does nothing, used when there are no sinks"""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        return False
+
+
+_NULL_CONTEXT = _NullContext()
+
+
+class _Timer:
+    def __init__(self, metrics: 'Metrics', provider: str, stage: str):
+        self.metrics = metrics
+        self.provider = provider
+        self.stage = stage
+        self.started = 0.0
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.metrics.observe_duration(self.provider, self.stage, time.perf_counter() - self.started)
+        return False
+
+
+class _OutcomeCounter:
+    def __init__(self, metrics: 'Metrics', provider: str):
+        self.metrics = metrics
+        self.provider = provider
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            return False
+        for exception_class, outcome in OUTCOMES:
+            if issubclass(exc_type, exception_class):
+                self.metrics.increment(self.provider, outcome)
+                break
+        else:
+            self.metrics.increment(self.provider, 'error')
+        return False
+
+
+class Metrics(BaseMetricsSink):
+    """
+    Sends metrics to all registered sinks
+    If there are no sinks it is falsy and its context managers do nothing
+    """
+
+    def __init__(self, sinks: Iterable[BaseMetricsSink] = ()):
+        self.sinks: List[BaseMetricsSink] = list(sinks)
+
+    def __bool__(self):
+        return bool(self.sinks)
+
+    def add_sink(self, sink: BaseMetricsSink):
+        self.sinks.append(sink)
+
+    def observe_duration(self, provider: str, stage: str, seconds: float):
+        for sink in self.sinks:
+            sink.observe_duration(provider, stage, seconds)
+
+    def increment(self, provider: str, event: str, value: int = 1):
+        for sink in self.sinks:
+            sink.increment(provider, event, value)
+
+    def observe_size(self, provider: str, payload: str, size: int):
+        for sink in self.sinks:
+            sink.observe_size(provider, payload, size)
+
+    def timer(self, provider: str, stage: str):
+        """Context manager measuring duration of stage"""
+        if not self.sinks:
+            return _NULL_CONTEXT
+        return _Timer(self, provider, stage)
+
+    def outcomes(self, provider: str):
+        """Context manager counting failed verifications by exception"""
+        if not self.sinks:
+            return _NULL_CONTEXT
+        return _OutcomeCounter(self, provider)
+
+
+class Histogram:
+    """Cumulative histogram with fixed buckets"""
+
+    def __init__(self, buckets: Tuple[float, ...]):
+        self.buckets = buckets
+        # last one is +Inf
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative_counts(self) -> List[int]:
+        result, total = [], 0
+        for count in self.counts:
+            total += count
+            result.append(total)
+        return result
+
+    def quantile(self, q: float) -> Optional[float]:
+        """Estimation of quantile as upper bound of bucket, None if there are no values"""
+        if not self.count:
+            return None
+        rank = q * self.count
+        for bound, total in zip(self.buckets + (float('inf'),), self.cumulative_counts()):
+            if total >= rank:
+                return bound
+        return float('inf')
+
+
+class InMemoryHistogramSink(BaseMetricsSink):
+    """Keeps histograms of durations and sizes and counters of events in memory of process"""
+
+    def __init__(self, duration_buckets: Tuple[float, ...] = DURATION_BUCKETS,
+                 size_buckets: Tuple[float, ...] = SIZE_BUCKETS):
+        self.duration_buckets = duration_buckets
+        self.size_buckets = size_buckets
+        self.durations: Dict[Tuple[str, str], Histogram] = {}
+        self.sizes: Dict[Tuple[str, str], Histogram] = {}
+        self.counters: Dict[Tuple[str, str], int] = defaultdict(int)
+        self._lock = threading.Lock()
+        register_after_fork(self)
+
+    def _after_fork(self):
+        self._lock = threading.Lock()
+
+    def observe_duration(self, provider: str, stage: str, seconds: float):
+        with self._lock:
+            histogram = self.durations.get((provider, stage))
+            if histogram is None:
+                histogram = self.durations[(provider, stage)] = Histogram(self.duration_buckets)
+            histogram.observe(seconds)
+
+    def increment(self, provider: str, event: str, value: int = 1):
+        with self._lock:
+            self.counters[(provider, event)] += value
+
+    def observe_size(self, provider: str, payload: str, size: int):
+        with self._lock:
+            histogram = self.sizes.get((provider, payload))
+            if histogram is None:
+                histogram = self.sizes[(provider, payload)] = Histogram(self.size_buckets)
+            histogram.observe(size)
+
+
+def _format_labels(labels: Dict[str, str]) -> str:
+    return ','.join('{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+                    for k, v in labels.items())
+
+
+def _format_bound(bound: float) -> str:
+    return '+Inf' if bound == float('inf') else repr(float(bound))
+
+
+def _render_histograms(lines: List[str], name: str, label: str, histograms: Dict[Tuple[str, str], Histogram]):
+    lines.append('# TYPE {} histogram'.format(name))
+    for (provider, value), histogram in sorted(histograms.items()):
+        labels = {'provider': provider, label: value}
+        for bound, total in zip(histogram.buckets + (float('inf'),), histogram.cumulative_counts()):
+            lines.append('{}_bucket{{{}}} {}'.format(
+                name, _format_labels(dict(labels, le=_format_bound(bound))), total))
+        lines.append('{}_sum{{{}}} {}'.format(name, _format_labels(labels), repr(float(histogram.sum))))
+        lines.append('{}_count{{{}}} {}'.format(name, _format_labels(labels), histogram.count))
+
+
+def render_prometheus(sink: InMemoryHistogramSink, prefix: str = 'subinapp', breakers: Iterable = ()) -> str:
+    """
+    Metrics of sink in Prometheus text exposition format
+    :param breakers: Circuit breakers of providers, their states are rendered as gauge (0 closed, 1 half-open, 2 open)
+    """
+    lines = []
+    breakers = list(breakers)
+    if breakers:
+        name = '{}_circuit_breaker_state'.format(prefix)
+        lines.append('# TYPE {} gauge'.format(name))
+        for breaker in sorted(breakers, key=lambda b: b.provider):
+            lines.append('{}{{{}}} {}'.format(name, _format_labels({'provider': breaker.provider}),
+                                              breaker.stats()['state_code']))
+    with sink._lock:
+        _render_histograms(lines, '{}_stage_duration_seconds'.format(prefix), 'stage', sink.durations)
+        _render_histograms(lines, '{}_payload_size_bytes'.format(prefix), 'payload', sink.sizes)
+        name = '{}_events_total'.format(prefix)
+        lines.append('# TYPE {} counter'.format(name))
+        for (provider, event), value in sorted(sink.counters.items()):
+            lines.append('{}{{{}}} {}'.format(name, _format_labels({'provider': provider, 'event': event}), value))
+    return '\n'.join(lines) + '\n'
+
+
+class InstrumentedSerialization(SerializationOptions):
+    """Serialization options reporting time of serialization and sizes of payloads"""
+
+    def __init__(self, options: SerializationOptions, metrics: Metrics, provider: str):
+        super(InstrumentedSerialization, self).__init__(keep_raw=options.keep_raw,
+                                                        include_fields=options.include_fields,
+                                                        exclude_fields=options.exclude_fields)
+        self.metrics = metrics
+        self.provider = provider
+
+    def __reduce__(self):
+        # sinks hold locks, so result stored in shared cache is pickled with plain options
+        return SerializationOptions, (self.keep_raw, self.include_fields, self.exclude_fields)
+
+    def serialize_receipt(self, receipt: str) -> bytes:
+        with self.metrics.timer(self.provider, 'serialize'):
+            result = super(InstrumentedSerialization, self).serialize_receipt(receipt)
+        self.metrics.observe_size(self.provider, 'receipt', len(result))
+        return result
+
+    def serialize_provider_response(self, provider_response: dict) -> bytes:
+        with self.metrics.timer(self.provider, 'serialize'):
+            result = super(InstrumentedSerialization, self).serialize_provider_response(provider_response)
+        self.metrics.observe_size(self.provider, 'provider_response', len(result))
+        return result
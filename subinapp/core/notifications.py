@@ -0,0 +1,233 @@
+"""
+Processing of notifications of providers about renewals, cancellations and refunds
+"""
+
+import itertools
+import logging
+import threading
+import time
+from collections import OrderedDict
+from importlib import import_module
+from typing import Any, AsyncIterable, AsyncIterator, Dict, Iterable, Iterator, List, Tuple, Type, Union
+
+from subinapp.core import batch
+from subinapp.core.cache import receipt_cache_key
+from subinapp.core.controllers import SubscriptionsBasicController
+from subinapp.core.forking import register_after_fork
+from subinapp.core.scheduling import BACKGROUND
+from subinapp.interface.api import BaseDeduplicationStore
+from subinapp.interface.entities import ProviderNotification, SubscriptionUpdate, BatchVerificationResult
+from subinapp.interface.exceptions import VerificationFailed, ParsingFailed, UndefinedProvider
+
+log = logging.getLogger(__name__)
+
+# Providers redeliver notifications for several days (Pub/Sub keeps messages for 7 days)
+DEFAULT_DEDUPLICATION_TTL = 7 * 24 * 3600
+
+# Pair of provider and notification payload: body of request or message as bytes, str or dict
+Notification = Tuple[str, Union[bytes, str, dict]]
+# Notifications about the same receipt, they are verified with provider once
+_Requests = Dict[Tuple[str, str], List[ProviderNotification]]
+
+
+class InMemoryDeduplicationStore(BaseDeduplicationStore):
+    """
+    Thread safe store of keys in memory of process
+    Least recently added keys are evicted when max_size is reached
+    """
+
+    def __init__(self, max_size: int = 100000):
+        self.max_size = max_size
+        # key -> monotonic time of expiration
+        self._keys: 'OrderedDict[str, float]' = OrderedDict()
+        self._lock = threading.Lock()
+        register_after_fork(self)
+
+    def _after_fork(self):
+        self._lock = threading.Lock()
+
+    def add(self, key: str, ttl: float) -> bool:
+        now = time.monotonic()
+        with self._lock:
+            expires_at = self._keys.get(key)
+            if expires_at is not None and expires_at > now:
+                return False
+            self._keys[key] = now + ttl
+            self._keys.move_to_end(key)
+            while len(self._keys) > self.max_size:
+                self._keys.popitem(last=False)
+            return True
+
+    def discard(self, key: str):
+        with self._lock:
+            self._keys.pop(key, None)
+
+    def __len__(self):
+        return len(self._keys)
+
+
+class NotificationPipeline:
+    """
+    Turns stream of notifications into updates of subscriptions
+    Notifications are read in batches and redelivered ones are skipped.
+    Subscription is parsed from notification if it contains its data, otherwise receipt is verified with provider,
+        once for all notifications about the same receipt in batch
+    Updates of batch are yielded when whole batch is processed, not in order of notifications
+    """
+
+    def __init__(self, controller: Type[SubscriptionsBasicController],
+                 deduplication: BaseDeduplicationStore = None,
+                 deduplication_ttl: float = DEFAULT_DEDUPLICATION_TTL,
+                 batch_size: int = 100,
+                 concurrency: batch.Concurrency = batch.DEFAULT_CONCURRENCY):
+        """
+        :param controller: Configured controller, AsyncSubscriptionsController for aprocess()
+        :param deduplication: Store of processed notifications, InMemoryDeduplicationStore by default
+        :param deduplication_ttl: Seconds to remember processed notification
+        :param batch_size: Max number of notifications processed at once
+        :param concurrency: Max number of simultaneous verifications with each provider
+        """
+        self.controller = controller
+        self.deduplication = deduplication if deduplication is not None else InMemoryDeduplicationStore()
+        self.deduplication_ttl = deduplication_ttl
+        self.batch_size = batch_size
+        self.concurrency = concurrency
+        # metrics
+        self.received = 0
+        self.duplicates = 0
+        self.parsed = 0
+        self.verified = 0
+        self.failed = 0
+
+    def decode(self, provider: str, payload: Union[bytes, str, dict]) -> ProviderNotification:
+        """
+        Decodes notification with decode_notification of provider module
+        :raises UndefinedProvider: Provider is not configured for controller
+        :raises VerificationFailed: Notification is malformed or not authentic
+        """
+        self.controller._is_provider_in_list(provider)
+        module = import_module('subinapp.core.providers.{}'.format(provider))
+        return module.decode_notification(payload, getattr(self.controller.config, provider))
+
+    def process(self, notifications: Iterable[Notification]) -> Iterator[SubscriptionUpdate]:
+        """
+        Yields update for each new notification, notifications are taken from iterable lazily
+        :param notifications: Pairs of provider and notification payload
+        """
+        iterator = iter(notifications)
+        while True:
+            chunk = list(itertools.islice(iterator, self.batch_size))
+            if not chunk:
+                return
+            updates, requests = self._plan(chunk)
+            results = self.controller.verify_receipts(list(requests), concurrency=self.concurrency,
+                                                      priority=BACKGROUND)
+            updates.extend(self._apply_results(requests, results))
+            yield from updates
+
+    async def aprocess(self, notifications: Union[Iterable[Notification], AsyncIterable[Notification]]
+                       ) -> AsyncIterator[SubscriptionUpdate]:
+        """
+        Same as process, but verifications are awaited, controller should be AsyncSubscriptionsController
+        :param notifications: Pairs of provider and notification payload
+        """
+        async for chunk in _achunks(notifications, self.batch_size):
+            updates, requests = self._plan(chunk)
+            results = [result async for result in self.controller.verify_receipts(
+                list(requests), concurrency=self.concurrency, priority=BACKGROUND)]
+            updates.extend(self._apply_results(requests, results))
+            for update in updates:
+                yield update
+
+    def _plan(self, chunk: List[Notification]) -> Tuple[List[SubscriptionUpdate], _Requests]:
+        """
+        Decodes and deduplicates notifications of batch
+        :return: Updates that are ready and notifications to verify with provider by receipt
+        """
+        updates, requests = [], {}
+        for provider, payload in chunk:
+            self.received += 1
+            try:
+                notification = self.decode(provider, payload)
+            except (VerificationFailed, UndefinedProvider) as e:
+                self.failed += 1
+                updates.append(SubscriptionUpdate(provider=provider, error=e))
+                continue
+            if not self.deduplication.add(self._deduplication_key(notification), self.deduplication_ttl):
+                self.duplicates += 1
+                continue
+            if notification.provider_response is not None:
+                updates.append(self._parse(notification))
+            elif notification.receipt:
+                self._invalidate_cache(notification)
+                requests.setdefault((provider, notification.receipt), []).append(notification)
+            else:
+                # notification isn't about subscription
+                updates.append(SubscriptionUpdate(provider=provider, notification=notification))
+        return updates, requests
+
+    def _parse(self, notification: ProviderNotification) -> SubscriptionUpdate:
+        try:
+            subscription_info = getattr(self.controller.parsers, notification.provider).parse(
+                notification.provider_response)
+        except ParsingFailed as e:
+            return self._failed(notification, e)
+        self.parsed += 1
+        return SubscriptionUpdate(provider=notification.provider, notification=notification,
+                                  subscription_info=subscription_info)
+
+    def _apply_results(self, requests: _Requests,
+                       results: Iterable[BatchVerificationResult]) -> Iterator[SubscriptionUpdate]:
+        """Shares result of verification of receipt between notifications about it"""
+        notifications_by_index = list(requests.values())
+        for result in results:
+            for notification in notifications_by_index[result.index]:
+                if not result.is_verified:
+                    yield self._failed(notification, result.error)
+                    continue
+                self.verified += 1
+                yield SubscriptionUpdate(provider=notification.provider, notification=notification,
+                                         subscription_info=result.processed_receipt.subscription_info,
+                                         verified_with_provider=True)
+
+    def _failed(self, notification: ProviderNotification, error: BaseException) -> SubscriptionUpdate:
+        """Notification is forgotten, so it is processed again when provider redelivers it"""
+        self.failed += 1
+        self.deduplication.discard(self._deduplication_key(notification))
+        return SubscriptionUpdate(provider=notification.provider, notification=notification, error=error)
+
+    def _invalidate_cache(self, notification: ProviderNotification):
+        """Subscription is changed, so cached result of its verification is outdated"""
+        if self.controller.cache is not None:
+            self.controller.cache.delete(receipt_cache_key(notification.provider, notification.receipt))
+
+    @staticmethod
+    def _deduplication_key(notification: ProviderNotification) -> str:
+        return 'notification:{}:{}'.format(notification.provider, notification.notification_id)
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            'received_total': self.received,
+            'duplicates_total': self.duplicates,
+            'parsed_total': self.parsed,
+            'verified_total': self.verified,
+            'failed_total': self.failed,
+        }
+
+
+async def _achunks(items: Union[Iterable[Any], AsyncIterable[Any]], size: int) -> AsyncIterator[List[Any]]:
+    if not hasattr(items, '__aiter__'):
+        iterator = iter(items)
+        while True:
+            chunk = list(itertools.islice(iterator, size))
+            if not chunk:
+                return
+            yield chunk
+    chunk = []
+    async for item in items:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
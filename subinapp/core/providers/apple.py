@@ -2,30 +2,260 @@
 Implementation of Verifier and Parser for App Store subscriptions
 """
 
+import asyncio
+import hashlib
+import hmac
+import json
 import logging
+import time
+from collections import ChainMap
 from datetime import datetime
+from typing import TYPE_CHECKING, Any, Callable, Dict, Hashable, Mapping, Optional, Tuple, Union
 
 import inapppy
+from inapppy.appstore import api_result_ok, api_result_errors
+from requests import RequestException
 
-from subinapp.interface.api import BaseVerifier, BaseParser
-from subinapp.interface.entities import VerifiedSubscriptionInfo
-from subinapp.interface.exceptions import VerificationFailed
+from subinapp.core.apple_receipt import check_receipt, decoded_receipt_keys
+from subinapp.core.deadlines import current_deadline, client_timeout
+from subinapp.core.forking import register_after_fork
+from subinapp.core.routing import EnvironmentRouter, SANDBOX, response_keys, response_environment, \
+    receipt_digest_keys
+from subinapp.core.scheduling import is_throttled, retry_after_seconds
+from subinapp.core.transport import PooledTransport
+from subinapp.interface.api import BaseVerifier, BaseParser, AsyncBaseVerifier
+from subinapp.interface.entities import ProviderResponse, AppleExtraArgs, AppleVerifierConfig, ProviderNotification
+from subinapp.interface.exceptions import VerificationFailed, ProviderThrottled, ProviderUnavailable, \
+    DeadlineExceeded
 from subinapp.interface.utils import parsing_exception
 
+if TYPE_CHECKING:
+    import aiohttp
+
 log = logging.getLogger(__name__)
 
+PRODUCTION_URL = 'https://buy.itunes.apple.com/verifyReceipt'
+SANDBOX_URL = 'https://sandbox.itunes.apple.com/verifyReceipt'
+# Statuses of receipts sent to wrong environment (sandbox to production and vice versa)
+WRONG_ENVIRONMENT_STATUSES = (21007, 21008)
+# Receipt server is unavailable, 21100-21199 are internal errors of App Store
+UNAVAILABLE_STATUSES = (21005,) + tuple(range(21100, 21200))
+
+
+def check_status(api_response: dict) -> dict:
+    """
+    Returns response if its status is ok
+    :raises inapppy.InAppPyValidationError: Bad status, error contains response
+    :raises ProviderUnavailable: App Store failed to check receipt
+    """
+    status = api_response.get('status', 'unknown')
+    if status in UNAVAILABLE_STATUSES:
+        raise ProviderUnavailable('App Store is unavailable, status %s', status)
+    if status != api_result_ok:
+        error = api_result_errors.get(status, inapppy.InAppPyValidationError('Unknown API status'))
+        raise inapppy.InAppPyValidationError(error.message, api_response)
+    return api_response
+
+
+def make_transport(extra: AppleExtraArgs) -> PooledTransport:
+    return PooledTransport(pool_size=extra.pool_size,
+                           connect_timeout=extra.connect_timeout,
+                           read_timeout=extra.read_timeout,
+                           max_retries=extra.max_retries,
+                           retry_backoff=extra.retry_backoff)
+
+
+def make_router(extra: AppleExtraArgs) -> Optional[EnvironmentRouter]:
+    if not extra.learn_environment:
+        return None
+    return EnvironmentRouter(max_size=extra.environment_cache_size,
+                             key_extractor=decoded_receipt_keys if extra.decode_receipts else receipt_digest_keys)
+
+
+def shared_resources(provider_config: AppleVerifierConfig) -> Dict[str, Tuple[Hashable, Callable[[], Any]]]:
+    """
+    Arguments of verifiers that can be shared by applications, e.g. by subinapp.core.tenants
+    Each one is given with key of settings it is created from and its factory
+    """
+    extra = provider_config.extra
+    return {
+        'transport': (('apple', 'transport', extra.pool_size, extra.connect_timeout, extra.read_timeout,
+                       extra.max_retries, extra.retry_backoff), lambda: make_transport(extra)),
+        'router': (('apple', 'router', extra.learn_environment, extra.environment_cache_size, extra.decode_receipts),
+                   lambda: make_router(extra)),
+    }
+
+
+def prescreen_receipt(provider_config: AppleVerifierConfig, metrics, receipt: str):
+    """
+    Rejects receipt without request to App Store, if receipts are decoded locally
+    :raises VerificationFailed: Receipt is malformed or it is receipt of other application
+    """
+    if not provider_config.extra.decode_receipts:
+        return
+    try:
+        check_receipt(receipt, provider_config.bundle_id)
+    except VerificationFailed as e:
+        log.warning('Apple receipt is rejected without request: %s', e)
+        if metrics:
+            metrics.increment('apple', 'rejected_locally')
+        raise
+
+
+def choose_sandbox(router: Optional[EnvironmentRouter], keys: list, default: bool) -> bool:
+    """Environment to send receipt first, learned one if it is known"""
+    environment = router.lookup(keys) if router is not None and keys else None
+    if environment is None:
+        return default
+    return environment == SANDBOX
+
+
+def learn_environment(router: Optional[EnvironmentRouter], keys: list, provider_response: dict):
+    """Remembers environment of verified receipt"""
+    if router is None:
+        return
+    environment = response_environment(provider_response)
+    if environment is not None:
+        router.remember(keys + response_keys(provider_response), environment)
+
+
+def check_retry_deadline(first_request_seconds: float):
+    """
+    Receipt is retried in other environment only if answer can come before deadline of verification,
+    retry is expected to take as long as first request
+    :raises DeadlineExceeded: Retry would be answered after deadline
+    """
+    deadline = current_deadline()
+    if deadline is not None and deadline.remaining() < first_request_seconds:
+        raise DeadlineExceeded('Receipt is not retried in other environment, %.3f seconds are left before deadline',
+                               deadline.remaining())
+
+
+def count_environment_retry(metrics, sandbox: bool, provider_response: dict):
+    """Counts receipts verified not in environment they were sent first"""
+    environment = response_environment(provider_response)
+    if metrics and environment is not None and (environment == SANDBOX) != sandbox:
+        metrics.increment('apple', 'environment_retry')
+
+
+def decode_notification(payload: Union[bytes, str, dict], provider_config: AppleVerifierConfig) -> ProviderNotification:
+    """
+    Decodes App Store Server Notification (version 1)
+    Data of subscription is taken from unified_receipt, it has the same format as verifyReceipt response,
+        it is trusted only if notification is authenticated by shared secret,
+        otherwise latest_receipt is verified with App Store
+    Notification has no id, so it is identified by digest of its content
+    :raises VerificationFailed: Notification is malformed, it is for other application
+        or its password doesn't match shared secret
+    """
+    try:
+        data = json.loads(payload) if isinstance(payload, (bytes, str)) else payload
+        if 'signedPayload' in data:
+            raise VerificationFailed('Signed App Store notifications (version 2) are decoded by storekit provider')
+        notification_type = data['notification_type']
+        unified_receipt = data.get('unified_receipt') or {}
+    except (ValueError, TypeError, KeyError, AttributeError) as e:
+        log.warning('Malformed App Store notification: %s', e)
+        raise VerificationFailed('Malformed App Store notification: %s', e)
+    if data.get('bid') != provider_config.bundle_id:
+        raise VerificationFailed('App Store notification is for other application %s', data.get('bid'))
+    shared_secret = provider_config.extra.shared_secret
+    if shared_secret and not hmac.compare_digest(str(data.get('password') or ''), shared_secret):
+        raise VerificationFailed('Password of App Store notification does not match shared secret')
+    notification_id = hashlib.sha256(json.dumps(data, sort_keys=True).encode('utf-8')).hexdigest()
+    # without shared secret anyone can post notification, so its data isn't trusted
+    if shared_secret and unified_receipt.get('latest_receipt_info'):
+        return ProviderNotification('apple', notification_id, notification_type, provider_response=unified_receipt)
+    return ProviderNotification('apple', notification_id, notification_type,
+                                receipt=unified_receipt.get('latest_receipt') or data.get('latest_receipt'))
+
+
+class PooledAppStoreValidator(inapppy.AppStoreValidator):
+    """
+    inapppy.AppStoreValidator sending requests through PooledTransport
+    Environment to retry is chosen per call and isn't stored, so validator can be used from many threads
+    """
+
+    production_url = PRODUCTION_URL
+    sandbox_url = SANDBOX_URL
+
+    def __init__(self, bundle_id: str = '', sandbox: bool = False, auto_retry_wrong_env_request: bool = False,
+                 http_timeout: int = None, transport: Optional[PooledTransport] = None):
+        # bundle_id is deprecated in inapppy, so it isn't passed there
+        super(PooledAppStoreValidator, self).__init__(sandbox=sandbox,
+                                                      auto_retry_wrong_env_request=auto_retry_wrong_env_request,
+                                                      http_timeout=http_timeout)
+        self.bundle_id = bundle_id
+        self.transport = transport or PooledTransport()
+
+    def post_json(self, request_json: dict, sandbox: Optional[bool] = None) -> ProviderResponse:
+        sandbox = self.sandbox if sandbox is None else sandbox
+        url = self.sandbox_url if sandbox else self.production_url
+        try:
+            response = self.transport.post(url, json.dumps(request_json).encode('utf-8'),
+                                           headers={'Content-Type': 'application/json'})
+            retry_after = response.headers.get('Retry-After')
+            if is_throttled(response.status_code, retry_after):
+                raise ProviderThrottled('App Store responded with status %s', response.status_code,
+                                        retry_after=retry_after_seconds(retry_after))
+            if response.status_code >= 500:
+                raise ProviderUnavailable('App Store responded with status %s', response.status_code)
+            return ProviderResponse(json.loads(response.content), raw=response.content)
+        except (ValueError, RequestException) as e:
+            log.warning('Apple receipt check failed on HTTP request: %s', e)
+            raise ProviderUnavailable('App Store request failed: %s', e)
+
+    def validate(self, receipt: str, shared_secret: str = None, exclude_old_transactions: bool = False,
+                 sandbox: Optional[bool] = None) -> dict:
+        """
+        Same as inapppy.AppStoreValidator.validate
+        :param sandbox: Environment to send receipt first, self.sandbox by default
+        """
+        sandbox = self.sandbox if sandbox is None else sandbox
+        receipt_json = self._prepare_receipt(receipt, shared_secret, exclude_old_transactions)
+        started = time.monotonic()
+        api_response = self.post_json(receipt_json, sandbox)
+        if self.auto_retry_wrong_env_request and api_response.get('status') in WRONG_ENVIRONMENT_STATUSES:
+            check_retry_deadline(time.monotonic() - started)
+            api_response = self.post_json(receipt_json, not sandbox)
+        return check_status(api_response)
+
 
 class Verifier(BaseVerifier):
-    """Apple verifier based on inapppy.AppStoreValidator"""
+    """Apple verifier based on inapppy.AppStoreValidator with pooled keep-alive connections"""
 
-    verifier_class = inapppy.AppStoreValidator
+    verifier_class = PooledAppStoreValidator
     provider = 'apple'
 
+    def __init__(self, config, transport: Optional[PooledTransport] = None,
+                 router: Optional[EnvironmentRouter] = None):
+        """
+        :param transport: Transport shared with other verifiers, created from config if not given
+        :param router: Router shared with other verifiers, created from config if not given
+        """
+        self.transport = transport
+        super(Verifier, self).__init__(config)
+        self.router = router or make_router(self.provider_config.extra)
+
+    def get_verifier_kwargs(self, config_dict: dict) -> dict:
+        if self.transport is None:
+            self.transport = make_transport(self.provider_config.extra)
+        return dict(config_dict, transport=self.transport)
+
     def verify(self, receipt: str) -> dict:
+        """Receipt is sent to learned environment first, if it is known"""
+        prescreen_receipt(self.provider_config, self.metrics, receipt)
+        keys = self.router.receipt_keys(receipt) if self.router is not None else []
+        sandbox = choose_sandbox(self.router, keys, self.provider_config.sandbox)
         try:
-            return self.verifier.validate(receipt=receipt,
-                                          shared_secret=self.provider_config.extra.shared_secret,
-                                          exclude_old_transactions=self.provider_config.extra.exclude_old_transactions)
+            response = self.verifier.validate(
+                receipt=receipt,
+                shared_secret=self.provider_config.extra.shared_secret,
+                exclude_old_transactions=self.provider_config.extra.exclude_old_transactions,
+                sandbox=sandbox)
+            learn_environment(self.router, keys, response)
+            count_environment_retry(self.metrics, sandbox, response)
+            return response
         except inapppy.errors.InAppPyValidationError as e:
             response_from_apple = e.raw_response
             log.warning(f'Apple receipt check failed: %s', response_from_apple)
@@ -33,44 +263,157 @@ class Verifier(BaseVerifier):
             raise VerificationFailed('Verification failed due to following reason: %s', e)
 
 
+class AsyncVerifier(AsyncBaseVerifier):
+    """
+    Apple verifier sending requests to App Store with aiohttp
+    One session is shared by all verifications, so a lot of them can be in flight at once
+    """
+
+    provider = 'apple'
+    production_url = PRODUCTION_URL
+    sandbox_url = SANDBOX_URL
+    # Total timeout of one request in seconds
+    http_timeout: float = 15
+    # Max number of simultaneously opened connections
+    connections_limit: int = 1000
+
+    def __init__(self, config, router: Optional[EnvironmentRouter] = None):
+        """
+        :param router: Router shared with other verifiers, created from config if not given
+        """
+        super(AsyncVerifier, self).__init__(config)
+        self.router = router or make_router(self.provider_config.extra)
+        self._session = None
+        register_after_fork(self)
+
+    def _after_fork(self):
+        # session of parent is bound to its event loop
+        self._session = None
+
+    def _get_session(self) -> 'aiohttp.ClientSession':
+        """Session is created on first request, because it should be bound to running event loop"""
+        # aiohttp is imported only by async verifiers, it makes cold start of sync ones much longer
+        import aiohttp
+        if self._session is None or self._session.closed:
+            extra = self.provider_config.extra
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.connections_limit),
+                timeout=aiohttp.ClientTimeout(total=self.http_timeout,
+                                              sock_connect=extra.connect_timeout,
+                                              sock_read=extra.read_timeout),
+            )
+        return self._session
+
+    def _prepare_request(self, receipt: str) -> dict:
+        extra = self.provider_config.extra
+        request_json = {'receipt-data': receipt}
+        if extra.shared_secret:
+            request_json['password'] = extra.shared_secret
+        if extra.exclude_old_transactions:
+            request_json['exclude-old-transactions'] = True
+        return request_json
+
+    async def _post_json(self, sandbox: bool, request_json: dict) -> dict:
+        import aiohttp
+        url = self.sandbox_url if sandbox else self.production_url
+        session = self._get_session()
+        try:
+            timeout = client_timeout(session.timeout, 'request to App Store')
+            async with session.post(url, json=request_json, timeout=timeout) as response:
+                retry_after = response.headers.get('Retry-After')
+                if is_throttled(response.status, retry_after):
+                    raise ProviderThrottled('App Store responded with status %s', response.status,
+                                            retry_after=retry_after_seconds(retry_after))
+                if response.status >= 500:
+                    raise ProviderUnavailable('App Store responded with status %s', response.status)
+                body = await response.read()
+            return ProviderResponse(json.loads(body), raw=body)
+        except (ValueError, aiohttp.ClientError, asyncio.TimeoutError) as e:
+            log.warning('Apple receipt check failed on HTTP request: %s', e)
+            raise ProviderUnavailable('App Store request failed: %s', e)
+
+    async def verify(self, receipt: str) -> dict:
+        """
+        Works like inapppy.AppStoreValidator.validate,
+        but environment to retry is chosen per call and not stored in verifier
+        Receipt is sent to learned environment first, if it is known
+        """
+        prescreen_receipt(self.provider_config, self.metrics, receipt)
+        request_json = self._prepare_request(receipt)
+        keys = self.router.receipt_keys(receipt) if self.router is not None else []
+        sandbox = choose_sandbox(self.router, keys, self.provider_config.sandbox)
+        started = time.monotonic()
+        response = await self._post_json(sandbox, request_json)
+        if self.provider_config.auto_retry_wrong_env_request and response.get('status') in WRONG_ENVIRONMENT_STATUSES:
+            check_retry_deadline(time.monotonic() - started)
+            response = await self._post_json(not sandbox, request_json)
+        try:
+            check_status(response)
+        except inapppy.InAppPyValidationError as e:
+            log.warning('Apple receipt check failed: %s', response)
+            raise VerificationFailed('Verification failed due to following reason: %s', e)
+        learn_environment(self.router, keys, response)
+        count_environment_retry(self.metrics, sandbox, response)
+        return response
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+
 class Parser(BaseParser):
-    """Apple receipt parser"""
+    """
+    Apple receipt parser
+    Response is read in one pass and is not changed, found values are kept in view over it
+    """
 
-    def parse(self, provider_response: dict) -> VerifiedSubscriptionInfo:
+    def prepare(self, provider_response: dict) -> Mapping:
         """Retrieve receipt with the most recent date from latest_receipt_info"""
-        # Most of main subscription info is in latest_receipt_info list
-        latest_receipts_info: list = provider_response['latest_receipt_info']
-        # first will be with max expires_date_ms value, so most fresh
-        latest_receipts_info.sort(key=lambda x: x['expires_date_ms'], reverse=True)
-        # So we need to add extra field detecting the most fresh subscription
-        provider_response['last_receipt'] = latest_receipts_info[0]
-        return super(Parser, self).parse(provider_response)
+        return ChainMap({'last_receipt': self.detect_last_receipt(provider_response)}, provider_response)
+
+    @parsing_exception('Apple', 'last receipt')
+    def detect_last_receipt(self, provider_response: Mapping) -> dict:
+        """Most of main subscription info is in latest_receipt_info, the freshest has max expires_date_ms"""
+        if 'last_receipt' in provider_response:
+            return provider_response['last_receipt']
+        return max(provider_response['latest_receipt_info'], key=_expires_date_ms)
+
+    @parsing_exception('Apple', 'renewal info')
+    def detect_renewal_index(self, provider_response: Mapping) -> Dict[str, dict]:
+        """Renewal info by product id, first one is taken if product is repeated"""
+        index = {}
+        for renewal_info in provider_response.get('pending_renewal_info') or ():
+            index.setdefault(renewal_info['product_id'], renewal_info)
+        return index
+
+    @parsing_exception('Apple', 'expiration date')
+    def detect_expiration_date(self, provider_response: Mapping) -> datetime:
+        return datetime.fromtimestamp(self.detect_expiration_timestamp(provider_response))
 
     @parsing_exception('Apple', 'expiration date')
-    def detect_expiration_date(self, provider_response: dict) -> datetime:
-        return datetime.fromtimestamp(
-            int(provider_response['last_receipt']['expires_date_ms']) / 1000
-        )
+    def detect_expiration_timestamp(self, provider_response: Mapping) -> float:
+        return _expires_date_ms(self.detect_last_receipt(provider_response)) / 1000
 
     @parsing_exception('Apple', 'product id')
-    def detect_product_id(self, provider_response: dict) -> str:
-        return provider_response['last_receipt']['product_id']
+    def detect_product_id(self, provider_response: Mapping) -> str:
+        return self.detect_last_receipt(provider_response)['product_id']
 
     @parsing_exception('Apple', 'renewable flag')
-    def detect_is_renewable(self, provider_response: dict) -> bool:
-        if ('pending_renewal_info' not in provider_response.keys()
-                or len(provider_response['pending_renewal_info']) == 0):
+    def detect_is_renewable(self, provider_response: Mapping) -> bool:
+        if not provider_response.get('pending_renewal_info'):
             log.warning(f'Failed to detect renewable status, setting to False')
             return False
-        auto_renew = [
-            x for x in
-            filter(lambda x: x['product_id'] == self.detect_product_id(provider_response),
-                   provider_response['pending_renewal_info'])
-        ]
-        if len(auto_renew) == 0:
+        renewal_info = self.detect_renewal_index(provider_response).get(self.detect_product_id(provider_response))
+        if renewal_info is None:
             return False
-        return auto_renew[0]['auto_renew_status'] == '1'
+        return renewal_info['auto_renew_status'] == '1'
 
     @parsing_exception('Apple', 'purchase token')
-    def detect_purchase_token(self, provider_response: dict) -> str:
-        return provider_response['last_receipt']['transaction_id']
+    def detect_purchase_token(self, provider_response: Mapping) -> str:
+        return self.detect_last_receipt(provider_response)['transaction_id']
+
+
+def _expires_date_ms(receipt_info: dict) -> int:
+    """Apple sends milliseconds as string"""
+    return int(receipt_info['expires_date_ms'])
@@ -2,29 +2,198 @@
 Implementation of Verifier and Parser for Google Play subscriptions
 """
 
+import asyncio
+import base64
+import binascii
 import json
 import logging
 from datetime import datetime
+from typing import TYPE_CHECKING, Any, Callable, Dict, Hashable, Optional, Tuple, Union
+from urllib.parse import quote
 
+import httplib2
 import inapppy
+from googleapiclient.errors import HttpError
 
-from subinapp.interface.api import BaseVerifier, BaseParser
-from subinapp.interface.exceptions import VerificationFailed
+from subinapp.core.deadlines import current_deadline, client_timeout
+from subinapp.core.forking import register_after_fork
+from subinapp.core.scheduling import is_throttled, retry_after_seconds
+from subinapp.core.tokens import GoogleTokenManager, FileTokenCache
+from subinapp.interface.api import BaseVerifier, BaseParser, AsyncBaseVerifier
+from subinapp.interface.entities import ProviderResponse, GoogleVerifierConfig, GoogleExtraArgs, ProviderNotification
+from subinapp.interface.exceptions import VerificationFailed, ProviderThrottled, ProviderUnavailable
 from subinapp.interface.utils import parsing_exception
 
+if TYPE_CHECKING:
+    import aiohttp
+
 log = logging.getLogger(__name__)
 
+# notificationType of subscriptionNotification
+NOTIFICATION_TYPES = {
+    1: 'SUBSCRIPTION_RECOVERED',
+    2: 'SUBSCRIPTION_RENEWED',
+    3: 'SUBSCRIPTION_CANCELED',
+    4: 'SUBSCRIPTION_PURCHASED',
+    5: 'SUBSCRIPTION_ON_HOLD',
+    6: 'SUBSCRIPTION_IN_GRACE_PERIOD',
+    7: 'SUBSCRIPTION_RESTARTED',
+    8: 'SUBSCRIPTION_PRICE_CHANGE_CONFIRMED',
+    9: 'SUBSCRIPTION_DEFERRED',
+    10: 'SUBSCRIPTION_PAUSED',
+    11: 'SUBSCRIPTION_PAUSE_SCHEDULE_CHANGED',
+    12: 'SUBSCRIPTION_REVOKED',
+    13: 'SUBSCRIPTION_EXPIRED',
+    20: 'SUBSCRIPTION_PENDING_PURCHASE_CANCELED',
+}
+# Notifications not about subscriptions
+OTHER_NOTIFICATIONS = (
+    ('testNotification', 'TEST_NOTIFICATION'),
+    ('oneTimeProductNotification', 'ONE_TIME_PRODUCT'),
+    ('voidedPurchaseNotification', 'VOIDED_PURCHASE'),
+)
+
+
+def decode_receipt(receipt: str) -> Tuple[str, str]:
+    """
+    Gets purchase token and product sku from receipt
+    :raises VerificationFailed: Receipt is not json with purchaseToken and productId
+    """
+    try:
+        decoded_receipt = json.loads(receipt)
+        return decoded_receipt['purchaseToken'], decoded_receipt['productId']
+    except (ValueError, TypeError, KeyError) as e:
+        log.warning('Malformed Google receipt: %s', e)
+        raise VerificationFailed('Verification failed due to following reason: %s', e)
+
+
+def decode_notification(message: Union[bytes, str, dict], provider_config: GoogleVerifierConfig) -> ProviderNotification:
+    """
+    Decodes Real-time developer notification from body of Pub/Sub push request or pulled message
+    It doesn't contain data of subscription, so purchase token is verified with Google Play
+    :raises VerificationFailed: Message is malformed or it is for another package
+    """
+    try:
+        data = json.loads(message) if isinstance(message, (bytes, str)) else message
+        message = data.get('message', data)
+        message_id = message.get('messageId') or message['message_id']
+        notification = json.loads(base64.b64decode(message['data']))
+        package_name = notification['packageName']
+        subscription = notification.get('subscriptionNotification')
+        if subscription:
+            notification_type = NOTIFICATION_TYPES.get(subscription.get('notificationType'), 'SUBSCRIPTION_UNKNOWN')
+            receipt = json.dumps({'purchaseToken': subscription['purchaseToken'],
+                                  'productId': subscription['subscriptionId']})
+    except (ValueError, TypeError, KeyError, AttributeError, binascii.Error) as e:
+        log.warning('Malformed Google notification: %s', e)
+        raise VerificationFailed('Malformed Google notification: %s', e)
+    if package_name != provider_config.bundle_id:
+        raise VerificationFailed('Notification is for another package %s', package_name)
+    if subscription:
+        return ProviderNotification('google', message_id, notification_type, receipt=receipt)
+    for key, notification_type in OTHER_NOTIFICATIONS:
+        if key in notification:
+            return ProviderNotification('google', message_id, notification_type)
+    raise VerificationFailed('Unknown type of Google notification')
+
+
+def make_token_manager(provider_config: GoogleVerifierConfig) -> GoogleTokenManager:
+    """
+    Token manager configured with extra arguments of provider
+    Token refreshing is started by warm() or first verification, not by configuration
+    """
+    extra = provider_config.extra or GoogleExtraArgs()
+    cache = FileTokenCache(extra.token_cache_path) if extra.token_cache_path else None
+    return GoogleTokenManager(provider_config.private_key_path,
+                              cache=cache,
+                              refresh_margin=extra.token_refresh_margin,
+                              start_on_first_use=True)
+
+
+def shared_resources(provider_config: GoogleVerifierConfig) -> Dict[str, Tuple[Hashable, Callable[[], Any]]]:
+    """
+    Arguments of verifiers that can be shared by applications, e.g. by subinapp.core.tenants
+    Applications published by one account share token manager of its service account
+    """
+    extra = provider_config.extra or GoogleExtraArgs()
+    return {
+        'token_manager': (('google', 'token_manager', provider_config.private_key_path, extra.token_cache_path,
+                           extra.token_refresh_margin), lambda: make_token_manager(provider_config)),
+    }
+
+
+def _set_timeout(conn, timeout: Optional[float]):
+    """Timeout of opened httplib2 connection and of its socket"""
+    conn.timeout = timeout
+    if conn.sock is not None:
+        conn.sock.settimeout(timeout)
+
+
+class TokenAuthorizedHttp(httplib2.Http):
+    """Adds access token from token manager to requests, token is refreshed once if it was rejected"""
+
+    def __init__(self, token_manager: GoogleTokenManager, **kwargs):
+        super(TokenAuthorizedHttp, self).__init__(**kwargs)
+        self.token_manager = token_manager
+
+    def _conn_request(self, conn, request_uri, method, body, headers):
+        """Socket timeout is cut to time left before deadline of current verification"""
+        deadline = current_deadline()
+        if deadline is None:
+            return super(TokenAuthorizedHttp, self)._conn_request(conn, request_uri, method, body, headers)
+        _set_timeout(conn, deadline.cap(self.timeout, 'request to Google Play'))
+        try:
+            return super(TokenAuthorizedHttp, self)._conn_request(conn, request_uri, method, body, headers)
+        finally:
+            # connection is kept open for next requests
+            _set_timeout(conn, self.timeout)
+
+    def request(self, uri, method='GET', body=None, headers=None, *args, **kwargs):
+        headers = dict(headers or {})
+        headers['Authorization'] = 'Bearer {}'.format(self.token_manager.get_token())
+        response, content = super(TokenAuthorizedHttp, self).request(uri, method, body, headers, *args, **kwargs)
+        if response.status == 401:
+            headers['Authorization'] = 'Bearer {}'.format(self.token_manager.refresh(force=True).value)
+            response, content = super(TokenAuthorizedHttp, self).request(uri, method, body, headers, *args, **kwargs)
+        return response, content
+
+
+class TokenGooglePlayVerifier(inapppy.GooglePlayVerifier):
+    """inapppy.GooglePlayVerifier authorized with token from GoogleTokenManager instead of own credentials"""
+
+    def __init__(self, bundle_id: str, private_key_path: str, http_timeout: int = 15,
+                 token_manager: Optional[GoogleTokenManager] = None):
+        self.token_manager = token_manager or GoogleTokenManager(private_key_path)
+        super(TokenGooglePlayVerifier, self).__init__(bundle_id, private_key_path, http_timeout)
+
+    def _authorize(self):
+        return TokenAuthorizedHttp(self.token_manager, timeout=self.http_timeout)
+
 
 class Verifier(BaseVerifier):
     """Google verifier based on inapppy.GooglePlayVerifier"""
 
-    verifier_class = inapppy.GooglePlayVerifier
+    verifier_class = TokenGooglePlayVerifier
     provider = 'google'
 
+    def __init__(self, config, token_manager: Optional[GoogleTokenManager] = None):
+        """
+        :param token_manager: Token manager shared with other verifiers, created from config if not given
+        """
+        self.token_manager = token_manager
+        super(Verifier, self).__init__(config)
+
+    def get_verifier_kwargs(self, config_dict: dict) -> dict:
+        if self.token_manager is None:
+            self.token_manager = make_token_manager(self.provider_config)
+        return dict(config_dict, token_manager=self.token_manager)
+
+    def warm(self):
+        """Requests access token"""
+        self.token_manager.get_token()
+
     def verify(self, receipt: str) -> dict:
-        decoded_receipt = json.loads(receipt)
-        purchase_token = decoded_receipt['purchaseToken']
-        product_sku = decoded_receipt['productId']
+        purchase_token, product_sku = decode_receipt(receipt)
         try:
             result = self.verifier.verify_with_result(
                 purchase_token,
@@ -37,6 +206,103 @@ class Verifier(BaseVerifier):
             log.warning('Purchase validation failed: %s', e)
             log.exception(e)
             raise VerificationFailed('Verification failed due to following reason: %s', e)
+        except HttpError as e:
+            retry_after = e.resp.get('retry-after')
+            if is_throttled(e.resp.status, retry_after):
+                raise ProviderThrottled('Google Play responded with status %s', e.resp.status,
+                                        retry_after=retry_after_seconds(retry_after))
+            if e.resp.status >= 500:
+                raise ProviderUnavailable('Google Play responded with status %s', e.resp.status)
+            # e.g. 404 of unknown product or 410 of purchase token expired long ago, provider is healthy
+            log.warning('Purchase validation failed with status %s: %s', e.resp.status, e)
+            raise VerificationFailed('Verification failed due to following reason: %s', e)
+        except (OSError, httplib2.HttpLib2Error) as e:
+            log.warning('Purchase validation failed on HTTP request: %s', e)
+            raise ProviderUnavailable('Google Play request failed: %s', e)
+
+
+class AsyncVerifier(AsyncBaseVerifier):
+    """
+    Google verifier sending requests to Google Play Developer API with aiohttp
+    Access token is taken from GoogleTokenManager, which refreshes it in background
+    """
+
+    provider = 'google'
+    api_url = ('https://androidpublisher.googleapis.com/androidpublisher/v3/applications/'
+               '{package_name}/purchases/subscriptions/{subscription_id}/tokens/{token}')
+    # Total timeout of one request in seconds
+    http_timeout: float = 15
+    # Max number of simultaneously opened connections
+    connections_limit: int = 1000
+
+    def __init__(self, config, token_manager: Optional[GoogleTokenManager] = None):
+        """
+        :param token_manager: Token manager shared with other verifiers, created from config if not given
+        """
+        super(AsyncVerifier, self).__init__(config)
+        self.token_manager = token_manager or make_token_manager(self.provider_config)
+        self._session = None
+        register_after_fork(self)
+
+    def _after_fork(self):
+        # session of parent is bound to its event loop
+        self._session = None
+
+    def _get_session(self) -> 'aiohttp.ClientSession':
+        """Session is created on first request, because it should be bound to running event loop"""
+        # aiohttp is imported only by async verifiers, it makes cold start of sync ones much longer
+        import aiohttp
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.connections_limit),
+                timeout=aiohttp.ClientTimeout(total=self.http_timeout),
+            )
+        return self._session
+
+    def warm(self):
+        """Requests access token"""
+        self.token_manager.get_token()
+
+    async def _get_access_token(self) -> str:
+        """Waits for token exchange in executor only if there is no valid token"""
+        token = self.token_manager.valid_token()
+        if token is None:
+            token = await asyncio.get_running_loop().run_in_executor(None, self.token_manager.get_token)
+        return token
+
+    async def verify(self, receipt: str) -> dict:
+        """Same as Verifier.verify, so result contains data even for expired and canceled subscriptions"""
+        import aiohttp
+        purchase_token, product_sku = decode_receipt(receipt)
+        url = self.api_url.format(package_name=quote(self.provider_config.bundle_id, safe=''),
+                                  subscription_id=quote(product_sku, safe=''),
+                                  token=quote(purchase_token, safe=''))
+        headers = {'Authorization': 'Bearer {}'.format(await self._get_access_token())}
+        session = self._get_session()
+        try:
+            timeout = client_timeout(session.timeout, 'request to Google Play')
+            async with session.get(url, headers=headers, timeout=timeout) as response:
+                retry_after = response.headers.get('Retry-After')
+                if is_throttled(response.status, retry_after):
+                    raise ProviderThrottled('Google Play responded with status %s', response.status,
+                                            retry_after=retry_after_seconds(retry_after))
+                body = await response.read()
+                status = response.status
+            result = ProviderResponse(json.loads(body), raw=body)
+        except (ValueError, aiohttp.ClientError, asyncio.TimeoutError) as e:
+            log.warning('Purchase validation failed on HTTP request: %s', e)
+            raise ProviderUnavailable('Google Play request failed: %s', e)
+        if status >= 500:
+            raise ProviderUnavailable('Google Play responded with status %s', status)
+        if status != 200:
+            log.warning('Purchase validation failed with status %s: %s', status, result)
+            raise VerificationFailed('Verification failed due to following reason: %s', result)
+        return result
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
 
 
 class Parser(BaseParser):
@@ -44,7 +310,11 @@ class Parser(BaseParser):
 
     @parsing_exception('Google','expiration date')
     def detect_expiration_date(self, provider_response: dict) -> datetime:
-        return datetime.fromtimestamp(int(provider_response['expiryTimeMillis'] / 1000))
+        return datetime.fromtimestamp(self.detect_expiration_timestamp(provider_response))
+
+    @parsing_exception('Google', 'expiration date')
+    def detect_expiration_timestamp(self, provider_response: dict) -> float:
+        return int(provider_response['expiryTimeMillis'] / 1000)
 
     @parsing_exception('Google','product id')
     def detect_product_id(self, provider_response: dict) -> str:
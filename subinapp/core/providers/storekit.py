@@ -0,0 +1,324 @@
+"""
+Implementation of Verifier and Parser for StoreKit 2 signed transactions
+Transactions are JWS signed by App Store, they are verified locally with trusted root certificates
+without requests to App Store, so verification takes CPU time of one signature check
+"""
+
+import base64
+import binascii
+import dataclasses
+import json
+import logging
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+from functools import lru_cache
+from typing import Dict, Iterable, List, Optional, Tuple, Union
+
+from cryptography import x509
+from cryptography.exceptions import InvalidSignature, UnsupportedAlgorithm
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.asymmetric import ec
+from cryptography.hazmat.primitives.asymmetric.utils import encode_dss_signature
+
+from subinapp.core.forking import register_after_fork
+from subinapp.interface.api import BaseVerifier, BaseParser, AsyncBaseVerifier
+from subinapp.interface.entities import StoreKitVerifierConfig, ProviderNotification
+from subinapp.interface.exceptions import VerificationFailed, ConfigurationIsMissing
+from subinapp.interface.utils import parsing_exception
+
+log = logging.getLogger(__name__)
+
+# Extensions of App Store signing certificates
+APPLE_LEAF_OID = x509.ObjectIdentifier('1.2.840.113635.100.6.11.1')
+APPLE_INTERMEDIATE_OID = x509.ObjectIdentifier('1.2.840.113635.100.6.2.1')
+
+PRODUCTION = 'Production'
+SANDBOX = 'Sandbox'
+
+# Public key of leaf certificate and unix times when all certificates of chain are valid
+_TrustedChain = Tuple[ec.EllipticCurvePublicKey, float, float]
+
+
+def load_certificate(path: str) -> x509.Certificate:
+    with open(path, 'rb') as f:
+        data = f.read()
+    if b'-----BEGIN' in data:
+        return x509.load_pem_x509_certificate(data)
+    return x509.load_der_x509_certificate(data)
+
+
+def _b64url_decode(part: str) -> bytes:
+    return base64.urlsafe_b64decode(part + '=' * (-len(part) % 4))
+
+
+class SignedDataVerifier:
+    """
+    Verifies JWS signed by App Store
+    Certificate chain from JWS header is checked once and cached by its certificates,
+        next JWS signed by the same certificate are checked only by their signature
+    Revocation of certificates isn't checked, as it needs requests to Apple
+    """
+
+    def __init__(self, bundle_id: str, root_certificates: Iterable[str], allow_sandbox: bool = True,
+                 require_apple_extensions: bool = True, chain_cache_size: int = 100):
+        """
+        :param bundle_id: Bundle ID of mobile application
+        :param root_certificates: Paths to trusted root certificates
+        :param allow_sandbox: Accept transactions made in Sandbox environment
+        :param require_apple_extensions: Certificates must have extensions of App Store signing certificates
+        :param chain_cache_size: Max number of verified certificate chains
+        """
+        self.bundle_id = bundle_id
+        self.allow_sandbox = allow_sandbox
+        self.require_apple_extensions = require_apple_extensions
+        self.chain_cache_size = chain_cache_size
+        roots = [load_certificate(path) for path in root_certificates]
+        if not roots:
+            raise ConfigurationIsMissing('No trusted root certificates for StoreKit transactions')
+        self._roots: Dict[bytes, x509.Certificate] = {root.fingerprint(hashes.SHA256()): root for root in roots}
+        # (leaf, intermediate) from x5c header -> verified chain
+        self._chains: 'OrderedDict[Tuple[str, str], _TrustedChain]' = OrderedDict()
+        self._lock = threading.Lock()
+        self.chain_hits = 0
+        self.chain_misses = 0
+        register_after_fork(self)
+
+    def _after_fork(self):
+        self._lock = threading.Lock()
+
+    def decode(self, jws: str) -> dict:
+        """
+        Returns payload of JWS if its signature and certificate chain are valid
+        :raises VerificationFailed: JWS is malformed or isn't signed by trusted certificate
+        """
+        try:
+            header_part, payload_part, signature_part = jws.split('.')
+            header = json.loads(_b64url_decode(header_part))
+            payload = json.loads(_b64url_decode(payload_part))
+            signature = _b64url_decode(signature_part)
+            algorithm, x5c = header.get('alg'), header.get('x5c')
+            signed_at = payload.get('signedDate', time.time() * 1000) / 1000
+        except (ValueError, TypeError, AttributeError, binascii.Error) as e:
+            raise VerificationFailed('Malformed JWS: %s', e)
+        if algorithm != 'ES256' or len(signature) != 64:
+            raise VerificationFailed('Unsupported algorithm of JWS: %s', algorithm)
+        public_key = self._leaf_key(x5c, signed_at)
+        # JWS signature is r and s of ECDSA signature, cryptography takes it in DER
+        der_signature = encode_dss_signature(int.from_bytes(signature[:32], 'big'),
+                                             int.from_bytes(signature[32:], 'big'))
+        try:
+            public_key.verify(der_signature, '{}.{}'.format(header_part, payload_part).encode('ascii'),
+                              ec.ECDSA(hashes.SHA256()))
+        except InvalidSignature:
+            raise VerificationFailed('Signature of JWS is not valid')
+        return payload
+
+    def verify_transaction(self, signed_transaction: str) -> dict:
+        """
+        Decoded transaction of application
+        :raises VerificationFailed: Transaction isn't valid or it is transaction of other application or environment
+        """
+        transaction = self.decode(signed_transaction)
+        if transaction.get('bundleId') != self.bundle_id:
+            raise VerificationFailed('Transaction of %s is not for %s', transaction.get('bundleId'), self.bundle_id)
+        self._check_environment(transaction)
+        return transaction
+
+    def verify_renewal_info(self, signed_renewal_info: str, transaction: dict) -> dict:
+        """
+        Decoded renewal info of subscription of transaction
+        :raises VerificationFailed: Renewal info isn't valid or it is renewal info of other subscription
+        """
+        renewal_info = self.decode(signed_renewal_info)
+        if renewal_info.get('originalTransactionId') != transaction.get('originalTransactionId'):
+            raise VerificationFailed('Renewal info of %s is not for transaction of %s',
+                                     renewal_info.get('originalTransactionId'), transaction.get('originalTransactionId'))
+        self._check_environment(renewal_info)
+        return renewal_info
+
+    def _check_environment(self, payload: dict):
+        if payload.get('environment') == SANDBOX and not self.allow_sandbox:
+            raise VerificationFailed('Sandbox transactions are not allowed')
+
+    def _leaf_key(self, x5c: Optional[List[str]], signed_at: float) -> ec.EllipticCurvePublicKey:
+        if not isinstance(x5c, list) or len(x5c) != 3 or not all(isinstance(item, str) for item in x5c):
+            raise VerificationFailed('JWS has no chain of three certificates')
+        key = (x5c[0], x5c[1])
+        with self._lock:
+            chain = self._chains.get(key)
+            if chain is not None:
+                self._chains.move_to_end(key)
+                self.chain_hits += 1
+        if chain is None:
+            chain = self._verify_chain(x5c)
+            with self._lock:
+                self.chain_misses += 1
+                self._chains[key] = chain
+                while len(self._chains) > self.chain_cache_size:
+                    self._chains.popitem(last=False)
+        public_key, not_before, not_after = chain
+        if not not_before <= signed_at <= not_after:
+            raise VerificationFailed('Certificate chain of JWS is not valid at %s', signed_at)
+        return public_key
+
+    def _verify_chain(self, x5c: List[str]) -> _TrustedChain:
+        """
+        Checks that leaf is issued by intermediate and intermediate is issued by trusted root
+        Root from header has to be one of trusted roots
+        """
+        try:
+            leaf, intermediate, root = [x509.load_der_x509_certificate(base64.b64decode(item)) for item in x5c]
+        except (ValueError, binascii.Error) as e:
+            raise VerificationFailed('Malformed certificate in JWS: %s', e)
+        trusted_root = self._roots.get(root.fingerprint(hashes.SHA256()))
+        if trusted_root is None:
+            raise VerificationFailed('Root certificate of JWS is not trusted')
+        try:
+            intermediate.verify_directly_issued_by(trusted_root)
+            leaf.verify_directly_issued_by(intermediate)
+            if not intermediate.extensions.get_extension_for_class(x509.BasicConstraints).value.ca:
+                raise ValueError('intermediate certificate is not CA')
+            if self.require_apple_extensions:
+                intermediate.extensions.get_extension_for_oid(APPLE_INTERMEDIATE_OID)
+                leaf.extensions.get_extension_for_oid(APPLE_LEAF_OID)
+        except (ValueError, TypeError, InvalidSignature, UnsupportedAlgorithm, x509.ExtensionNotFound) as e:
+            raise VerificationFailed('Certificate chain of JWS is not trusted: %s', e)
+        public_key = leaf.public_key()
+        if not isinstance(public_key, ec.EllipticCurvePublicKey):
+            raise VerificationFailed('Key of JWS certificate is not EC key')
+        chain = (leaf, intermediate, trusted_root)
+        return (public_key,
+                max(certificate.not_valid_before_utc.timestamp() for certificate in chain),
+                min(certificate.not_valid_after_utc.timestamp() for certificate in chain))
+
+    def stats(self) -> Dict[str, int]:
+        return {'chain_hits_total': self.chain_hits, 'chain_misses_total': self.chain_misses,
+                'chains': len(self._chains)}
+
+
+def verify_signed(verifier: SignedDataVerifier, signed_transaction: str,
+                  signed_renewal_info: Optional[str] = None) -> dict:
+    """
+    :return: Decoded transaction and renewal info if it is given
+    :raises VerificationFailed: Transaction or renewal info isn't signed by App Store
+    """
+    transaction = verifier.verify_transaction(signed_transaction)
+    renewal_info = verifier.verify_renewal_info(signed_renewal_info, transaction) if signed_renewal_info else None
+    return {'transaction': transaction, 'renewal_info': renewal_info}
+
+
+def verify_signed_receipt(verifier: SignedDataVerifier, receipt: str) -> dict:
+    """
+    Receipt is signed transaction or json with signedTransactionInfo and signedRenewalInfo from App Store
+    :return: Decoded transaction and renewal info if it is given
+    :raises VerificationFailed: Receipt is malformed or isn't signed by App Store
+    """
+    if not receipt.lstrip().startswith('{'):
+        return verify_signed(verifier, receipt.strip())
+    try:
+        signed = json.loads(receipt)
+        signed_transaction = signed['signedTransactionInfo']
+        signed_renewal_info = signed.get('signedRenewalInfo')
+    except (ValueError, TypeError, KeyError) as e:
+        raise VerificationFailed('Malformed StoreKit receipt: %s', e)
+    return verify_signed(verifier, signed_transaction, signed_renewal_info)
+
+
+def _config_kwargs(provider_config: StoreKitVerifierConfig) -> dict:
+    return dict(dataclasses.asdict(provider_config), root_certificates=tuple(provider_config.root_certificates))
+
+
+@lru_cache(maxsize=16)
+def _notification_verifier(**kwargs) -> SignedDataVerifier:
+    """Verifier of notifications is created once for configuration, so certificates are loaded once"""
+    return SignedDataVerifier(**kwargs)
+
+
+def decode_notification(payload: Union[bytes, str, dict], provider_config: StoreKitVerifierConfig
+                        ) -> ProviderNotification:
+    """
+    Decodes App Store Server Notification (version 2) with signedPayload
+    Notification is verified locally, data of subscription is taken from signed transaction and renewal info
+    Type of notification is joined with its subtype, e.g. DID_CHANGE_RENEWAL_STATUS.AUTO_RENEW_DISABLED
+    :raises VerificationFailed: Notification is malformed or isn't signed by App Store
+    """
+    verifier = _notification_verifier(**_config_kwargs(provider_config))
+    try:
+        body = json.loads(payload) if isinstance(payload, (bytes, str)) else payload
+        signed_payload = body['signedPayload']
+    except (ValueError, TypeError, KeyError) as e:
+        raise VerificationFailed('Malformed App Store notification: %s', e)
+    notification = verifier.decode(signed_payload)
+    data = notification.get('data') or {}
+    if data.get('bundleId') != provider_config.bundle_id:
+        raise VerificationFailed('Notification of %s is not for %s', data.get('bundleId'), provider_config.bundle_id)
+    if not notification.get('notificationUUID'):
+        raise VerificationFailed('App Store notification has no notificationUUID')
+    notification_type = '.'.join(filter(None, (notification.get('notificationType'), notification.get('subtype'))))
+    provider_response = None
+    if data.get('signedTransactionInfo'):
+        provider_response = verify_signed(verifier, data['signedTransactionInfo'], data.get('signedRenewalInfo'))
+    return ProviderNotification('storekit', notification.get('notificationUUID'), notification_type,
+                                provider_response=provider_response)
+
+
+class Verifier(BaseVerifier):
+    """Verifier of StoreKit 2 signed transactions, no requests are sent"""
+
+    verifier_class = SignedDataVerifier
+    provider = 'storekit'
+
+    def get_verifier_kwargs(self, config_dict: dict) -> dict:
+        return dict(config_dict, root_certificates=tuple(config_dict['root_certificates']))
+
+    def verify(self, receipt: str) -> dict:
+        return verify_signed_receipt(self.verifier, receipt)
+
+
+class AsyncVerifier(AsyncBaseVerifier):
+    """
+    Same as Verifier, signature is checked in event loop,
+        because it takes less time than passing it to thread
+    """
+
+    provider = 'storekit'
+
+    def __init__(self, config):
+        super(AsyncVerifier, self).__init__(config)
+        self.verifier = SignedDataVerifier(**_config_kwargs(self.provider_config))
+
+    async def verify(self, receipt: str) -> dict:
+        return verify_signed_receipt(self.verifier, receipt)
+
+
+class Parser(BaseParser):
+    """
+    Parser of decoded StoreKit transaction and renewal info
+    Renewal status is known only if renewal info was given with transaction
+    """
+
+    @parsing_exception('StoreKit', 'expiration date')
+    def detect_expiration_date(self, provider_response: dict) -> datetime:
+        return datetime.fromtimestamp(self.detect_expiration_timestamp(provider_response))
+
+    @parsing_exception('StoreKit', 'expiration date')
+    def detect_expiration_timestamp(self, provider_response: dict) -> float:
+        return provider_response['transaction']['expiresDate'] / 1000
+
+    @parsing_exception('StoreKit', 'product id')
+    def detect_product_id(self, provider_response: dict) -> str:
+        return provider_response['transaction']['productId']
+
+    @parsing_exception('StoreKit', 'renewable flag')
+    def detect_is_renewable(self, provider_response: dict) -> bool:
+        renewal_info = provider_response.get('renewal_info')
+        if not renewal_info:
+            log.warning('No renewal info of StoreKit transaction, setting renewable status to False')
+            return False
+        return renewal_info['autoRenewStatus'] == 1
+
+    @parsing_exception('StoreKit', 'purchase token')
+    def detect_purchase_token(self, provider_response: dict) -> str:
+        return provider_response['transaction']['transactionId']
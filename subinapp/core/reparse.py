@@ -0,0 +1,182 @@
+"""
+Bulk re-parsing of archived provider responses (ProcessedReceipt.provider_response) into columns
+Batches are decoded and parsed in pool of processes by the same parsers as verified receipts,
+expiration dates are kept as POSIX timestamps in arrays instead of datetime object of each row
+
+Archive of tab separated provider and json response per line can be re-parsed from command line:
+    python -m subinapp.core.reparse responses.tsv --output columns.jsonl
+"""
+
+import argparse
+import json
+import logging
+import math
+import os
+from array import array
+from collections import deque
+from concurrent.futures import Executor, ProcessPoolExecutor
+from functools import lru_cache
+from importlib import import_module
+from itertools import islice
+from typing import Dict, Iterable, Iterator, Optional, Sequence, Tuple, Union
+
+from subinapp.interface.api import BaseParser
+from subinapp.interface.entities import ReparsedBatch
+
+log = logging.getLogger(__name__)
+
+# Pairs of provider name and archived response
+ArchivedResponse = Tuple[str, Union[bytes, str]]
+
+DEFAULT_BATCH_SIZE = 10000
+
+
+@lru_cache(maxsize=None)
+def _get_parser(provider: str) -> BaseParser:
+    """Parser of provider in current process, parsers don't need configuration"""
+    return import_module('subinapp.core.providers.{}'.format(provider)).Parser()
+
+
+def parse_batch(items: Sequence[ArchivedResponse], offset: int = 0) -> ReparsedBatch:
+    """
+    Decodes and parses batch of archived responses in current process
+    Rows that can't be decoded or parsed are kept in batch with error, so positions of rows match input
+    :param items: Pairs of provider and archived response
+    :param offset: Position of first item in whole input
+    """
+    provider_index: Dict[str, int] = {}
+    product_index: Dict[Optional[str], int] = {}
+    provider_codes = array('B')
+    product_codes = array('I')
+    purchase_tokens = []
+    expiration = array('d')
+    is_renewable = array('b')
+    errors = {}
+    for position, (provider, response) in enumerate(items):
+        provider_codes.append(provider_index.setdefault(provider, len(provider_index)))
+        try:
+            parser = _get_parser(provider)
+            view = parser.prepare(json.loads(response))
+            row = (parser.detect_product_id(view), parser.detect_purchase_token(view),
+                   float(parser.detect_expiration_timestamp(view)), bool(parser.detect_is_renewable(view)))
+        except (KeyboardInterrupt, SystemExit, GeneratorExit):
+            raise
+        except BaseException as e:
+            # exceptions from subinapp.interface.exceptions are not subclasses of Exception
+            errors[position] = '{}: {}'.format(type(e).__name__, e)
+            row = (None, None, math.nan, False)
+        product_codes.append(product_index.setdefault(row[0], len(product_index)))
+        purchase_tokens.append(row[1])
+        expiration.append(row[2])
+        is_renewable.append(row[3])
+    if errors:
+        log.warning('%s of %s archived responses from %s are not parsed', len(errors), len(provider_codes), offset)
+    return ReparsedBatch(offset=offset, providers=tuple(provider_index), provider_codes=provider_codes,
+                         products=tuple(product_index), product_codes=product_codes, purchase_tokens=purchase_tokens,
+                         expiration=expiration, is_renewable=is_renewable, errors=errors)
+
+
+def _batches(items: Iterable[ArchivedResponse], batch_size: int) -> Iterator[Tuple[int, list]]:
+    iterator = iter(items)
+    offset = 0
+    while True:
+        batch = list(islice(iterator, batch_size))
+        if not batch:
+            return
+        yield offset, batch
+        offset += len(batch)
+
+
+def reparse(items: Iterable[ArchivedResponse],
+            workers: Optional[int] = None,
+            batch_size: int = DEFAULT_BATCH_SIZE,
+            max_pending: Optional[int] = None,
+            executor: Optional[Executor] = None) -> Iterator[ReparsedBatch]:
+    """
+    Parses archived responses in pool of processes and yields batches of columns in order of input
+    Items are taken from iterable lazily, so not more than max_pending batches are kept in memory
+    :param items: Pairs of provider and archived response, e.g. rows read from database cursor
+    :param workers: Number of processes, by default number of CPUs, 0 parses in current process
+    :param batch_size: Number of responses in one batch sent to worker
+    :param max_pending: Max number of submitted, but not yielded batches, by default twice of workers
+    :param executor: Executor to use instead of own pool of processes, it isn't shut down
+    """
+    if workers == 0 and executor is None:
+        for offset, batch in _batches(items, batch_size):
+            yield parse_batch(batch, offset)
+        return
+
+    own_executor = executor is None
+    if own_executor:
+        executor = ProcessPoolExecutor(max_workers=workers)
+    max_pending = max_pending or 2 * (workers or os.cpu_count() or 1)
+    pending = deque()
+    try:
+        for offset, batch in _batches(items, batch_size):
+            pending.append(executor.submit(parse_batch, batch, offset))
+            while len(pending) >= max_pending:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+    finally:
+        for future in pending:
+            future.cancel()
+        if own_executor:
+            executor.shutdown(wait=True)
+
+
+def _read_archive(path: str) -> Iterator[ArchivedResponse]:
+    with open(path, 'rb') as archive:
+        for line in archive:
+            provider, _, response = line.rstrip(b'\n').partition(b'\t')
+            if response:
+                yield provider.decode('ascii'), response
+
+
+def _write_columns(batches: Iterator[ReparsedBatch], path: str) -> Tuple[int, int]:
+    """Writes each batch as json object of columns, or all of them to npz file of numpy"""
+    rows = failed = 0
+    if path.endswith('.npz'):
+        import numpy
+
+        columns = []
+        for batch in batches:
+            rows += len(batch)
+            failed += len(batch.errors)
+            columns.append(batch.to_numpy())
+        numpy.savez(path, **{name: numpy.concatenate([column[name] for column in columns])
+                             for name in (columns[0] if columns else ())})
+        return rows, failed
+    with open(path, 'w') as output:
+        for batch in batches:
+            rows += len(batch)
+            failed += len(batch.errors)
+            json.dump({
+                'offset': batch.offset,
+                'provider': [batch.providers[code] for code in batch.provider_codes],
+                'product_id': [batch.products[code] for code in batch.product_codes],
+                'purchase_token': batch.purchase_tokens,
+                'expiration': [None if math.isnan(value) else value for value in batch.expiration],
+                'is_renewable': [bool(value) for value in batch.is_renewable],
+                'errors': {str(position): error for position, error in batch.errors.items()},
+            }, output, separators=(',', ':'))
+            output.write('\n')
+    return rows, failed
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description='Re-parse archived provider responses into columns')
+    arg_parser.add_argument('archive', help='File of lines with provider and json response separated by tab')
+    arg_parser.add_argument('--output', required=True,
+                            help='json lines of column batches, or numpy arrays if file name ends with .npz')
+    arg_parser.add_argument('--workers', type=int, default=None)
+    arg_parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE)
+    args = arg_parser.parse_args()
+
+    batches = reparse(_read_archive(args.archive), workers=args.workers, batch_size=args.batch_size)
+    rows, failed = _write_columns(batches, args.output)
+    print('{} responses are re-parsed, {} failed'.format(rows, failed))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,396 @@
+"""
+Protection from slow and failing providers: hedging of slow requests and circuit breaker
+"""
+
+import asyncio
+import contextvars
+import logging
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, Future, wait, FIRST_COMPLETED
+from contextlib import contextmanager, ExitStack
+from typing import Any, Awaitable, Callable, ContextManager, Dict, Optional
+
+from subinapp.core.deadlines import Deadline, current_deadline
+from subinapp.core.forking import register_after_fork
+from subinapp.interface.api import BaseMetricsSink
+from subinapp.interface.entities import HedgePolicy, CircuitBreakerPolicy, ProcessedReceipt
+from subinapp.interface.exceptions import ProviderUnavailable, CircuitOpen, VerificationFailed, ParsingFailed, \
+    RateLimitExceeded
+
+log = logging.getLogger(__name__)
+
+# States of circuit breaker
+CLOSED = 'closed'
+HALF_OPEN = 'half_open'
+OPEN = 'open'
+# Values of states in metrics
+STATE_CODES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+# Events of metrics
+HEDGED = 'hedged'
+HEDGE_WON = 'hedge_won'
+SERVED_STALE = 'served_stale'
+BREAKER_REJECTED = 'breaker_rejected'
+
+# Min number of latencies to estimate percentile, max_delay is used before that
+MIN_LATENCIES = 20
+# Percentile is recalculated after this number of new latencies
+RECALCULATE_EVERY = 32
+# Max number of hedges that can be sent at once after long period without them
+MAX_HEDGE_BUDGET = 10
+
+
+# Errors of network that weren't wrapped into ProviderUnavailable by verifier
+TRANSPORT_ERRORS = (OSError, asyncio.TimeoutError)
+
+
+def is_provider_failure(error: BaseException) -> bool:
+    """
+    Failure of provider or network, not of receipt
+    Other unexpected errors, e.g. bugs of parsing, say nothing about health of provider
+    """
+    return isinstance(error, (ProviderUnavailable,) + TRANSPORT_ERRORS)
+
+
+class CircuitBreaker:
+    """
+    Stops requests to provider after consecutive failures, so they fail at once instead of waiting for timeouts
+    After open_seconds probe requests are sent, breaker is closed after first successful one
+    Keeps last successful results of receipts to serve them while provider is unavailable
+    """
+
+    # sink of metrics, set by controller
+    metrics: Optional[BaseMetricsSink] = None
+
+    def __init__(self, provider: str, policy: CircuitBreakerPolicy):
+        self.provider = provider
+        self.policy = policy
+        self.state = CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probes = 0
+        self._stale: 'OrderedDict[str, ProcessedReceipt]' = OrderedDict()
+        self._lock = threading.Lock()
+        # metrics
+        self.opened = 0
+        self.rejected = 0
+        self.served_stale = 0
+        register_after_fork(self)
+
+    def _after_fork(self):
+        self._lock = threading.Lock()
+        self._probes = 0
+
+    def _set_state(self, state: str):
+        if state == self.state:
+            return
+        log.warning('Circuit breaker of %s is %s', self.provider, state)
+        self.state = state
+        if state == OPEN:
+            self.opened += 1
+            self._opened_at = time.monotonic()
+        if self.metrics:
+            self.metrics.increment(self.provider, 'breaker_{}'.format(state))
+
+    def allow(self):
+        """
+        Checks that request can be sent
+        :raises CircuitOpen: Provider is failing
+        """
+        with self._lock:
+            if self.state == OPEN and time.monotonic() - self._opened_at >= self.policy.open_seconds:
+                self._set_state(HALF_OPEN)
+                self._probes = 0
+            if self.state == CLOSED:
+                return
+            if self.state == HALF_OPEN and self._probes < self.policy.half_open_requests:
+                self._probes += 1
+                return
+            self.rejected += 1
+        if self.metrics:
+            self.metrics.increment(self.provider, BREAKER_REJECTED)
+        raise CircuitOpen('Requests to %s are stopped after its failures', self.provider)
+
+    def on_success(self):
+        with self._lock:
+            self._failures = 0
+            self._probes = max(0, self._probes - 1)
+            self._set_state(CLOSED)
+
+    def on_failure(self):
+        with self._lock:
+            self._failures += 1
+            self._probes = max(0, self._probes - 1)
+            if self.state == HALF_OPEN or self._failures >= self.policy.failure_threshold:
+                self._set_state(OPEN)
+
+    def _release(self):
+        """Request ended without answer about health of provider, e.g. it was rate limited"""
+        with self._lock:
+            self._probes = max(0, self._probes - 1)
+
+    @contextmanager
+    def guard(self):
+        """
+        Checks that request can be sent and counts its result
+        Answers with bad status of receipt are successes, provider is healthy
+        :raises CircuitOpen: Provider is failing
+        """
+        self.allow()
+        try:
+            yield
+        except BaseException as e:
+            if is_provider_failure(e):
+                self.on_failure()
+            elif isinstance(e, (VerificationFailed, ParsingFailed)):
+                self.on_success()
+            else:
+                self._release()
+            raise
+        self.on_success()
+
+    def remember(self, key: str, result: ProcessedReceipt):
+        """Keeps successful result of receipt to serve it while provider is unavailable"""
+        if not self.policy.serve_stale:
+            return
+        with self._lock:
+            self._stale[key] = result
+            self._stale.move_to_end(key)
+            while len(self._stale) > self.policy.stale_size:
+                self._stale.popitem(last=False)
+
+    def stale(self, key: str) -> Optional[ProcessedReceipt]:
+        """Last successful result of receipt, None if it isn't known"""
+        with self._lock:
+            result = self._stale.get(key)
+            if result is not None:
+                self.served_stale += 1
+        if result is not None and self.metrics:
+            self.metrics.increment(self.provider, SERVED_STALE)
+        return result
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'state': self.state,
+            'state_code': STATE_CODES[self.state],
+            'consecutive_failures': self._failures,
+            'stale_results': len(self._stale),
+            'opened_total': self.opened,
+            'rejected_total': self.rejected,
+            'served_stale_total': self.served_stale,
+        }
+
+
+# Makes context of hedge that charges it to rate limit and circuit breaker of provider
+HedgeGuard = Callable[[], ContextManager]
+
+
+class Hedger:
+    """
+    Sends second request if first one isn't answered by percentile of recent latencies
+    Hedged requests of sync controllers are sent from pool of threads, so caller doesn't wait for slower one,
+    it is left to finish in its thread. Requests of async controllers are tasks, slower one is cancelled
+    Verification requests don't change anything at providers, so they are safe to repeat
+    Request isn't hedged if deadline of verification comes before hedge delay
+    Hedges are charged to rate limit and circuit breaker of provider, hedge isn't sent if they don't allow it
+    """
+
+    # sink of metrics, set by controller
+    metrics: Optional[BaseMetricsSink] = None
+
+    def __init__(self, provider: str, policy: HedgePolicy):
+        self.provider = provider
+        self.policy = policy
+        self._latencies = deque(maxlen=policy.window)
+        self._observed = 0
+        self._delay = policy.max_delay
+        self._budget = 1.0
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._lock = threading.Lock()
+        # metrics
+        self.requests = 0
+        self.hedged = 0
+        self.won = 0
+        register_after_fork(self)
+
+    def _after_fork(self):
+        # threads of pool aren't copied to child
+        self._lock = threading.Lock()
+        self._executor = None
+
+    def _get_executor(self) -> ThreadPoolExecutor:
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.policy.max_workers,
+                                                    thread_name_prefix='subinapp-hedge-{}'.format(self.provider))
+            return self._executor
+
+    def delay(self) -> float:
+        """Seconds to wait for answer before hedging"""
+        return self._delay
+
+    def observe(self, seconds: float):
+        """Latency of successful request"""
+        with self._lock:
+            self._latencies.append(seconds)
+            self._observed += 1
+            if len(self._latencies) >= MIN_LATENCIES and self._observed % RECALCULATE_EVERY == 0:
+                latencies = sorted(self._latencies)
+                percentile = latencies[min(len(latencies) - 1, int(self.policy.percentile * len(latencies)))]
+                self._delay = min(self.policy.max_delay, max(self.policy.min_delay, percentile))
+
+    def _start_request(self):
+        with self._lock:
+            self.requests += 1
+            self._budget = min(MAX_HEDGE_BUDGET, self._budget + self.policy.max_ratio)
+
+    def _admit_hedge(self, guard: Optional[HedgeGuard]) -> Optional[ExitStack]:
+        """
+        Takes hedge from budget of max_ratio and enters its guard
+        :return: Context of hedge request, None if hedge isn't allowed
+        """
+        with self._lock:
+            if self._budget < 1:
+                return None
+            self._budget -= 1
+        stack = ExitStack()
+        if guard is not None:
+            try:
+                stack.enter_context(guard())
+            except (CircuitOpen, RateLimitExceeded) as e:
+                log.debug('Hedge of request to %s is not sent: %s', self.provider, e)
+                with self._lock:
+                    self._budget += 1
+                return None
+        with self._lock:
+            self.hedged += 1
+        if self.metrics:
+            self.metrics.increment(self.provider, HEDGED)
+        return stack
+
+    def _count_won(self):
+        with self._lock:
+            self.won += 1
+        if self.metrics:
+            self.metrics.increment(self.provider, HEDGE_WON)
+
+    def _timed(self, function: Callable, *args) -> Any:
+        started = time.monotonic()
+        result = function(*args)
+        self.observe(time.monotonic() - started)
+        return result
+
+    def _guarded(self, stack: ExitStack, function: Callable, *args) -> Any:
+        with stack:
+            return self._timed(function, *args)
+
+    def _should_hedge(self, deadline: Optional[Deadline]) -> bool:
+        return deadline is None or deadline.remaining() > self.delay()
+
+    def _submit(self, executor: ThreadPoolExecutor, stack: ExitStack, function: Callable, *args) -> Future:
+        # deadline of verification is passed to thread of request
+        return executor.submit(contextvars.copy_context().run, self._guarded, stack, function, *args)
+
+    def _result(self, future: Future, deadline: Optional[Deadline]) -> Any:
+        """Result of request, it isn't waited after deadline, request is left to finish in its thread"""
+        if deadline is not None:
+            done, _ = wait([future], timeout=deadline.remaining())
+            if not done:
+                raise deadline.error('answer of {}'.format(self.provider))
+        return future.result()
+
+    def call(self, function: Callable[..., Any], *args, guard: Optional[HedgeGuard] = None) -> Any:
+        """
+        Calls function in thread and hedges it, if it is slow
+        Request isn't hedged if deadline comes before hedge delay, then it is sent from caller thread
+        Error of first request is raised only if hedge failed too
+        :param guard: Makes context of hedge, e.g. takes token of rate limit
+        :raises DeadlineExceeded: There is no answer before deadline of current verification
+        """
+        self._start_request()
+        deadline = current_deadline()
+        if not self._should_hedge(deadline):
+            return self._timed(function, *args)
+        executor = self._get_executor()
+        primary = self._submit(executor, ExitStack(), function, *args)
+        done, _ = wait([primary], timeout=self.delay())
+        stack = None if done else self._admit_hedge(guard)
+        if stack is None:
+            return self._result(primary, deadline)
+        hedge = self._submit(executor, stack, function, *args)
+        return self._first_success(primary, hedge, deadline)
+
+    def _first_success(self, primary: Future, hedge: Future, deadline: Optional[Deadline] = None) -> Any:
+        """
+        First successful answer, the slower request isn't waited, it is just ignored
+        Error about receipt is answer too, only failures of provider wait for the other request
+        """
+        pending = {primary, hedge}
+        while pending:
+            done, pending = wait(pending, timeout=deadline.remaining() if deadline is not None else None,
+                                 return_when=FIRST_COMPLETED)
+            if not done:
+                raise deadline.error('answer of {}'.format(self.provider))
+            for future in (primary, hedge):
+                if future not in done:
+                    continue
+                error = future.exception()
+                if error is None and future is hedge:
+                    self._count_won()
+                if error is None or not is_provider_failure(error):
+                    return future.result()
+        return primary.result()
+
+    async def _atimed(self, function: Callable[..., Awaitable], *args) -> Any:
+        started = time.monotonic()
+        result = await function(*args)
+        self.observe(time.monotonic() - started)
+        return result
+
+    async def _aguarded(self, stack: ExitStack, function: Callable[..., Awaitable], *args) -> Any:
+        with stack:
+            return await self._atimed(function, *args)
+
+    async def acall(self, function: Callable[..., Awaitable], *args, guard: Optional[HedgeGuard] = None) -> Any:
+        """
+        Awaits coroutine function and hedges it, if it is slow
+        Request that isn't needed anymore is cancelled
+        :param guard: Makes context of hedge, e.g. takes token of rate limit
+        """
+        self._start_request()
+        deadline = current_deadline()
+        primary = asyncio.ensure_future(self._atimed(function, *args))
+        tasks = [primary]
+        try:
+            if not self._should_hedge(deadline):
+                return await primary
+            done, _ = await asyncio.wait(tasks, timeout=self.delay())
+            stack = None if done else self._admit_hedge(guard)
+            if stack is None:
+                return await primary
+            hedge = asyncio.ensure_future(self._aguarded(stack, function, *args))
+            tasks.append(hedge)
+            pending = set(tasks)
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in tasks:
+                    if task in done and not task.cancelled() and task.exception() is None:
+                        if task is hedge:
+                            self._count_won()
+                        return task.result()
+            return primary.result()
+        finally:
+            for task in tasks:
+                if not task.done():
+                    task.cancel()
+
+    def stats(self) -> Dict[str, float]:
+        return {
+            'delay': self._delay,
+            'requests_total': self.requests,
+            'hedged_total': self.hedged,
+            'hedge_won_total': self.won,
+            'hedge_ratio': self.hedged / self.requests if self.requests else 0.0,
+        }
@@ -0,0 +1,260 @@
+"""
+Re-verification of stored subscriptions around their expiration, to catch renewals and lapses
+"""
+
+import dataclasses
+import heapq
+import json
+import logging
+import os
+import time
+from collections import deque
+from typing import Any, AsyncIterable, AsyncIterator, Deque, Dict, Iterable, Iterator, List, Optional, Tuple, \
+    Type, Union
+
+from subinapp.core import batch
+from subinapp.core.cache import receipt_cache_key
+from subinapp.core.controllers import SubscriptionsBasicController
+from subinapp.core.scheduling import BACKGROUND
+from subinapp.interface.api import BaseCheckpointStore
+from subinapp.interface.entities import StoredSubscription, ReverificationCheckpoint, ReverificationResult, \
+    BatchVerificationResult
+from subinapp.interface.exceptions import ProviderUnavailable
+
+log = logging.getLogger(__name__)
+
+# Subscriptions expiring in this number of seconds are re-verified
+DEFAULT_BEFORE_EXPIRATION = 24 * 3600
+# Subscriptions expired this number of seconds ago are re-verified, renewal may succeed after billing retry
+DEFAULT_AFTER_EXPIRATION = 3 * 24 * 3600
+
+# (expiration, provider, purchase_token), subscriptions are re-verified in this order
+_SortKey = Tuple[float, str, str]
+
+
+class InMemoryCheckpointStore(BaseCheckpointStore):
+    """Keeps checkpoint in memory of process, so sweep can be resumed only by the same process"""
+
+    def __init__(self):
+        self._checkpoint: Optional[ReverificationCheckpoint] = None
+
+    def load(self) -> Optional[ReverificationCheckpoint]:
+        return self._checkpoint
+
+    def save(self, checkpoint: ReverificationCheckpoint):
+        self._checkpoint = dataclasses.replace(checkpoint)
+
+    def clear(self):
+        self._checkpoint = None
+
+
+class FileCheckpointStore(BaseCheckpointStore):
+    """Keeps checkpoint in json file, file is replaced atomically"""
+
+    def __init__(self, path: str):
+        self.path = path
+
+    def load(self) -> Optional[ReverificationCheckpoint]:
+        try:
+            with open(self.path) as f:
+                return ReverificationCheckpoint(**json.load(f))
+        except (OSError, ValueError, TypeError):
+            return None
+
+    def save(self, checkpoint: ReverificationCheckpoint):
+        tmp_path = '{}.{}.tmp'.format(self.path, os.getpid())
+        with open(tmp_path, 'w') as f:
+            json.dump(dataclasses.asdict(checkpoint), f)
+        os.replace(tmp_path, self.path)
+
+    def clear(self):
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+
+def _sort_key(stored: StoredSubscription) -> _SortKey:
+    return (stored.subscription_info.expiration_date.timestamp(), stored.provider,
+            stored.subscription_info.purchase_token)
+
+
+def _checkpoint_key(checkpoint: ReverificationCheckpoint) -> _SortKey:
+    return checkpoint.expiration, checkpoint.provider, checkpoint.purchase_token
+
+
+class ReverificationScheduler:
+    """
+    Re-verifies stored subscriptions which expire soon or expired recently
+    Subscriptions are read from stream once, the ones in window are kept in heap ordered by expiration
+    and re-verified in that order with background priority, others are skipped.
+    Cached results of subscriptions are dropped before re-verification, last known results served
+    while provider is unavailable are counted as failures.
+    Progress is saved to checkpoint store, interrupted sweep is resumed from last re-verified subscription
+    with the same window, if it isn't older than before_expiration
+    """
+
+    def __init__(self, controller: Type[SubscriptionsBasicController],
+                 checkpoints: BaseCheckpointStore = None,
+                 before_expiration: float = DEFAULT_BEFORE_EXPIRATION,
+                 after_expiration: float = DEFAULT_AFTER_EXPIRATION,
+                 checkpoint_every: int = 100,
+                 concurrency: batch.Concurrency = batch.DEFAULT_CONCURRENCY):
+        """
+        :param controller: Configured controller, AsyncSubscriptionsController for asweep()
+        :param checkpoints: Store of progress, InMemoryCheckpointStore by default
+        :param before_expiration: Seconds before expiration when subscription is re-verified
+        :param after_expiration: Seconds after expiration when subscription is still re-verified
+        :param checkpoint_every: Number of re-verified subscriptions between saves of checkpoint
+        :param concurrency: Max number of simultaneous verifications with each provider
+        """
+        self.controller = controller
+        self.checkpoints = checkpoints if checkpoints is not None else InMemoryCheckpointStore()
+        self.before_expiration = before_expiration
+        self.after_expiration = after_expiration
+        self.checkpoint_every = checkpoint_every
+        self.concurrency = concurrency
+        # metrics of last sweep
+        self.scanned = 0
+        self.skipped = 0
+        self.resumed = 0
+        self.changed = 0
+
+    def sweep(self, subscriptions: Iterable[StoredSubscription],
+              now: float = None) -> Iterator[ReverificationResult]:
+        """
+        Yields results of re-verification of subscriptions in window, ordered by expiration
+        Verification starts when stream is read till the end
+        :param subscriptions: Stream of stored subscriptions in any order
+        :param now: Unix time of start of sweep, current time by default
+        """
+        checkpoint = self._start(now)
+        heap = []
+        for stored in subscriptions:
+            self._push(heap, stored, checkpoint)
+        due: Deque[StoredSubscription] = deque()
+        results = self.controller.verify_receipts(self._pop_due(heap, due), concurrency=self.concurrency,
+                                                  priority=BACKGROUND)
+        completed = False
+        try:
+            for result in results:
+                stored = due.popleft()
+                result = self._checked(result)
+                yield self._result(stored, result)
+                self._advance(checkpoint, stored, result)
+            completed = True
+        finally:
+            results.close()
+            self._finish(checkpoint, completed)
+
+    async def asweep(self, subscriptions: Union[Iterable[StoredSubscription], AsyncIterable[StoredSubscription]],
+                     now: float = None) -> AsyncIterator[ReverificationResult]:
+        """
+        Same as sweep, but verifications are awaited, controller should be AsyncSubscriptionsController
+        :param subscriptions: Stream or async stream of stored subscriptions in any order
+        :param now: Unix time of start of sweep, current time by default
+        """
+        checkpoint = self._start(now)
+        heap = []
+        if hasattr(subscriptions, '__aiter__'):
+            async for stored in subscriptions:
+                self._push(heap, stored, checkpoint)
+        else:
+            for stored in subscriptions:
+                self._push(heap, stored, checkpoint)
+        due: Deque[StoredSubscription] = deque()
+        results = self.controller.verify_receipts(self._pop_due(heap, due), concurrency=self.concurrency,
+                                                  priority=BACKGROUND)
+        completed = False
+        try:
+            async for result in results:
+                stored = due.popleft()
+                result = self._checked(result)
+                yield self._result(stored, result)
+                self._advance(checkpoint, stored, result)
+            completed = True
+        finally:
+            await results.aclose()
+            self._finish(checkpoint, completed)
+
+    def _start(self, now: Optional[float]) -> ReverificationCheckpoint:
+        """Resumes sweep from stored checkpoint or starts new one"""
+        now = time.time() if now is None else now
+        self.scanned = self.skipped = self.resumed = self.changed = 0
+        checkpoint = self.checkpoints.load()
+        if checkpoint is not None:
+            if now - checkpoint.started_at <= self.before_expiration:
+                log.info('Re-verification is resumed after %s subscriptions', checkpoint.verified + checkpoint.failed)
+                return checkpoint
+            log.info('Checkpoint of re-verification started at %s is outdated', checkpoint.started_at)
+        return ReverificationCheckpoint(started_at=now)
+
+    def _push(self, heap: List[Tuple[_SortKey, int, StoredSubscription]], stored: StoredSubscription,
+              checkpoint: ReverificationCheckpoint):
+        self.scanned += 1
+        key = _sort_key(stored)
+        if not checkpoint.started_at - self.after_expiration <= key[0] <= checkpoint.started_at + self.before_expiration:
+            self.skipped += 1
+        elif key <= _checkpoint_key(checkpoint):
+            self.resumed += 1
+        else:
+            # sequence number keeps duplicates comparable
+            heapq.heappush(heap, (key, self.scanned, stored))
+
+    def _pop_due(self, heap: List[Tuple[_SortKey, int, StoredSubscription]],
+                 due: Deque[StoredSubscription]) -> Iterator[Tuple[str, str]]:
+        """
+        Subscriptions are taken from heap as verifications are submitted
+        Cached result is what sweep checks, so it is dropped and receipt is verified with provider
+        """
+        while heap:
+            _, _, stored = heapq.heappop(heap)
+            due.append(stored)
+            if self.controller.cache is not None:
+                self.controller.cache.delete(receipt_cache_key(stored.provider, stored.receipt))
+            yield stored.provider, stored.receipt
+
+    @staticmethod
+    def _checked(result: BatchVerificationResult) -> BatchVerificationResult:
+        """Last known result served while provider is unavailable isn't re-verification"""
+        if result.processed_receipt is None or not result.processed_receipt.is_stale:
+            return result
+        error = ProviderUnavailable('%s is unavailable, only last known result of receipt is returned', result.provider)
+        return dataclasses.replace(result, processed_receipt=None, error=error)
+
+    def _result(self, stored: StoredSubscription, result: BatchVerificationResult) -> ReverificationResult:
+        reverification = ReverificationResult(stored=stored, processed_receipt=result.processed_receipt,
+                                              error=result.error)
+        if reverification.is_changed:
+            self.changed += 1
+        return reverification
+
+    def _advance(self, checkpoint: ReverificationCheckpoint, stored: StoredSubscription,
+                 result: BatchVerificationResult):
+        """
+        Moves checkpoint to subscription whose result was consumed
+        Results are yielded in order of subscriptions, so all subscriptions before it are re-verified too
+        """
+        if result.is_verified:
+            checkpoint.verified += 1
+        else:
+            checkpoint.failed += 1
+        checkpoint.expiration, checkpoint.provider, checkpoint.purchase_token = _sort_key(stored)
+        if (checkpoint.verified + checkpoint.failed) % self.checkpoint_every == 0:
+            self.checkpoints.save(checkpoint)
+
+    def _finish(self, checkpoint: ReverificationCheckpoint, completed: bool):
+        if completed:
+            self.checkpoints.clear()
+            log.info('Re-verification is completed: %s verified, %s failed, %s changed',
+                     checkpoint.verified, checkpoint.failed, self.changed)
+        else:
+            self.checkpoints.save(checkpoint)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'scanned_total': self.scanned,
+            'skipped_total': self.skipped,
+            'resumed_total': self.resumed,
+            'changed_total': self.changed,
+        }
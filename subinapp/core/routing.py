@@ -0,0 +1,98 @@
+"""
+Learned routing of Apple receipts between production and sandbox environments
+"""
+
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Callable, Iterable, List, Optional, Dict
+
+from subinapp.core.forking import register_after_fork
+
+PRODUCTION = 'production'
+SANDBOX = 'sandbox'
+
+# Keys of receipt known before request to Apple
+KeyExtractor = Callable[[str], Iterable[str]]
+
+
+def receipt_digest(receipt: str) -> str:
+    return hashlib.sha256(receipt.encode('utf-8')).hexdigest()
+
+
+def receipt_digest_keys(receipt: str) -> List[str]:
+    """Receipt itself is the only key, that is known without decoding"""
+    return ['receipt:{}'.format(receipt_digest(receipt))]
+
+
+def response_keys(provider_response: dict) -> List[str]:
+    """
+    Keys learned from verified response
+    Original transactions and version of application
+    """
+    keys = {'original_transaction:{}'.format(item['original_transaction_id'])
+            for item in provider_response.get('latest_receipt_info') or ()
+            if item.get('original_transaction_id')}
+    receipt = provider_response.get('receipt') or {}
+    if receipt.get('bundle_id') and receipt.get('application_version'):
+        keys.add('app_version:{}:{}'.format(receipt['bundle_id'], receipt['application_version']))
+    return sorted(keys)
+
+
+def response_environment(provider_response: dict) -> Optional[str]:
+    environment = (provider_response.get('environment') or '').lower()
+    if environment in (PRODUCTION, SANDBOX):
+        return environment
+    return None
+
+
+class EnvironmentRouter:
+    """
+    Remembers environment in which receipts were verified
+    Keys are kept in LRU order, least recently used are evicted when max_size is reached
+    """
+
+    def __init__(self, max_size: int = 100000, key_extractor: KeyExtractor = receipt_digest_keys):
+        """
+        :param max_size: Max number of remembered keys
+        :param key_extractor: Function returning keys of receipt before request to Apple
+        """
+        self.max_size = max_size
+        self.key_extractor = key_extractor
+        self._environments: 'OrderedDict[str, str]' = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        register_after_fork(self)
+
+    def _after_fork(self):
+        self._lock = threading.Lock()
+
+    def receipt_keys(self, receipt: str) -> List[str]:
+        try:
+            return list(self.key_extractor(receipt))
+        except Exception:
+            return []
+
+    def lookup(self, keys: Iterable[str]) -> Optional[str]:
+        """Environment of first known key"""
+        with self._lock:
+            for key in keys:
+                environment = self._environments.get(key)
+                if environment is not None:
+                    self._environments.move_to_end(key)
+                    self.hits += 1
+                    return environment
+            self.misses += 1
+        return None
+
+    def remember(self, keys: Iterable[str], environment: str):
+        with self._lock:
+            for key in keys:
+                self._environments[key] = environment
+                self._environments.move_to_end(key)
+            while len(self._environments) > self.max_size:
+                self._environments.popitem(last=False)
+
+    def stats(self) -> Dict[str, int]:
+        return {'hits_total': self.hits, 'misses_total': self.misses, 'keys': len(self._environments)}
@@ -0,0 +1,339 @@
+"""
+Pacing of requests to providers: token bucket rate limit with priorities and backoff on throttling
+"""
+
+import asyncio
+import heapq
+import itertools
+import threading
+import time
+from contextlib import contextmanager, asynccontextmanager
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from typing import Dict, List, Optional, Tuple
+
+from subinapp.core.deadlines import Deadline
+from subinapp.core.forking import register_after_fork
+from subinapp.interface.api import BaseMetricsSink
+from subinapp.interface.entities import RateLimit
+from subinapp.interface.exceptions import RateLimitExceeded, ProviderThrottled, DeadlineExceeded
+
+# Priorities of requests, requests with lower value are sent first
+INTERACTIVE = 0
+BACKGROUND = 1
+
+# HTTP statuses of responses to throttled requests, 503 without Retry-After is unavailability of provider
+TOO_MANY_REQUESTS = 429
+SERVICE_UNAVAILABLE = 503
+
+# Rate is multiplied by it when provider throttles requests
+RATE_DECREASE_FACTOR = 0.5
+# Part of configured rate restored after each successful request
+RATE_RECOVERY = 0.01
+# Pause after first throttled request if provider didn't send Retry-After, it's doubled on next ones
+INITIAL_BACKOFF = 1.0
+
+
+def is_throttled(status: int, retry_after: Optional[str]) -> bool:
+    """Request is rejected because too many requests were sent, not because provider is failing"""
+    return status == TOO_MANY_REQUESTS or (status == SERVICE_UNAVAILABLE and bool(retry_after))
+
+
+def retry_after_seconds(value: Optional[str]) -> Optional[float]:
+    """Seconds from Retry-After header, it is either number of seconds or HTTP date"""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+
+class _BaseScheduler:
+    """
+    State of token bucket and queue of requests waiting for turn
+    Request at head of queue takes token when it is available,
+    queue is ordered by priority and then by arrival
+    """
+
+    # sink of metrics, set by controller
+    metrics: Optional[BaseMetricsSink] = None
+
+    def __init__(self, provider: str, limit: RateLimit):
+        """
+        :param provider: Provider title, used in errors
+        :param limit: Limit of requests to provider
+        """
+        self.provider = provider
+        self.limit = limit
+        self.rate = limit.rate
+        self._tokens = float(limit.burst)
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._backoff = 0.0
+        # heap of (priority, sequence number) of waiting requests
+        self._waiting: List[Tuple[int, int]] = []
+        self._sequence = itertools.count()
+        self._lock = threading.Lock()
+        # metrics
+        self.admitted = 0
+        self.rejected = 0
+        self.throttled = 0
+
+    def _refill(self, now: float):
+        self._tokens = min(self.limit.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def _reject(self, reason: str) -> RateLimitExceeded:
+        self.rejected += 1
+        return RateLimitExceeded('Request to %s is rejected: %s', self.provider, reason)
+
+    def _reject_late(self, deadline: Deadline) -> DeadlineExceeded:
+        self.rejected += 1
+        return deadline.error('turn of request to {}'.format(self.provider))
+
+    def _enqueue(self, priority: int, now: float, deadline: Optional[Deadline] = None) -> Tuple[int, int]:
+        """
+        Adds request to queue
+        :raises RateLimitExceeded: Queue is full or request would wait longer than max_wait
+        :raises DeadlineExceeded: Request would wait for turn after deadline of verification
+        """
+        if len(self._waiting) >= self.limit.max_queue:
+            raise self._reject('queue is full')
+        ahead = sum(1 for waiting_priority, _ in self._waiting if waiting_priority <= priority)
+        self._refill(now)
+        expected_wait = max(0.0, self._paused_until - now) + max(0.0, ahead + 1 - self._tokens) / self.rate
+        if expected_wait > self.limit.max_wait:
+            raise self._reject('expected wait is too long')
+        if deadline is not None and expected_wait > deadline.remaining():
+            raise self._reject_late(deadline)
+        entry = (priority, next(self._sequence))
+        heapq.heappush(self._waiting, entry)
+        return entry
+
+    def _try_admit(self, entry: Tuple[int, int], wait_until: float, now: float,
+                   deadline: Optional[Deadline] = None) -> Optional[float]:
+        """
+        Admits request if it is at head of queue and token is available
+        :param wait_until: Time to stop waiting, end of max_wait or deadline of verification
+        :return: None if request is admitted, otherwise seconds to wait before next try
+        :raises RateLimitExceeded: Request has waited for max_wait
+        :raises DeadlineExceeded: Deadline of verification has come
+        """
+        delay = None
+        if self._waiting[0] == entry:
+            self._refill(now)
+            delay = max(0.0, self._paused_until - now)
+            if self._tokens < 1:
+                delay = max(delay, (1 - self._tokens) / self.rate)
+            if delay <= 0:
+                heapq.heappop(self._waiting)
+                self._tokens -= 1
+                self.admitted += 1
+                return None
+        if now >= wait_until:
+            if deadline is not None and deadline.expired:
+                raise self._reject_late(deadline)
+            raise self._reject('waited too long')
+        return wait_until - now if delay is None else min(delay, wait_until - now)
+
+    def _remove(self, entry: Tuple[int, int]):
+        if entry in self._waiting:
+            self._waiting.remove(entry)
+            heapq.heapify(self._waiting)
+
+    def on_throttled(self, retry_after: Optional[float] = None):
+        """
+        Slows down after provider throttled request
+        Rate is decreased and requests are paused for retry_after or exponential backoff
+        """
+        if self.metrics:
+            self.metrics.increment(self.provider, 'throttled')
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            self.throttled += 1
+            self.rate = max(self.limit.min_rate, self.rate * RATE_DECREASE_FACTOR)
+            self._backoff = min(self.limit.max_backoff, self._backoff * 2 or INITIAL_BACKOFF)
+            pause = self._backoff if retry_after is None else min(retry_after, self.limit.max_backoff)
+            self._paused_until = max(self._paused_until, now + pause)
+            # burst isn't allowed right after pause
+            self._tokens = min(self._tokens, 0.0)
+
+    def on_success(self):
+        """Restores rate gradually after throttling"""
+        if self.rate >= self.limit.rate and not self._backoff:
+            return
+        with self._lock:
+            self._backoff = 0.0
+            self.rate = min(self.limit.rate, self.rate + self.limit.rate * RATE_RECOVERY)
+
+    def try_acquire(self) -> bool:
+        """Takes token if it is available at once and nobody waits for turn, for requests that aren't worth waiting"""
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            if self._waiting or self._paused_until > now or self._tokens < 1:
+                return False
+            self._tokens -= 1
+            self.admitted += 1
+            return True
+
+    @contextmanager
+    def hedge_slot(self):
+        """
+        Takes token for hedge of slow request without waiting and adapts rate to its result
+        :raises RateLimitExceeded: There is no token for hedge right now
+        """
+        if not self.try_acquire():
+            raise RateLimitExceeded('Hedge of request to %s is not sent: no token', self.provider)
+        try:
+            yield
+        except ProviderThrottled as e:
+            self.on_throttled(e.retry_after)
+            raise
+        self.on_success()
+
+    def _wait_until(self, now: float, deadline: Optional[Deadline]) -> float:
+        wait_until = now + self.limit.max_wait
+        return wait_until if deadline is None else min(wait_until, deadline.expires_at)
+
+    def _observe_wait(self, started: float):
+        if self.metrics:
+            self.metrics.observe_duration(self.provider, 'queue', time.monotonic() - started)
+
+    def stats(self) -> Dict[str, float]:
+        return {
+            'rate': self.rate,
+            'waiting': len(self._waiting),
+            'paused_seconds': max(0.0, self._paused_until - time.monotonic()),
+            'admitted_total': self.admitted,
+            'rejected_total': self.rejected,
+            'throttled_total': self.throttled,
+        }
+
+
+class ProviderScheduler(_BaseScheduler):
+    """Scheduler of requests made from threads, waiting request blocks its thread"""
+
+    def __init__(self, provider: str, limit: RateLimit):
+        super(ProviderScheduler, self).__init__(provider, limit)
+        self._condition = threading.Condition(self._lock)
+        register_after_fork(self)
+
+    def _after_fork(self):
+        # waiting requests belong to threads of parent
+        self._waiting = []
+        self._lock = threading.Lock()
+        self._condition = threading.Condition(self._lock)
+
+    def acquire(self, priority: int = INTERACTIVE, deadline: Optional[Deadline] = None):
+        """
+        Waits for turn of request
+        :param deadline: Deadline of verification, request doesn't wait for turn after it
+        :raises RateLimitExceeded: Request is rejected
+        :raises DeadlineExceeded: Turn of request doesn't come before deadline
+        """
+        with self._condition:
+            now = time.monotonic()
+            entry = self._enqueue(priority, now, deadline)
+            wait_until = self._wait_until(now, deadline)
+            try:
+                while True:
+                    timeout = self._try_admit(entry, wait_until, time.monotonic(), deadline)
+                    if timeout is None:
+                        break
+                    self._condition.wait(timeout)
+            except BaseException:
+                self._remove(entry)
+                raise
+            finally:
+                # next request at head of queue recalculates its wait
+                self._condition.notify_all()
+
+    @contextmanager
+    def slot(self, priority: int = INTERACTIVE, deadline: Optional[Deadline] = None):
+        """
+        Waits for turn of request and adapts rate to result of request
+        :raises RateLimitExceeded: Request is rejected
+        :raises DeadlineExceeded: Turn of request doesn't come before deadline
+        """
+        started = time.monotonic()
+        self.acquire(priority, deadline)
+        self._observe_wait(started)
+        try:
+            yield
+        except ProviderThrottled as e:
+            self.on_throttled(e.retry_after)
+            raise
+        self.on_success()
+
+
+class AsyncProviderScheduler(_BaseScheduler):
+    """Scheduler of requests made from asyncio tasks, it should be used from one event loop"""
+
+    def __init__(self, provider: str, limit: RateLimit):
+        super(AsyncProviderScheduler, self).__init__(provider, limit)
+        self._events: Dict[Tuple[int, int], asyncio.Event] = {}
+        register_after_fork(self)
+
+    def _after_fork(self):
+        self._waiting = []
+        self._events = {}
+        self._lock = threading.Lock()
+
+    def _wake_head(self):
+        if self._waiting:
+            self._events[self._waiting[0]].set()
+
+    async def acquire(self, priority: int = INTERACTIVE, deadline: Optional[Deadline] = None):
+        """
+        Waits for turn of request without blocking event loop
+        :param deadline: Deadline of verification, request doesn't wait for turn after it
+        :raises RateLimitExceeded: Request is rejected
+        :raises DeadlineExceeded: Turn of request doesn't come before deadline
+        """
+        now = time.monotonic()
+        with self._lock:
+            entry = self._enqueue(priority, now, deadline)
+        event = self._events[entry] = asyncio.Event()
+        wait_until = self._wait_until(now, deadline)
+        try:
+            while True:
+                with self._lock:
+                    timeout = self._try_admit(entry, wait_until, time.monotonic(), deadline)
+                if timeout is None:
+                    break
+                event.clear()
+                try:
+                    await asyncio.wait_for(event.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+        except BaseException:
+            with self._lock:
+                self._remove(entry)
+            raise
+        finally:
+            del self._events[entry]
+            self._wake_head()
+
+    @asynccontextmanager
+    async def slot(self, priority: int = INTERACTIVE, deadline: Optional[Deadline] = None):
+        """
+        Waits for turn of request and adapts rate to result of request
+        :raises RateLimitExceeded: Request is rejected
+        :raises DeadlineExceeded: Turn of request doesn't come before deadline
+        """
+        started = time.monotonic()
+        await self.acquire(priority, deadline)
+        self._observe_wait(started)
+        try:
+            yield
+        except ProviderThrottled as e:
+            self.on_throttled(e.retry_after)
+            raise
+        self.on_success()
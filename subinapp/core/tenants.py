@@ -0,0 +1,258 @@
+"""
+Verification of receipts of many applications (tenants) in one process
+Each tenant has own controller with its configuration, verifiers of tenant are created on first use
+and are dropped with controller of least recently used tenant.
+Connection pools, token managers, parsers, rate limits, circuit breakers and metrics are shared by all tenants
+"""
+
+import dataclasses
+import inspect
+import logging
+import threading
+from collections import OrderedDict
+from importlib import import_module
+from types import ModuleType
+from typing import Any, Callable, Dict, Hashable, Iterable, Iterator, Mapping, Optional, Tuple, Type, Union
+
+from subinapp.core import batch
+from subinapp.core.controllers import SubscriptionsBasicController
+from subinapp.core.deadlines import DeadlineArg, to_deadline
+from subinapp.core.lazy import LazyProviders
+from subinapp.core.metrics import Metrics
+from subinapp.core.resilience import CircuitBreaker, Hedger
+from subinapp.core.scheduling import ProviderScheduler, INTERACTIVE, BACKGROUND
+from subinapp.interface.api import BaseParser, BaseReceiptCache, BaseMetricsSink, BaseVerifier
+from subinapp.interface.entities import SubscriptionManagerConfig, ProcessedReceipt, BatchVerificationResult, \
+    SerializationOptions, RateLimit, HedgePolicy, CircuitBreakerPolicy
+from subinapp.interface.exceptions import UndefinedTenant
+
+log = logging.getLogger(__name__)
+
+# Configuration of tenant by its id, None if tenant is unknown
+ConfigSource = Union[Mapping[str, SubscriptionManagerConfig], Callable[[str], Optional[SubscriptionManagerConfig]]]
+
+PROVIDERS = tuple(field.name for field in dataclasses.fields(SubscriptionManagerConfig))
+
+
+class SharedResources:
+    """
+    Objects passed to verifiers of all tenants, e.g. connection pool of App Store
+    Objects are created once for the same settings, provider modules describe them in shared_resources()
+    """
+
+    def __init__(self):
+        self._objects: Dict[Hashable, Any] = {}
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable, factory: Callable[[], Any]) -> Any:
+        with self._lock:
+            if key not in self._objects:
+                log.info('Creating shared %s', key[:2] if isinstance(key, tuple) else key)
+                self._objects[key] = factory()
+            return self._objects[key]
+
+    def verifier_kwargs(self, module: ModuleType, verifier_class: type, provider_config) -> Dict[str, Any]:
+        """Shared objects of provider that are accepted by constructor of verifier_class"""
+        describe = getattr(module, 'shared_resources', None)
+        if describe is None:
+            return {}
+        accepted = inspect.signature(verifier_class).parameters
+        return {name: self.get(key, factory)
+                for name, (key, factory) in describe(provider_config).items() if name in accepted}
+
+    def __len__(self) -> int:
+        return len(self._objects)
+
+    def close(self):
+        """Closes connection pools and stops token refreshing"""
+        with self._lock:
+            objects = list(self._objects.values())
+            self._objects.clear()
+        for obj in objects:
+            # transports are closed, token managers are stopped
+            for method in ('close', 'stop'):
+                if callable(getattr(obj, method, None)):
+                    getattr(obj, method)()
+
+
+class TenantCache(BaseReceiptCache):
+    """Keys of tenant in shared cache, so receipt verified for one application isn't returned to another"""
+
+    def __init__(self, cache: BaseReceiptCache, tenant: str):
+        self.cache = cache
+        self.prefix = '{}:'.format(tenant)
+
+    def get(self, key: str) -> Optional[ProcessedReceipt]:
+        return self.cache.get(self.prefix + key)
+
+    def set(self, key: str, value: ProcessedReceipt, ttl: float):
+        self.cache.set(self.prefix + key, value, ttl)
+
+    def delete(self, key: str):
+        self.cache.delete(self.prefix + key)
+
+
+class TenantController(SubscriptionsBasicController):
+    """Controller of one tenant, its verifiers get shared resources"""
+
+    tenant: Optional[str] = None
+    resources: Optional[SharedResources] = None
+
+    @classmethod
+    def _load_verifier(cls, provider: str) -> BaseVerifier:
+        module = import_module('subinapp.core.providers.{}'.format(provider))
+        verifier_class = getattr(module, cls.verifier_class_name)
+        kwargs = cls.resources.verifier_kwargs(module, verifier_class, getattr(cls.config, provider))
+        verifier = verifier_class(cls.config, **kwargs)
+        verifier.metrics = cls.metrics
+        return verifier
+
+    @classmethod
+    def _stale_key(cls, provider: str, receipt: str, cache_key: Optional[str]) -> str:
+        # circuit breakers are shared by tenants
+        return '{}:{}'.format(cls.tenant, super(TenantController, cls)._stale_key(provider, receipt, cache_key))
+
+
+class MultiTenantController:
+    """
+    Controller of many applications keyed by tenant id, e.g. bundle id
+    Controllers of not more than max_tenants recently used tenants are kept
+    """
+
+    tenant_controller_class: Type[TenantController] = TenantController
+
+    def __init__(self, configs: ConfigSource,
+                 max_tenants: int = 100,
+                 cache: Optional[BaseReceiptCache] = None,
+                 cache_ttl: float = 3600,
+                 serialization: Optional[SerializationOptions] = None,
+                 metrics_sinks: Iterable[BaseMetricsSink] = (),
+                 coalesce: bool = True,
+                 rate_limits: Optional[Dict[str, RateLimit]] = None,
+                 hedging: Optional[Dict[str, HedgePolicy]] = None,
+                 circuit_breakers: Optional[Dict[str, CircuitBreakerPolicy]] = None):
+        """
+        :param configs: Configurations of tenants by id or function returning configuration of tenant
+        :param max_tenants: Max number of tenants with created controllers
+        :param cache: Storage of verification results shared by tenants, keys of tenants are prefixed
+        :param cache_ttl: Max seconds to keep result in cache
+        :param serialization: Options of receipt and provider response serialization
+        :param metrics_sinks: Receivers of metrics of all tenants
+        :param coalesce: Concurrent verifications of the same receipt of tenant share one request to provider
+        :param rate_limits: Limits of requests by provider, shared by tenants
+        :param hedging: Policies of hedging slow requests by provider, latencies are shared by tenants
+        :param circuit_breakers: Policies of circuit breakers by provider, health of provider is shared by tenants
+        """
+        self.get_config = configs.get if isinstance(configs, Mapping) else configs
+        self.max_tenants = max_tenants
+        self.cache = cache
+        self.cache_ttl = cache_ttl
+        self.serialization = serialization or SerializationOptions()
+        self.coalesce = coalesce
+        self.metrics = Metrics(metrics_sinks)
+        self.resources = SharedResources()
+        self.parsers = LazyProviders(PROVIDERS, self._load_parser)
+        self.schedulers = {p: ProviderScheduler(p, limit) for p, limit in (rate_limits or {}).items()}
+        self.hedgers = {p: Hedger(p, policy) for p, policy in (hedging or {}).items()}
+        self.breakers = {p: CircuitBreaker(p, policy) for p, policy in (circuit_breakers or {}).items()}
+        for component in (*self.schedulers.values(), *self.hedgers.values(), *self.breakers.values()):
+            component.metrics = self.metrics
+        self._controllers: 'OrderedDict[str, Type[TenantController]]' = OrderedDict()
+        self._lock = threading.Lock()
+        self.created_total = 0
+        self.evicted_total = 0
+
+    def _load_parser(self, provider: str) -> BaseParser:
+        parser = import_module('subinapp.core.providers.{}'.format(provider)).Parser()
+        parser.metrics = self.metrics
+        return parser
+
+    def controller(self, tenant: str) -> Type[TenantController]:
+        """
+        Controller of tenant, it is created if tenant isn't used recently
+        :raises UndefinedTenant: There is no configuration of tenant
+        """
+        with self._lock:
+            controller = self._controllers.get(tenant)
+            if controller is not None:
+                self._controllers.move_to_end(tenant)
+                return controller
+        config = self.get_config(tenant)
+        if config is None:
+            raise UndefinedTenant('Tenant %s is not configured', tenant)
+        with self._lock:
+            # it could be created by other thread while config was loaded
+            if tenant not in self._controllers:
+                self._controllers[tenant] = self._create_controller(tenant, config)
+                self.created_total += 1
+                while len(self._controllers) > self.max_tenants:
+                    evicted, _ = self._controllers.popitem(last=False)
+                    self.evicted_total += 1
+                    log.info('Controller of tenant %s is evicted', evicted)
+            self._controllers.move_to_end(tenant)
+            return self._controllers[tenant]
+
+    def _create_controller(self, tenant: str, config: SubscriptionManagerConfig) -> Type[TenantController]:
+        controller = type('{}[{}]'.format(self.tenant_controller_class.__name__, tenant),
+                          (self.tenant_controller_class,), {'tenant': tenant, 'resources': self.resources})
+        controller.configure(config,
+                             cache=TenantCache(self.cache, tenant) if self.cache is not None else None,
+                             cache_ttl=self.cache_ttl,
+                             serialization=self.serialization,
+                             lazy=True,
+                             coalesce=self.coalesce)
+        controller.metrics = self.metrics
+        controller.parsers = self.parsers
+        controller.schedulers = self.schedulers
+        controller.hedgers = self.hedgers
+        controller.breakers = self.breakers
+        return controller
+
+    def evict(self, tenant: str):
+        """Drops controller of tenant, e.g. after change of its configuration"""
+        with self._lock:
+            if self._controllers.pop(tenant, None) is not None:
+                self.evicted_total += 1
+
+    def verify_receipt(self, tenant: str, provider: str, receipt: str, priority: int = INTERACTIVE,
+                       deadline: DeadlineArg = None) -> ProcessedReceipt:
+        """
+        Returns verified and parsed receipt of tenant's application
+        :param deadline: Seconds given to verification including creation of tenant's controller
+        :raises UndefinedTenant: There is no configuration of tenant
+        :raises UndefinedProvider: Provider isn't configured for tenant
+        :raises DeadlineExceeded: Verification isn't finished before deadline
+        """
+        deadline = to_deadline(deadline)
+        return self.controller(tenant).verify_receipt(provider, receipt, priority, deadline)
+
+    def verify_receipts(self, tenant: str,
+                        receipts: Iterable[Tuple[str, str]],
+                        concurrency: batch.Concurrency = batch.DEFAULT_CONCURRENCY,
+                        ordered: bool = True,
+                        max_pending: int = None,
+                        priority: int = BACKGROUND,
+                        deadline: DeadlineArg = None) -> Iterator[BatchVerificationResult]:
+        """Same as SubscriptionsBasicController.verify_receipts for receipts of tenant"""
+        return self.controller(tenant).verify_receipts(receipts, concurrency=concurrency, ordered=ordered,
+                                                       max_pending=max_pending, priority=priority, deadline=deadline)
+
+    def warm(self, tenants: Iterable[str]):
+        """Creates controllers, verifiers and parsers of tenants, e.g. the most active ones before fork"""
+        for tenant in tenants:
+            self.controller(tenant).warm()
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                'tenants': len(self._controllers),
+                'created_total': self.created_total,
+                'evicted_total': self.evicted_total,
+                'shared_resources': len(self.resources),
+            }
+
+    def close(self):
+        """Drops controllers of tenants and closes shared resources, should be called on application shutdown"""
+        with self._lock:
+            self._controllers.clear()
+        self.resources.close()
@@ -0,0 +1,157 @@
+"""
+Local HTTP server standing in for Apple and Google endpoints in tests
+and controllers with fake verifiers instead of configured ones
+"""
+
+import datetime
+import ipaddress
+import json
+import os
+import ssl
+import threading
+import time
+from collections import namedtuple
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Callable, Dict, Optional, Tuple, Type
+
+from cryptography import x509
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import ec
+from cryptography.x509.oid import NameOID
+
+from subinapp.core.controllers import SubscriptionsBasicController
+from subinapp.core.providers.google import Parser as GParser
+
+# handler(method, path, body) -> (status, response dict)
+StubHandler = Callable[[str, str, bytes], Tuple[int, dict]]
+
+
+def google_response(receipt: str, expiration_ms: float = 1600000000000, product_id: str = 'com.product',
+                    auto_renewing: bool = True) -> dict:
+    """Answer of Google Play about subscription whose purchase token is receipt"""
+    return {'expiryTimeMillis': expiration_ms, 'productId': product_id,
+            'purchaseToken': receipt, 'autoRenewing': auto_renewing}
+
+
+def make_controller(controller_class: Type[SubscriptionsBasicController], verifiers: Dict[str, Any],
+                    parsers: Dict[str, Any] = None, **attributes) -> Type[SubscriptionsBasicController]:
+    """
+    Subclass of controller with given verifiers, so tests don't change each other's controllers
+    :param verifiers: Verifier by provider
+    :param parsers: Parser by provider, Google parser is used for others, fake verifiers answer like Google Play
+    :param attributes: Other attributes of controller, e.g. metrics or cache
+    """
+    class Controller(controller_class):
+        pass
+
+    providers = namedtuple('Providers', sorted(verifiers))
+    Controller.providers = set(verifiers)
+    Controller.verifiers = providers(**verifiers)
+    Controller.parsers = providers(**{provider: (parsers or {}).get(provider) or GParser() for provider in verifiers})
+    for name, value in attributes.items():
+        setattr(Controller, name, value)
+    return Controller
+
+
+def make_certificate(directory: str) -> Tuple[str, str]:
+    """
+    Creates self-signed certificate for 127.0.0.1
+    :return: Paths to certificate and private key
+    """
+    key = ec.generate_private_key(ec.SECP256R1())
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, 'subinapp-stub')])
+    now = datetime.datetime.utcnow()
+    certificate = (
+        x509.CertificateBuilder()
+        .subject_name(name)
+        .issuer_name(name)
+        .public_key(key.public_key())
+        .serial_number(x509.random_serial_number())
+        .not_valid_before(now - datetime.timedelta(days=1))
+        .not_valid_after(now + datetime.timedelta(days=1))
+        .add_extension(x509.SubjectAlternativeName([x509.IPAddress(ipaddress.ip_address('127.0.0.1'))]),
+                       critical=False)
+        .add_extension(x509.BasicConstraints(ca=True, path_length=None), critical=True)
+        .sign(key, hashes.SHA256())
+    )
+    cert_path = os.path.join(directory, 'stub.crt')
+    key_path = os.path.join(directory, 'stub.key')
+    with open(cert_path, 'wb') as f:
+        f.write(certificate.public_bytes(serialization.Encoding.PEM))
+    with open(key_path, 'wb') as f:
+        f.write(key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8,
+                                  serialization.NoEncryption()))
+    return cert_path, key_path
+
+
+class _Server(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024
+
+
+class StubServer:
+    """
+    Serves json responses given by handler on random local port
+    Use as context manager, every request is handled in separate thread
+    With certificate requests are served over TLS
+    """
+
+    def __init__(self, handler: StubHandler, delay: float = 0, certificate: Optional[Tuple[str, str]] = None):
+        self.handler = handler
+        self.delay = delay
+        self.certificate = certificate
+        self.requests_count = 0
+        self._lock = threading.Lock()
+        self._server: Optional[ThreadingHTTPServer] = None
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return '{}://{}:{}'.format('https' if self.certificate else 'http', host, port)
+
+    def _make_request_handler(self):
+        stub = self
+
+        class RequestHandler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            # headers and body are written separately, without it delayed ACK adds ~40ms to keep-alive requests
+            disable_nagle_algorithm = True
+
+            def _respond(self):
+                length = int(self.headers.get('Content-Length') or 0)
+                body = self.rfile.read(length) if length else b''
+                with stub._lock:
+                    stub.requests_count += 1
+                if stub.delay:
+                    time.sleep(stub.delay)
+                status, response = stub.handler(self.command, self.path, body)
+                payload = json.dumps(response).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            do_GET = _respond
+            do_POST = _respond
+
+            def log_message(self, *args):
+                pass
+
+        return RequestHandler
+
+    def __enter__(self) -> 'StubServer':
+        self._server = _Server(('127.0.0.1', 0), self._make_request_handler())
+        if self.certificate:
+            context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+            context.load_cert_chain(*self.certificate)
+            self._server.socket = context.wrap_socket(self._server.socket, server_side=True)
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
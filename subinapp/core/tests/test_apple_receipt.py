@@ -0,0 +1,149 @@
+import base64
+from datetime import datetime, timezone
+
+import pytest
+
+from subinapp.core.apple_receipt import decode_receipt, check_receipt, decoded_receipt_keys, _DecodedReceipts
+from subinapp.core.providers.apple import Verifier as AVerifier
+from subinapp.core.routing import receipt_digest
+from subinapp.core.tests.stubs import StubServer
+from subinapp.interface.entities import SubscriptionManagerConfig, AppleVerifierConfig, AppleExtraArgs
+from subinapp.interface.exceptions import VerificationFailed
+
+SIGNED_DATA_OID = bytes.fromhex('2a864886f70d010702')
+DATA_OID = bytes.fromhex('2a864886f70d010701')
+
+
+def der(tag: int, content: bytes) -> bytes:
+    if len(content) < 0x80:
+        return bytes([tag, len(content)]) + content
+    size = (len(content).bit_length() + 7) // 8
+    return bytes([tag, 0x80 | size]) + len(content).to_bytes(size, 'big') + content
+
+
+def ber_indefinite(tag: int, *children: bytes) -> bytes:
+    return bytes([tag, 0x80]) + b''.join(children) + b'\x00\x00'
+
+
+def integer(value: int) -> bytes:
+    return der(0x02, value.to_bytes((value.bit_length() + 8) // 8, 'big', signed=True))
+
+
+def attribute(attribute_type: int, value: bytes) -> bytes:
+    return der(0x30, integer(attribute_type) + integer(1) + der(0x04, value))
+
+
+def string(attribute_type: int, value: str, tag: int = 0x0c) -> bytes:
+    return attribute(attribute_type, der(tag, value.encode('utf-8')))
+
+
+def in_app(product_id: str, transaction_id: str, original_transaction_id: str, expires: str) -> bytes:
+    return attribute(17, der(0x31, b''.join([
+        attribute(1701, integer(1)),
+        string(1702, product_id),
+        string(1703, transaction_id),
+        string(1705, original_transaction_id),
+        string(1704, '2020-01-01T00:00:00Z', 0x16),
+        string(1708, expires, 0x16),
+        string(1712, '', 0x16),
+        attribute(1711, integer(1000000050000000)),
+    ])))
+
+
+def make_receipt(bundle_id: str = 'com.company.myapp', indefinite: bool = True, purchases: int = 2) -> str:
+    """PKCS#7 container like App Store builds it, signature and certificates are omitted"""
+    payload = der(0x31, b''.join(
+        [string(2, bundle_id), string(3, '42'), string(19, '1.0'), string(12, '2020-02-01T10:00:00Z', 0x16),
+         attribute(5, b'\x01' * 20)]
+        + [in_app('com.product', str(2000 + i), '1000000001', '2020-{:02d}-01T00:00:00Z'.format(i % 10 + 2))
+           for i in range(purchases)]
+    ))
+    if indefinite:
+        # payload is split in chunks of constructed octet string
+        content = ber_indefinite(0x24, der(0x04, payload[:100]), der(0x04, payload[100:]))
+        signed_data = ber_indefinite(0x30, integer(1), der(0x31, b''),
+                                     ber_indefinite(0x30, der(0x06, DATA_OID), ber_indefinite(0xa0, content)),
+                                     der(0x31, b''))
+        container = ber_indefinite(0x30, der(0x06, SIGNED_DATA_OID), ber_indefinite(0xa0, signed_data))
+    else:
+        signed_data = der(0x30, integer(1) + der(0x31, b'')
+                          + der(0x30, der(0x06, DATA_OID) + der(0xa0, der(0x04, payload))) + der(0x31, b''))
+        container = der(0x30, der(0x06, SIGNED_DATA_OID) + der(0xa0, signed_data))
+    return base64.b64encode(container).decode('ascii')
+
+
+@pytest.mark.parametrize('indefinite', [True, False])
+def test_receipt_is_decoded(indefinite):
+    receipt = decode_receipt(make_receipt(indefinite=indefinite))
+    assert receipt.bundle_id == 'com.company.myapp'
+    assert receipt.application_version == '42'
+    assert receipt.original_application_version == '1.0'
+    assert receipt.creation_date == datetime(2020, 2, 1, 10, tzinfo=timezone.utc)
+    assert [purchase.transaction_id for purchase in receipt.in_app] == ['2000', '2001']
+    purchase = receipt.in_app[1]
+    assert purchase.product_id == 'com.product'
+    assert purchase.original_transaction_id == '1000000001'
+    assert purchase.expires_date == datetime(2020, 3, 1, tzinfo=timezone.utc)
+    assert purchase.cancellation_date is None
+    assert purchase.quantity == 1
+    assert purchase.web_order_line_item_id == 1000000050000000
+
+
+@pytest.mark.parametrize('receipt', [
+    'not base64!',
+    '',
+    make_receipt()[:200],
+    base64.b64encode(b'\x30\x03\x02\x01\x01').decode('ascii'),
+    base64.b64encode(b'{"signature": "..."}').decode('ascii'),
+])
+def test_malformed_receipts_are_rejected(receipt):
+    with pytest.raises(VerificationFailed):
+        decode_receipt(receipt)
+    assert decoded_receipt_keys(receipt) == decoded_receipt_keys(receipt)[:1]
+
+
+def test_decoded_receipts_are_cached_by_digest(monkeypatch):
+    cache = _DecodedReceipts(max_size=1)
+    monkeypatch.setattr('subinapp.core.apple_receipt._decoded', cache)
+    receipt = make_receipt()
+    decoded = decode_receipt(receipt)
+    assert decode_receipt(receipt) is decoded
+    assert list(cache._receipts) == [receipt_digest(receipt)]
+    decode_receipt(make_receipt(bundle_id='com.other.app'))
+    assert receipt_digest(receipt) not in cache._receipts
+
+
+def test_receipt_of_other_application_is_rejected():
+    assert check_receipt(make_receipt(), 'com.company.myapp').bundle_id == 'com.company.myapp'
+    with pytest.raises(VerificationFailed):
+        check_receipt(make_receipt(bundle_id='com.other.app'), 'com.company.myapp')
+
+
+def test_verifier_rejects_receipts_without_request_and_routes_decoded_ones():
+    response = {
+        'status': 0,
+        'environment': 'Sandbox',
+        'receipt': {'bundle_id': 'com.company.myapp', 'application_version': '42'},
+        'latest_receipt_info': [{'original_transaction_id': '1000000001'}],
+    }
+
+    def handler(method, path, body):
+        if path == '/production':
+            return 200, {'status': 21007}
+        return 200, response
+
+    config = AppleVerifierConfig(bundle_id='com.company.myapp', extra=AppleExtraArgs(decode_receipts=True))
+    verifier = AVerifier(SubscriptionManagerConfig(apple=config, google=None))
+    with StubServer(handler) as server:
+        verifier.verifier.production_url = server.url + '/production'
+        verifier.verifier.sandbox_url = server.url + '/sandbox'
+        for receipt in ('garbage', make_receipt(bundle_id='com.other.app')):
+            with pytest.raises(VerificationFailed):
+                verifier.verify(receipt)
+        assert server.requests_count == 0
+
+        verifier.verify(make_receipt(purchases=1))
+        assert server.requests_count == 2
+        # renewed receipt has the same original transaction, so it is sent to sandbox at once
+        verifier.verify(make_receipt(purchases=2))
+        assert server.requests_count == 3
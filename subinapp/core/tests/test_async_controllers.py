@@ -0,0 +1,135 @@
+import asyncio
+import json
+import time
+from datetime import datetime
+
+from subinapp.core.controllers import AsyncSubscriptionsController
+from subinapp.core.providers.apple import AsyncVerifier as AAsyncVerifier
+from subinapp.core.providers.google import AsyncVerifier as GAsyncVerifier
+from subinapp.core.tests.stubs import StubServer
+from subinapp.core.tokens import GoogleTokenManager
+from subinapp.interface.entities import SubscriptionManagerConfig, AppleVerifierConfig, GoogleVerifierConfig, \
+    AppleExtraArgs, ProcessedReceipt
+from subinapp.interface.exceptions import VerificationFailed
+
+APPLE_CONFIG = AppleVerifierConfig(bundle_id='com.company.myapp',
+                                   extra=AppleExtraArgs(shared_secret='4rjFaspQ3419S9vXx'))
+GOOGLE_CONFIG = GoogleVerifierConfig(bundle_id='com.company.myapp', private_key_path='/some/file/path/file.json')
+EXPIRES_MS = int(datetime.utcnow().timestamp() * 1000)
+
+APPLE_RESPONSE = {
+    'status': 0,
+    'latest_receipt_info': [
+        {'expires_date_ms': EXPIRES_MS, 'product_id': 'com.product.new', 'transaction_id': '48903258904286209385'},
+    ],
+    'pending_renewal_info': [{'product_id': 'com.product.new', 'auto_renew_status': '1'}],
+}
+GOOGLE_RESPONSE = {
+    'expiryTimeMillis': EXPIRES_MS,
+    'autoRenewing': True,
+}
+
+
+def apple_handler(method, path, body):
+    return 200, APPLE_RESPONSE
+
+
+def google_handler(method, path, body):
+    assert method == 'GET'
+    # /applications/{package}/purchases/subscriptions/{sku}/tokens/{token}
+    parts = path.split('/')
+    return 200, dict(GOOGLE_RESPONSE, productId=parts[-3], purchaseToken=parts[-1])
+
+
+def make_apple_verifier(url: str, config: AppleVerifierConfig = APPLE_CONFIG) -> AAsyncVerifier:
+    verifier = AAsyncVerifier(SubscriptionManagerConfig(apple=config, google=None))
+    verifier.production_url = url + '/production'
+    verifier.sandbox_url = url + '/sandbox'
+    return verifier
+
+
+def make_google_verifier(url: str) -> GAsyncVerifier:
+    token_manager = GoogleTokenManager(GOOGLE_CONFIG.private_key_path, fetch_token=lambda: ('token', 3600))
+    verifier = GAsyncVerifier(SubscriptionManagerConfig(apple=None, google=GOOGLE_CONFIG), token_manager=token_manager)
+    verifier.api_url = url + '/{package_name}/purchases/subscriptions/{subscription_id}/tokens/{token}'
+    return verifier
+
+
+def test_async_apple_verifier_retries_wrong_environment():
+    def handler(method, path, body):
+        assert json.loads(body)['password'] == '4rjFaspQ3419S9vXx'
+        if path == '/production':
+            return 200, {'status': 21007}
+        return 200, APPLE_RESPONSE
+
+    async def run():
+        verifier = make_apple_verifier(server.url)
+        try:
+            return await verifier.verify('receipt')
+        finally:
+            await verifier.close()
+
+    with StubServer(handler) as server:
+        assert asyncio.run(run()) == APPLE_RESPONSE
+        assert server.requests_count == 2
+
+
+def test_async_apple_verifier_fails_on_bad_status():
+    async def run():
+        verifier = make_apple_verifier(server.url)
+        try:
+            await verifier.verify('receipt')
+        finally:
+            await verifier.close()
+
+    with StubServer(lambda *args: (200, {'status': 21002})) as server:
+        try:
+            asyncio.run(run())
+        except VerificationFailed:
+            pass
+        else:
+            assert False
+
+
+def test_async_google_verifier():
+    async def run():
+        verifier = make_google_verifier(server.url)
+        try:
+            return await verifier.verify(json.dumps({'purchaseToken': 'token-1', 'productId': 'com.product'}))
+        finally:
+            await verifier.close()
+
+    with StubServer(google_handler) as server:
+        result = asyncio.run(run())
+    assert result['purchaseToken'] == 'token-1'
+    assert result['productId'] == 'com.product'
+
+
+def test_async_controller_keeps_verifications_in_flight():
+    class Controller(AsyncSubscriptionsController):
+        pass
+
+    async def run():
+        Controller.configure(SubscriptionManagerConfig(apple=APPLE_CONFIG, google=GOOGLE_CONFIG))
+        apple = make_apple_verifier(apple_server.url)
+        google = make_google_verifier(google_server.url)
+        Controller.verifiers = Controller.verifiers._replace(apple=apple, google=google)
+        receipts = [('apple', 'receipt')] * 100 + [
+            ('google', json.dumps({'purchaseToken': 'token-%s' % i, 'productId': 'com.product'}))
+            for i in range(100)
+        ]
+        try:
+            return await asyncio.gather(*(Controller.verify_receipt(provider=p, receipt=r) for p, r in receipts))
+        finally:
+            await Controller.close()
+
+    with StubServer(apple_handler, delay=0.2) as apple_server, \
+            StubServer(google_handler, delay=0.2) as google_server:
+        started = time.monotonic()
+        results = asyncio.run(run())
+        elapsed = time.monotonic() - started
+    # 200 sequential calls would take 40 seconds
+    assert elapsed < 10
+    assert all(isinstance(r, ProcessedReceipt) for r in results)
+    assert results[0].subscription_info.purchase_token == '48903258904286209385'
+    assert results[-1].subscription_info.purchase_token == 'token-99'
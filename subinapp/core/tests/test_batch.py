@@ -0,0 +1,143 @@
+import asyncio
+import itertools
+import threading
+import time
+from collections import defaultdict
+
+from subinapp.core.batch import DEFAULT_CONCURRENCY
+from subinapp.core.controllers import SubscriptionsBasicController, AsyncSubscriptionsController
+from subinapp.core.tests import stubs
+from subinapp.interface.exceptions import VerificationFailed, ParsingFailed, UndefinedProvider
+
+
+class ConcurrencyCounter:
+    def __init__(self):
+        self.current = defaultdict(int)
+        self.max = defaultdict(int)
+        self.lock = threading.Lock()
+
+    def enter(self, provider):
+        with self.lock:
+            self.current[provider] += 1
+            self.max[provider] = max(self.max[provider], self.current[provider])
+
+    def exit(self, provider):
+        with self.lock:
+            self.current[provider] -= 1
+
+
+def google_response(receipt: str) -> dict:
+    if receipt == 'bad-parse':
+        return {}
+    return stubs.google_response(receipt)
+
+
+class FakeVerifier:
+    def __init__(self, provider, counter, delay):
+        self.provider = provider
+        self.counter = counter
+        self.delay = delay
+
+    def verify(self, receipt):
+        self.counter.enter(self.provider)
+        try:
+            time.sleep(self.delay)
+            if receipt == 'bad-verify':
+                raise VerificationFailed('Bad receipt')
+            return google_response(receipt)
+        finally:
+            self.counter.exit(self.provider)
+
+
+class FakeAsyncVerifier(FakeVerifier):
+    async def verify(self, receipt):
+        self.counter.enter(self.provider)
+        try:
+            await asyncio.sleep(self.delay)
+            if receipt == 'bad-verify':
+                raise VerificationFailed('Bad receipt')
+            return google_response(receipt)
+        finally:
+            self.counter.exit(self.provider)
+
+
+def make_controller(controller_class, verifier_class, counter):
+    # google parser for both, fake verifiers return google-like responses
+    return stubs.make_controller(controller_class, {'apple': verifier_class('apple', counter, 0.02),
+                                                    'google': verifier_class('google', counter, 0.01)})
+
+
+def test_batch_keeps_order_and_limits_concurrency():
+    counter = ConcurrencyCounter()
+    Controller = make_controller(SubscriptionsBasicController, FakeVerifier, counter)
+    receipts = [('apple' if i % 3 else 'google', 'receipt-%s' % i) for i in range(60)]
+    receipts[5] = ('google', 'bad-verify')
+    receipts[7] = ('apple', 'bad-parse')
+    receipts[11] = ('amazon', 'receipt')
+    results = list(Controller.verify_receipts(receipts, concurrency={'apple': 2, 'google': 4}))
+    assert [r.index for r in results] == list(range(60))
+    assert counter.max['apple'] == 2
+    assert counter.max['google'] == 4
+    assert isinstance(results[5].error, VerificationFailed)
+    assert isinstance(results[7].error, ParsingFailed)
+    assert isinstance(results[11].error, UndefinedProvider)
+    assert results[0].is_verified
+    assert results[0].processed_receipt.subscription_info.purchase_token == 'receipt-0'
+
+
+def test_batch_streams_results():
+    Controller = make_controller(SubscriptionsBasicController, FakeVerifier, ConcurrencyCounter())
+    consumed = []
+
+    def receipts():
+        for i in itertools.count():
+            consumed.append(i)
+            yield 'google', 'receipt-%s' % i
+
+    results = Controller.verify_receipts(receipts(), concurrency=4, ordered=False, max_pending=8)
+    first = list(itertools.islice(results, 20))
+    results.close()
+    assert len({r.index for r in first}) == 20
+    # input is not read far ahead of yielded results
+    assert len(consumed) <= 20 + 8
+
+
+def test_providers_missing_in_concurrency_have_default_limit():
+    counter = ConcurrencyCounter()
+    Controller = make_controller(SubscriptionsBasicController, FakeVerifier, counter)
+    results = Controller.verify_receipts([('google', 'receipt-%s' % i) for i in range(40)], concurrency={'apple': 1})
+    assert all(result.is_verified for result in results)
+    # pending receipts aren't limited by concurrency of apple only
+    assert counter.max['google'] == DEFAULT_CONCURRENCY
+
+
+def test_async_batch():
+    counter = ConcurrencyCounter()
+    Controller = make_controller(AsyncSubscriptionsController, FakeAsyncVerifier, counter)
+    receipts = [('apple' if i % 2 else 'google', 'receipt-%s' % i) for i in range(40)]
+    receipts[3] = ('apple', 'bad-verify')
+
+    async def run():
+        return [r async for r in Controller.verify_receipts(receipts, concurrency={'apple': 3, 'google': 5})]
+
+    results = asyncio.run(run())
+    assert [r.index for r in results] == list(range(40))
+    assert counter.max['apple'] == 3
+    assert counter.max['google'] == 5
+    assert isinstance(results[3].error, VerificationFailed)
+
+
+def test_closed_async_batch_waits_for_cancelled_verifications():
+    counter = ConcurrencyCounter()
+    Controller = make_controller(AsyncSubscriptionsController, FakeAsyncVerifier, counter)
+
+    async def run():
+        # google answers first, apple verifications are still running
+        results = Controller.verify_receipts([('google', 'receipt')] + [('apple', 'receipt-%s' % i) for i in range(10)])
+        assert (await results.__anext__()).is_verified
+        assert counter.current['apple']
+        await results.aclose()
+        # cancelled verifications are finished before batch is closed
+        return sum(counter.current.values())
+
+    assert asyncio.run(run()) == 0
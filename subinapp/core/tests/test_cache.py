@@ -0,0 +1,64 @@
+from datetime import datetime, timedelta
+
+from subinapp.core.cache import InMemoryCache, receipt_cache_key, receipt_cache_ttl
+from subinapp.core.controllers import SubscriptionsBasicController
+from subinapp.core.tests.stubs import google_response, make_controller
+from subinapp.interface.entities import ProcessedReceipt, VerifiedSubscriptionInfo
+
+
+def make_processed_receipt(expiration_date: datetime) -> ProcessedReceipt:
+    info = VerifiedSubscriptionInfo(product_id='com.product', purchase_token='token',
+                                    expiration_date=expiration_date, is_renewable=True)
+    return ProcessedReceipt(provider='google', subscription_info=info, receipt=b'', provider_response=b'')
+
+
+class CountingVerifier:
+    def __init__(self, expiration_date: datetime):
+        self.calls = 0
+        self.expiration_date = expiration_date
+
+    def verify(self, receipt):
+        self.calls += 1
+        return google_response(receipt, expiration_ms=self.expiration_date.timestamp() * 1000)
+
+
+def test_in_memory_cache_evicts_least_recently_used():
+    cache = InMemoryCache(max_size=2)
+    item = make_processed_receipt(datetime.now() + timedelta(days=1))
+    cache.set('a', item, 60)
+    cache.set('b', item, 60)
+    assert cache.get('a') is item
+    cache.set('c', item, 60)
+    assert cache.get('b') is None
+    assert cache.get('a') is item
+    assert cache.get('c') is item
+    cache.set('d', item, 0)
+    assert cache.get('d') is None
+    assert len(cache) == 2
+
+
+def test_cache_ttl_is_capped_by_expiration_date():
+    soon = make_processed_receipt(datetime.now() + timedelta(seconds=100))
+    assert 90 < receipt_cache_ttl(soon, 3600) <= 100
+    later = make_processed_receipt(datetime.now() + timedelta(days=30))
+    assert receipt_cache_ttl(later, 3600) == 3600
+    expired = make_processed_receipt(datetime.now() - timedelta(days=1))
+    assert receipt_cache_ttl(expired, 3600) < 0
+    assert receipt_cache_key('google', 'x') != receipt_cache_key('apple', 'x')
+
+
+def test_controller_uses_cache():
+    verifier = CountingVerifier(datetime.now() + timedelta(days=30))
+    Controller = make_controller(SubscriptionsBasicController, {'google': verifier}, cache=InMemoryCache())
+    first = Controller.verify_receipt(provider='google', receipt='receipt-1')
+    second = Controller.verify_receipt(provider='google', receipt='receipt-1')
+    assert first is second
+    assert verifier.calls == 1
+    Controller.verify_receipt(provider='google', receipt='receipt-2')
+    assert verifier.calls == 2
+
+    # lapsed subscriptions are never served from cache
+    verifier.expiration_date = datetime.now() - timedelta(days=1)
+    Controller.verify_receipt(provider='google', receipt='receipt-3')
+    Controller.verify_receipt(provider='google', receipt='receipt-3')
+    assert verifier.calls == 4
@@ -0,0 +1,171 @@
+import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from subinapp.core.coalescing import SingleFlight, AsyncSingleFlight
+from subinapp.core.controllers import SubscriptionsBasicController, AsyncSubscriptionsController
+from subinapp.core.metrics import Metrics, InMemoryHistogramSink
+from subinapp.core.scheduling import INTERACTIVE, BACKGROUND
+from subinapp.core.tests import stubs
+from subinapp.core.tests.stubs import google_response
+from subinapp.interface.exceptions import VerificationFailed, DeadlineExceeded, RateLimitExceeded
+
+
+class BlockingVerifier:
+    """Waits for release, so all concurrent verifications are in progress at once"""
+    metrics = None
+
+    def __init__(self):
+        self.calls = 0
+        self.release = threading.Event()
+
+    def verify(self, receipt):
+        self.calls += 1
+        self.release.wait(5)
+        if receipt == 'bad-verify':
+            raise VerificationFailed('Bad receipt')
+        return google_response(receipt)
+
+
+class AsyncBlockingVerifier:
+    metrics = None
+
+    def __init__(self):
+        self.calls = 0
+        self.release = asyncio.Event()
+
+    async def verify(self, receipt):
+        self.calls += 1
+        await self.release.wait()
+        return google_response(receipt)
+
+
+def make_controller(controller_class, verifier, sink: InMemoryHistogramSink):
+    return stubs.make_controller(controller_class, {'google': verifier}, metrics=Metrics([sink]),
+                                 in_flight=controller_class.single_flight_class())
+
+
+def verify_concurrently(controller, receipt: str, count: int) -> list:
+    with ThreadPoolExecutor(count) as executor:
+        futures = [executor.submit(controller.verify_receipt, provider='google', receipt=receipt)
+                   for _ in range(count)]
+        while controller.in_flight.collapsed < count - 1:
+            threading.Event().wait(0.001)
+        controller.verifiers.google.release.set()
+        results = []
+        for future in futures:
+            try:
+                results.append(future.result())
+            except VerificationFailed as e:
+                results.append(e)
+        return results
+
+
+def test_concurrent_verifications_share_one_request():
+    sink = InMemoryHistogramSink()
+    controller = make_controller(SubscriptionsBasicController, BlockingVerifier(), sink)
+    results = verify_concurrently(controller, 'receipt', 5)
+    assert controller.verifiers.google.calls == 1
+    assert all(result is results[0] for result in results)
+    assert results[0].subscription_info.purchase_token == 'receipt'
+    assert sink.counters[('google', 'coalesced')] == 4
+    assert sink.counters[('google', 'verified')] == 1
+
+    # next verification isn't coalesced with completed one
+    controller.verify_receipt(provider='google', receipt='receipt')
+    assert controller.verifiers.google.calls == 2
+
+
+def test_exception_is_shared():
+    sink = InMemoryHistogramSink()
+    controller = make_controller(SubscriptionsBasicController, BlockingVerifier(), sink)
+    results = verify_concurrently(controller, 'bad-verify', 3)
+    assert controller.verifiers.google.calls == 1
+    assert all(isinstance(result, VerificationFailed) for result in results)
+    assert sink.counters[('google', 'verification_failed')] == 3
+
+
+def test_different_keys_are_not_coalesced():
+    single_flight = SingleFlight()
+    assert single_flight.do('a', lambda: 1) == 1
+    assert single_flight.do('b', lambda: 2) == 2
+    with pytest.raises(ValueError):
+        single_flight.do('a', lambda: int('not a number'))
+    assert single_flight.collapsed == 0
+
+
+def test_async_verifications_share_one_request():
+    async def run():
+        sink = InMemoryHistogramSink()
+        controller = make_controller(AsyncSubscriptionsController, AsyncBlockingVerifier(), sink)
+        tasks = [asyncio.ensure_future(controller.verify_receipt(provider='google', receipt='receipt'))
+                 for _ in range(5)]
+        await asyncio.sleep(0)
+        # cancellation of first caller doesn't cancel shared verification
+        tasks[0].cancel()
+        controller.verifiers.google.release.set()
+        results = await asyncio.gather(*tasks[1:])
+        assert controller.verifiers.google.calls == 1
+        assert all(result is results[0] for result in results)
+        assert controller.in_flight.collapsed == 4
+        assert sink.counters[('google', 'coalesced')] == 4
+
+    asyncio.run(run())
+
+
+def test_async_single_flight_shares_exception():
+    async def fail():
+        await asyncio.sleep(0.01)
+        raise ValueError('failed')
+
+    async def run():
+        single_flight = AsyncSingleFlight()
+        results = await asyncio.gather(*[single_flight.do('key', fail) for _ in range(3)], return_exceptions=True)
+        assert all(isinstance(result, ValueError) for result in results)
+        assert single_flight.collapsed == 2
+
+    asyncio.run(run())
+
+
+def test_follower_with_time_left_retries_after_deadline_of_leader():
+    sink = InMemoryHistogramSink()
+    verifier = BlockingVerifier()
+    controller = make_controller(SubscriptionsBasicController, verifier, sink)
+    with ThreadPoolExecutor(2) as executor:
+        leader = executor.submit(controller.verify_receipt, 'google', 'receipt', BACKGROUND, 0.05)
+        while verifier.calls < 1:
+            time.sleep(0.001)
+        follower = executor.submit(controller.verify_receipt, 'google', 'receipt', INTERACTIVE, 5)
+        while controller.in_flight.collapsed < 1:
+            time.sleep(0.001)
+        time.sleep(0.1)
+        verifier.release.set()
+        with pytest.raises(DeadlineExceeded):
+            leader.result()
+        assert follower.result().subscription_info.purchase_token == 'receipt'
+    assert verifier.calls == 2
+
+
+def test_async_follower_retries_after_rate_limit_of_leader():
+    calls = []
+
+    async def work(priority: int):
+        calls.append(priority)
+        await asyncio.sleep(0.01)
+        if priority == BACKGROUND:
+            raise RateLimitExceeded('Request is rejected')
+        return priority
+
+    async def run():
+        single_flight = AsyncSingleFlight()
+        return await asyncio.gather(single_flight.do('key', lambda: work(BACKGROUND)),
+                                    single_flight.do('key', lambda: work(INTERACTIVE)),
+                                    return_exceptions=True)
+
+    leader, follower = asyncio.run(run())
+    assert isinstance(leader, RateLimitExceeded)
+    assert follower == INTERACTIVE
+    assert calls == [BACKGROUND, INTERACTIVE]
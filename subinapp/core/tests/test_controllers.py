@@ -15,7 +15,7 @@ FAKE_GOOGLE_CONFIG = GoogleVerifierConfig(bundle_id='com.company.myapp',
 
 class GooglePlayVerifierMock(inapppy.GooglePlayVerifier):
     def __init__(self, bundle_id: str = 'some.bundle.id', private_key_path: str = '/some/file/path/file.json',
-                 http_timeout: int = 15):
+                 http_timeout: int = 15, token_manager=None):
         ...
 
     def _authorize(self):
@@ -0,0 +1,138 @@
+import asyncio
+import json
+import time
+
+import pytest
+
+from subinapp.core.controllers import SubscriptionsBasicController, AsyncSubscriptionsController
+from subinapp.core.deadlines import Deadline
+from subinapp.core.metrics import InMemoryHistogramSink
+from subinapp.core.providers.apple import PooledAppStoreValidator, Parser
+from subinapp.core.scheduling import ProviderScheduler
+from subinapp.core.tests.stubs import StubServer
+from subinapp.interface.entities import SubscriptionManagerConfig, AppleVerifierConfig, AppleExtraArgs, \
+    CircuitBreakerPolicy, RateLimit
+from subinapp.interface.exceptions import DeadlineExceeded
+
+RESPONSE = {
+    'status': 0,
+    'environment': 'Production',
+    'latest_receipt_info': [{'product_id': 'com.product', 'transaction_id': '1', 'original_transaction_id': '1',
+                             'expires_date_ms': '4102444800000'}],
+    'pending_renewal_info': [{'product_id': 'com.product', 'auto_renew_status': '1'}],
+}
+CONFIG = AppleVerifierConfig(bundle_id='com.company.myapp', extra=AppleExtraArgs(learn_environment=False))
+
+
+def slow_handler(seconds: float):
+    def handler(method, path, body):
+        time.sleep(seconds)
+        return 200, RESPONSE
+    return handler
+
+
+def make_controller(monkeypatch, server: StubServer, **kwargs):
+    monkeypatch.setattr(PooledAppStoreValidator, 'production_url', server.url + '/production')
+    monkeypatch.setattr(PooledAppStoreValidator, 'sandbox_url', server.url + '/sandbox')
+
+    class Controller(SubscriptionsBasicController):
+        pass
+
+    sink = InMemoryHistogramSink()
+    Controller.configure(SubscriptionManagerConfig(apple=CONFIG, google=None), metrics_sinks=[sink], **kwargs)
+    return Controller, sink
+
+
+def test_slow_provider_is_abandoned_at_deadline(monkeypatch):
+    with StubServer(slow_handler(1)) as server:
+        controller, sink = make_controller(monkeypatch, server,
+                                           circuit_breakers={'apple': CircuitBreakerPolicy(failure_threshold=1)})
+        started = time.monotonic()
+        with pytest.raises(DeadlineExceeded):
+            controller.verify_receipt('apple', 'receipt', deadline=0.2)
+        assert time.monotonic() - started < 0.6
+        # timeout given by caller isn't failure of provider, urllib3 didn't retry after deadline
+        assert controller.breakers['apple'].state == 'closed'
+        assert server.requests_count == 1
+        assert controller.verify_receipt('apple', 'receipt').subscription_info.product_id == 'com.product'
+    assert sink.counters[('apple', 'deadline_exceeded')] == 1
+
+
+def test_wrong_environment_is_not_retried_without_time_for_it(monkeypatch):
+    def handler(method, path, body):
+        if path == '/production':
+            time.sleep(0.2)
+            return 200, {'status': 21007}
+        return 200, RESPONSE
+
+    with StubServer(handler) as server:
+        controller, _ = make_controller(monkeypatch, server)
+        with pytest.raises(DeadlineExceeded):
+            controller.verify_receipt('apple', 'receipt', deadline=0.3)
+        assert server.requests_count == 1
+        assert controller.verify_receipt('apple', 'receipt', deadline=1).subscription_info.product_id == 'com.product'
+        assert server.requests_count == 3
+
+
+def test_deadline_is_checked_before_serialization(monkeypatch):
+    parse = Parser.parse
+
+    def slow_parse(self, provider_response):
+        time.sleep(0.2)
+        return parse(self, provider_response)
+
+    monkeypatch.setattr(Parser, 'parse', slow_parse)
+    with StubServer(slow_handler(0)) as server:
+        controller, _ = make_controller(monkeypatch, server)
+        with pytest.raises(DeadlineExceeded, match='serialization'):
+            controller.verify_receipt('apple', 'receipt', deadline=0.1)
+
+
+def test_batch_shares_deadline(monkeypatch):
+    with StubServer(slow_handler(0.3)) as server:
+        controller, _ = make_controller(monkeypatch, server)
+        started = time.monotonic()
+        results = list(controller.verify_receipts([('apple', 'receipt-{}'.format(i)) for i in range(5)],
+                                                  concurrency=1, deadline=0.5))
+        assert time.monotonic() - started < 0.9
+    assert results[0].is_verified
+    assert all(isinstance(result.error, DeadlineExceeded) for result in results[1:])
+    # the rest are abandoned without requests
+    assert server.requests_count == 2
+
+
+def test_async_request_is_cancelled_at_deadline():
+    class Controller(AsyncSubscriptionsController):
+        pass
+
+    def handler(method, path, body):
+        if json.loads(body)['receipt-data'] == 'slow':
+            time.sleep(1)
+        return 200, RESPONSE
+
+    async def run():
+        Controller.configure(SubscriptionManagerConfig(apple=CONFIG, google=None))
+        Controller.verifiers.apple.production_url = server.url + '/production'
+        try:
+            started = time.monotonic()
+            with pytest.raises(DeadlineExceeded):
+                await Controller.verify_receipt('apple', 'slow', deadline=0.2)
+            assert time.monotonic() - started < 0.6
+            result = await Controller.verify_receipt('apple', 'receipt', deadline=5)
+            assert result.subscription_info.product_id == 'com.product'
+        finally:
+            await Controller.close()
+
+    with StubServer(handler) as server:
+        asyncio.run(run())
+
+
+def test_request_doesnt_wait_for_turn_after_deadline():
+    scheduler = ProviderScheduler('apple', RateLimit(rate=1, burst=1, max_wait=10))
+    scheduler.acquire()
+    started = time.monotonic()
+    with pytest.raises(DeadlineExceeded):
+        scheduler.acquire(deadline=Deadline(0.5))
+    # turn comes in a second, so request is rejected at once
+    assert time.monotonic() - started < 0.1
+    assert scheduler.stats()['rejected_total'] == 1
@@ -0,0 +1,76 @@
+from datetime import datetime
+
+from subinapp.core.entitlements import EntitlementIndex
+from subinapp.interface.entities import VerifiedSubscriptionInfo, ProcessedReceipt, BatchVerificationResult
+from subinapp.interface.exceptions import VerificationFailed
+
+NOW = 1600000000
+HOUR = 3600
+
+
+def subscription(token: str, hours_to_expiration: float, product_id: str = 'com.product') -> VerifiedSubscriptionInfo:
+    return VerifiedSubscriptionInfo(product_id=product_id, purchase_token=token, is_renewable=True,
+                                    expiration_date=datetime.fromtimestamp(NOW + hours_to_expiration * HOUR))
+
+
+def test_lookups_and_updates():
+    index = EntitlementIndex(capacity=4)
+    for i in range(1000):
+        index.update(subscription('token-{}'.format(i), i - 500, 'com.product.{}'.format(i % 2)))
+    assert len(index) == 1000
+    assert index.stats()['capacity'] >= 1000 / 0.7
+    assert index.is_active('token-501', NOW)
+    assert not index.is_active('token-500', NOW)
+    assert not index.is_active('token-10', NOW)
+    assert index.is_active('token-10', NOW - 500 * HOUR)
+    assert index.is_active('token-501', NOW, product_id='com.product.1')
+    assert not index.is_active('token-501', NOW, product_id='com.product.0')
+    assert not index.is_active('unknown', NOW)
+    assert index.expires_at('token-600') == NOW + 100 * HOUR
+    assert index.expires_at('unknown') is None
+
+    # renewal
+    index.update(subscription('token-10', 10))
+    assert index.is_active('token-10', NOW)
+    assert len(index) == 1000
+
+    index.discard('token-10')
+    index.discard('unknown')
+    assert 'token-10' not in index
+    assert len(index) == 999
+
+
+def test_lapsed_entries_are_expired():
+    index = EntitlementIndex(bucket_seconds=HOUR)
+    for i in range(100):
+        index.update(subscription('token-{}'.format(i), i - 50))
+    # renewed after lapse
+    index.update(subscription('token-0', 100))
+    # buckets till the one of current hour are removed
+    assert index.expire(NOW + 0.5 * HOUR) == 49
+    assert len(index) == 51
+    assert 'token-0' in index
+    assert 'token-50' in index
+    assert index.expire(NOW + 0.5 * HOUR) == 0
+
+    # deleted slots are reused
+    capacity = index.stats()['capacity']
+    for i in range(1000):
+        index.update(subscription('token-new-{}'.format(i % 10), 1))
+        index.discard('token-new-{}'.format(i % 10))
+    assert index.stats()['capacity'] == capacity
+    assert len(index) == 51
+
+
+def test_index_tracks_verification_results():
+    index = EntitlementIndex()
+    results = [
+        BatchVerificationResult(index=0, provider='google', processed_receipt=ProcessedReceipt(
+            provider='google', subscription_info=subscription('token-1', 1))),
+        BatchVerificationResult(index=1, provider='google', error=VerificationFailed('Bad receipt')),
+        ProcessedReceipt(provider='apple', subscription_info=subscription('token-2', 2)),
+    ]
+    assert list(index.track(results)) == results
+    assert index.is_active('token-1', NOW)
+    assert index.is_active('token-2', NOW)
+    assert len(index) == 2
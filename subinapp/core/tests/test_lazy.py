@@ -0,0 +1,86 @@
+import multiprocessing
+
+import pytest
+
+from subinapp.core import controllers
+from subinapp.core.controllers import SubscriptionsBasicController
+from subinapp.core.providers.apple import Verifier as AppleVerifier, Parser as AppleParser
+from subinapp.core.tokens import GoogleTokenManager
+from subinapp.core.transport import PooledTransport
+from subinapp.interface.entities import SubscriptionManagerConfig, AppleVerifierConfig, AppleExtraArgs
+from subinapp.interface.exceptions import UndefinedProvider
+
+CONFIG = SubscriptionManagerConfig(apple=AppleVerifierConfig(bundle_id='com.company.myapp',
+                                                             extra=AppleExtraArgs(shared_secret='secret')),
+                                   google=None)
+
+
+class Controller(SubscriptionsBasicController):
+    pass
+
+
+@pytest.fixture
+def imported_modules(monkeypatch):
+    imported = []
+
+    def import_module(name):
+        imported.append(name)
+        return original(name)
+
+    original = controllers.import_module
+    monkeypatch.setattr(controllers, 'import_module', import_module)
+    return imported
+
+
+def test_providers_are_loaded_on_first_use(imported_modules):
+    Controller.configure(CONFIG, lazy=True)
+    assert Controller.providers == {'apple'}
+    assert imported_modules == []
+    assert list(Controller.verifiers) == []
+    assert not Controller.verifiers.is_loaded('apple')
+
+    verifier = Controller.verifiers.apple
+    assert isinstance(verifier, AppleVerifier)
+    assert Controller.verifiers.apple is verifier
+    assert list(Controller.verifiers) == [verifier]
+    assert not Controller.parsers.is_loaded('apple')
+    assert imported_modules == ['subinapp.core.providers.apple']
+    with pytest.raises(AttributeError):
+        Controller.verifiers.google
+
+
+def test_warm_loads_all_providers(imported_modules):
+    Controller.configure(CONFIG, lazy=True)
+    Controller.warm()
+    assert Controller.verifiers.is_loaded('apple')
+    assert isinstance(Controller.parsers.apple, AppleParser)
+    assert Controller.verifiers.apple.metrics is Controller.metrics
+    with pytest.raises(UndefinedProvider):
+        Controller.warm(['google'])
+
+
+def _report_state_after_fork(queue, transport, parent_session, token_manager):
+    queue.put((transport.session is not parent_session,
+               token_manager._thread is not None and token_manager._thread.is_alive(),
+               token_manager.valid_token()))
+
+
+def test_objects_created_before_fork_are_reinitialized_in_child():
+    transport = PooledTransport()
+    token_manager = GoogleTokenManager('/some/file/path/file.json', fetch_token=lambda: ('token', 3600))
+    token_manager.start()
+    try:
+        assert token_manager.get_token() == 'token'
+        context = multiprocessing.get_context('fork')
+        queue = context.Queue()
+        process = context.Process(target=_report_state_after_fork,
+                                  args=(queue, transport, transport.session, token_manager))
+        process.start()
+        new_session, thread_is_running, token = queue.get(timeout=10)
+        process.join(10)
+    finally:
+        token_manager.stop()
+        transport.close()
+    assert new_session
+    assert thread_is_running
+    assert token == 'token'
@@ -0,0 +1,75 @@
+import pickle
+
+from subinapp.core.controllers import SubscriptionsBasicController
+from subinapp.core.metrics import Metrics, InMemoryHistogramSink, render_prometheus
+from subinapp.core.tests import stubs
+from subinapp.core.tests.stubs import google_response
+from subinapp.interface.exceptions import VerificationFailed, ParsingFailed, UndefinedProvider
+
+
+class FakeVerifier:
+    metrics = None
+
+    def verify(self, receipt):
+        if receipt == 'bad-verify':
+            raise VerificationFailed('Bad receipt')
+        if receipt == 'bad-parse':
+            return {}
+        return google_response(receipt)
+
+
+def make_controller(metrics: Metrics):
+    return stubs.make_controller(SubscriptionsBasicController, {'google': FakeVerifier()}, metrics=metrics)
+
+
+def expect_exception(func, exception_class):
+    try:
+        func()
+    except exception_class:
+        pass
+    else:
+        assert False
+
+
+def test_controller_reports_stages_and_outcomes():
+    sink = InMemoryHistogramSink()
+    controller = make_controller(Metrics([sink]))
+    result = controller.verify_receipt(provider='google', receipt='receipt')
+    expect_exception(lambda: controller.verify_receipt(provider='google', receipt='bad-verify'), VerificationFailed)
+    expect_exception(lambda: controller.verify_receipt(provider='google', receipt='bad-parse'), ParsingFailed)
+    expect_exception(lambda: controller.verify_receipt(provider='apple', receipt='receipt'), UndefinedProvider)
+
+    assert sink.counters[('google', 'verified')] == 1
+    assert sink.counters[('google', 'verification_failed')] == 1
+    assert sink.counters[('google', 'parsing_failed')] == 1
+    assert sink.counters[('apple', 'undefined_provider')] == 1
+    assert sink.durations[('google', 'verify')].count == 3
+    assert sink.durations[('google', 'parse')].count == 2
+    # serialization is measured when payloads are accessed
+    assert ('google', 'serialize') not in sink.durations
+    assert len(result.provider_response) > 0
+    assert sink.durations[('google', 'serialize')].count == 1
+    assert sink.sizes[('google', 'provider_response')].sum == len(result.provider_response)
+
+    text = render_prometheus(sink)
+    assert '# TYPE subinapp_stage_duration_seconds histogram' in text
+    assert 'subinapp_stage_duration_seconds_count{provider="google",stage="verify"} 3' in text
+    assert 'subinapp_stage_duration_seconds_bucket{provider="google",stage="parse",le="+Inf"} 2' in text
+    assert 'subinapp_events_total{provider="google",event="verified"} 1' in text
+
+
+def test_instrumented_result_can_be_pickled():
+    controller = make_controller(Metrics([InMemoryHistogramSink()]))
+    result = controller.verify_receipt(provider='google', receipt='receipt')
+    restored = pickle.loads(pickle.dumps(result))
+    assert type(restored.serialization).__name__ == 'SerializationOptions'
+    assert restored == result
+
+
+def test_metrics_without_sinks_do_nothing():
+    metrics = Metrics()
+    assert not metrics
+    assert metrics.timer('google', 'verify') is metrics.outcomes('google')
+    controller = make_controller(metrics)
+    result = controller.verify_receipt(provider='google', receipt='receipt')
+    assert type(result.serialization).__name__ == 'SerializationOptions'
@@ -0,0 +1,142 @@
+import asyncio
+import base64
+import json
+
+from subinapp.core.controllers import SubscriptionsBasicController, AsyncSubscriptionsController
+from subinapp.core.notifications import NotificationPipeline
+from subinapp.core.providers.apple import Parser as AParser, decode_notification
+from subinapp.core.tests import stubs
+from subinapp.core.tests.stubs import google_response
+from subinapp.interface.entities import SubscriptionManagerConfig, AppleVerifierConfig, AppleExtraArgs, \
+    GoogleVerifierConfig
+from subinapp.interface.exceptions import VerificationFailed
+
+CONFIG = SubscriptionManagerConfig(
+    apple=AppleVerifierConfig(bundle_id='com.company.myapp', extra=AppleExtraArgs(shared_secret='secret')),
+    google=GoogleVerifierConfig(bundle_id='com.company.myapp', private_key_path='/some/file/path/file.json'),
+)
+
+
+class FakeGoogleVerifier:
+    metrics = None
+
+    def __init__(self):
+        self.receipts = []
+
+    def verify(self, receipt):
+        self.receipts.append(receipt)
+        decoded = json.loads(receipt)
+        if decoded['purchaseToken'] == 'bad-token':
+            raise VerificationFailed('Bad token')
+        return google_response(decoded['purchaseToken'], product_id=decoded['productId'], auto_renewing=False)
+
+
+class FakeAsyncGoogleVerifier(FakeGoogleVerifier):
+    async def verify(self, receipt):
+        return super(FakeAsyncGoogleVerifier, self).verify(receipt)
+
+
+def make_controller(controller_class, google_verifier):
+    return stubs.make_controller(controller_class, {'apple': None, 'google': google_verifier},
+                                 parsers={'apple': AParser()}, config=CONFIG)
+
+
+def apple_notification(notification_type: str, password: str = 'secret', bid: str = 'com.company.myapp') -> dict:
+    return {
+        'notification_type': notification_type,
+        'password': password,
+        'bid': bid,
+        'environment': 'PROD',
+        'unified_receipt': {
+            'status': 0,
+            'environment': 'Production',
+            'latest_receipt': 'receipt',
+            'latest_receipt_info': [
+                {'product_id': 'com.product', 'transaction_id': '2', 'expires_date_ms': '1600000000000'},
+                {'product_id': 'com.product', 'transaction_id': '1', 'expires_date_ms': '1500000000000'},
+            ],
+            'pending_renewal_info': [{'product_id': 'com.product', 'auto_renew_status': '0'}],
+        },
+    }
+
+
+def google_message(message_id: str, purchase_token: str = 'token', notification: dict = None) -> bytes:
+    notification = notification or {'subscriptionNotification': {
+        'version': '1.0', 'notificationType': 3, 'purchaseToken': purchase_token, 'subscriptionId': 'com.product'}}
+    data = dict(notification, version='1.0', packageName='com.company.myapp', eventTimeMillis='1600000000000')
+    return json.dumps({'message': {'messageId': message_id,
+                                   'data': base64.b64encode(json.dumps(data).encode()).decode()},
+                       'subscription': 'projects/myproject/subscriptions/mysubscription'}).encode()
+
+
+def test_apple_notifications_are_parsed_without_request():
+    pipeline = NotificationPipeline(make_controller(SubscriptionsBasicController, FakeGoogleVerifier()))
+    updates = list(pipeline.process([
+        ('apple', apple_notification('DID_CHANGE_RENEWAL_STATUS')),
+        # redelivery
+        ('apple', json.dumps(apple_notification('DID_CHANGE_RENEWAL_STATUS'))),
+        ('apple', apple_notification('CANCEL', password='wrong')),
+        ('apple', apple_notification('CANCEL', bid='com.other.app')),
+    ]))
+    assert len(updates) == 3
+    assert updates[0].notification.notification_type == 'DID_CHANGE_RENEWAL_STATUS'
+    assert updates[0].subscription_info.purchase_token == '2'
+    assert updates[0].subscription_info.is_renewable is False
+    assert not updates[0].verified_with_provider
+    assert isinstance(updates[1].error, VerificationFailed)
+    assert isinstance(updates[2].error, VerificationFailed)
+    assert pipeline.stats() == {'received_total': 4, 'duplicates_total': 1, 'parsed_total': 1,
+                                'verified_total': 0, 'failed_total': 2}
+
+
+def test_apple_notification_without_shared_secret_is_verified_with_app_store():
+    config = AppleVerifierConfig(bundle_id='com.company.myapp', extra=AppleExtraArgs())
+    notification = decode_notification(apple_notification('DID_RENEW', password=''), config)
+    # forged latest_receipt_info can't be told from real one
+    assert notification.provider_response is None
+    assert notification.receipt == 'receipt'
+
+def test_google_notifications_about_same_purchase_share_request():
+    verifier = FakeGoogleVerifier()
+    pipeline = NotificationPipeline(make_controller(SubscriptionsBasicController, verifier), batch_size=10)
+    updates = list(pipeline.process([
+        ('google', google_message('1')),
+        ('google', google_message('2')),
+        ('google', google_message('1')),
+        ('google', google_message('3', notification={'testNotification': {'version': '1.0'}})),
+    ]))
+    assert len(verifier.receipts) == 1
+    assert sorted(update.notification.notification_id for update in updates) == ['1', '2', '3']
+    subscription_updates = [update for update in updates if update.subscription_info]
+    assert len(subscription_updates) == 2
+    assert all(update.verified_with_provider for update in subscription_updates)
+    assert subscription_updates[0].notification.notification_type == 'SUBSCRIPTION_CANCELED'
+    assert pipeline.duplicates == 1
+
+
+def test_failed_notification_is_processed_again_on_redelivery():
+    verifier = FakeGoogleVerifier()
+    pipeline = NotificationPipeline(make_controller(SubscriptionsBasicController, verifier))
+    first = list(pipeline.process([('google', google_message('1', purchase_token='bad-token'))]))
+    second = list(pipeline.process([('google', google_message('1', purchase_token='bad-token'))]))
+    assert isinstance(first[0].error, VerificationFailed)
+    assert isinstance(second[0].error, VerificationFailed)
+    assert len(verifier.receipts) == 2
+    assert pipeline.duplicates == 0
+
+
+def test_async_pipeline():
+    async def notifications():
+        for i in range(5):
+            yield 'google', google_message(str(i), purchase_token='token-{}'.format(i % 2))
+
+    async def run():
+        verifier = FakeAsyncGoogleVerifier()
+        pipeline = NotificationPipeline(make_controller(AsyncSubscriptionsController, verifier), batch_size=4)
+        updates = [update async for update in pipeline.aprocess(notifications())]
+        assert len(updates) == 5
+        assert all(update.is_processed for update in updates)
+        # two tokens in first batch and one in second
+        assert len(verifier.receipts) == 3
+
+    asyncio.run(run())
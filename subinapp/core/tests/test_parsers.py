@@ -68,3 +68,34 @@ def test_apple_parser_with_correct_data():
     assert result.purchase_token == '48903258904286209385'
     assert result.is_renewable is True
     assert result.product_id == 'com.product.new'
+
+
+def test_apple_parser_does_not_change_response():
+    data = {
+        'latest_receipt_info': [
+            {'expires_date_ms': '1500000000000', 'product_id': 'com.product.old', 'transaction_id': '1'},
+            {'expires_date_ms': '1600000000000', 'product_id': 'com.product.new', 'transaction_id': '2'},
+            {'expires_date_ms': '1550000000000', 'product_id': 'com.product.old', 'transaction_id': '3'},
+        ],
+        'pending_renewal_info': [
+            {'product_id': 'com.product.new', 'auto_renew_status': '0'},
+        ]
+    }
+    parser: BaseParser = AParser()
+    result: VerifiedSubscriptionInfo = parser.parse(data)
+    assert result.purchase_token == '2'
+    assert result.is_renewable is False
+    assert result.expiration_date == datetime.fromtimestamp(1600000000)
+    assert 'last_receipt' not in data
+    assert [x['transaction_id'] for x in data['latest_receipt_info']] == ['1', '2', '3']
+
+
+def test_apple_parser_with_empty_history():
+    parser: BaseParser = AParser()
+    try:
+        parser.parse({'latest_receipt_info': []})
+    except ParsingFailed:
+        pass
+    else:
+        # exception should be raised
+        assert False
@@ -0,0 +1,93 @@
+import json
+import math
+from concurrent.futures import ThreadPoolExecutor
+
+from subinapp.core.providers.apple import Parser as AParser
+from subinapp.core.providers.google import Parser as GParser
+from subinapp.core.reparse import reparse, parse_batch, _read_archive, _write_columns
+from subinapp.interface.utils import dump_json
+
+START_MS = 1600000000000
+DAY_MS = 24 * 3600 * 1000
+
+
+def apple_response(index: int) -> bytes:
+    return dump_json({
+        'status': 0,
+        'latest_receipt_info': [
+            {'product_id': 'com.product.monthly', 'transaction_id': str(2000 + index + renewal),
+             'expires_date_ms': str(START_MS + (index + renewal) * DAY_MS)}
+            for renewal in (1, 0, 2)
+        ],
+        'pending_renewal_info': [{'product_id': 'com.product.monthly', 'auto_renew_status': str(index % 2)}],
+    })
+
+
+def google_response(index: int) -> bytes:
+    return dump_json({'productId': 'com.product.yearly', 'purchaseToken': 'token-{}'.format(index),
+                      'expiryTimeMillis': START_MS + index * DAY_MS + 999, 'autoRenewing': True})
+
+
+def archive(size: int) -> list:
+    items = []
+    for index in range(size):
+        if index % 10 == 7:
+            items.append(('apple', b'{"status": 0}'))
+        elif index % 10 == 8:
+            items.append(('google', b'not json'))
+        else:
+            items.append(('apple', apple_response(index)) if index % 2 else ('google', google_response(index)))
+    return items
+
+
+def test_columns_match_parsers():
+    items = archive(25)
+    batches = list(reparse(items, workers=0, batch_size=10))
+    assert [(batch.offset, len(batch)) for batch in batches] == [(0, 10), (10, 10), (20, 5)]
+
+    parsers = {'apple': AParser(), 'google': GParser()}
+    for batch in batches:
+        for position in range(len(batch)):
+            provider, response = items[batch.offset + position]
+            assert batch.providers[batch.provider_codes[position]] == provider
+            if (batch.offset + position) % 10 in (7, 8):
+                assert batch.subscription_info(position) is None
+                assert math.isnan(batch.expiration[position])
+                assert batch.products[batch.product_codes[position]] is None
+            else:
+                assert batch.subscription_info(position) == parsers[provider].parse(json.loads(response))
+    assert batches[0].errors[8].startswith('JSONDecodeError')
+    assert batches[0].errors[7].startswith('ParsingFailed')
+    # product ids are dictionary encoded
+    assert set(batches[0].products) == {'com.product.monthly', 'com.product.yearly', None}
+
+
+def snapshot(batches) -> list:
+    # nan isn't equal to itself, so expiration is compared by bytes
+    return [dict(vars(batch), expiration=batch.expiration.tobytes()) for batch in batches]
+
+
+def test_batches_are_parsed_in_pool_in_order():
+    items = archive(100)
+    expected = snapshot(reparse(items, workers=0, batch_size=7))
+    assert snapshot(reparse(iter(items), workers=2, batch_size=7, max_pending=3)) == expected
+    with ThreadPoolExecutor(2) as executor:
+        assert snapshot(reparse(iter(items), batch_size=7, executor=executor)) == expected
+    assert list(reparse([], workers=2)) == []
+
+
+def test_archive_is_written_by_columns(tmp_path):
+    path = tmp_path / 'responses.tsv'
+    with open(str(path), 'wb') as f:
+        for provider, response in archive(12):
+            f.write(provider.encode('ascii') + b'\t' + response + b'\n')
+    assert list(_read_archive(str(path))) == archive(12)
+
+    output = str(tmp_path / 'columns.jsonl')
+    assert _write_columns(reparse(_read_archive(str(path)), workers=0, batch_size=5), output) == (12, 2)
+    with open(output) as f:
+        columns = [json.loads(line) for line in f]
+    assert [batch['offset'] for batch in columns] == [0, 5, 10]
+    assert columns[1]['expiration'][2:4] == [None, None]
+    assert columns[1]['purchase_token'][:2] == ['2007', 'token-6']
+    assert columns[0]['expiration'][0] == parse_batch(archive(1)).expiration[0] == (START_MS + 999) // 1000
@@ -0,0 +1,248 @@
+import asyncio
+import json
+import os
+import threading
+import time
+from collections import namedtuple
+
+import httplib2
+import pytest
+from googleapiclient.errors import HttpError
+
+from subinapp.core.controllers import SubscriptionsBasicController
+from subinapp.core.metrics import InMemoryHistogramSink, render_prometheus
+from subinapp.core.providers import google
+from subinapp.core.providers.apple import PooledAppStoreValidator
+from subinapp.core.resilience import Hedger, CLOSED, OPEN
+from subinapp.core.tests.stubs import StubServer
+from subinapp.core.tokens import GoogleTokenManager
+from subinapp.interface.entities import SubscriptionManagerConfig, AppleVerifierConfig, AppleExtraArgs, \
+    GoogleVerifierConfig, HedgePolicy, CircuitBreakerPolicy, RateLimit
+from subinapp.interface.exceptions import ProviderUnavailable, CircuitOpen, VerificationFailed, ProviderThrottled
+
+KEY_PATH = os.path.join(os.path.dirname(__file__), 'keyfile.json')
+RESPONSE = {
+    'status': 0,
+    'environment': 'Production',
+    'latest_receipt_info': [{'product_id': 'com.product', 'transaction_id': '1', 'original_transaction_id': '1',
+                             'expires_date_ms': '4102444800000'}],
+    'pending_renewal_info': [{'product_id': 'com.product', 'auto_renew_status': '1'}],
+}
+
+
+class Upstream:
+    """Handler of App Store stub with switchable failures and slow failing first request"""
+
+    def __init__(self, slow_first: float = 0):
+        self.slow_first = slow_first
+        self.failing = False
+        self.requests = 0
+        self._lock = threading.Lock()
+
+    def __call__(self, method, path, body):
+        with self._lock:
+            self.requests += 1
+            first = self.requests == 1
+        if first and self.slow_first:
+            time.sleep(self.slow_first)
+            return 200, {'status': 21005}
+        if self.failing:
+            return 500, {}
+        if json.loads(body)['receipt-data'] == 'bad':
+            return 200, {'status': 21002}
+        return 200, RESPONSE
+
+
+def make_controller(monkeypatch, server: StubServer, **kwargs):
+    monkeypatch.setattr(PooledAppStoreValidator, 'production_url', server.url + '/production')
+
+    class Controller(SubscriptionsBasicController):
+        pass
+
+    config = AppleVerifierConfig(bundle_id='com.company.myapp', extra=AppleExtraArgs(learn_environment=False))
+    sink = InMemoryHistogramSink()
+    Controller.configure(SubscriptionManagerConfig(apple=config, google=None), metrics_sinks=[sink], **kwargs)
+    return Controller, sink
+
+
+def test_slow_request_is_hedged(monkeypatch):
+    upstream = Upstream(slow_first=2)
+    with StubServer(upstream) as server:
+        controller, sink = make_controller(monkeypatch, server,
+                                           hedging={'apple': HedgePolicy(max_delay=0.1, max_ratio=1)})
+        started = time.monotonic()
+        assert controller.verify_receipt('apple', 'receipt').subscription_info.product_id == 'com.product'
+        assert time.monotonic() - started < 1
+        controller.verify_receipt('apple', 'another')
+    stats = controller.hedgers['apple'].stats()
+    assert (stats['requests_total'], stats['hedged_total'], stats['hedge_won_total']) == (2, 1, 1)
+    assert sink.counters[('apple', 'hedged')] == sink.counters[('apple', 'hedge_won')] == 1
+
+
+def test_failed_hedge_is_counted_by_circuit_breaker(monkeypatch):
+    upstream = Upstream(slow_first=0.3)
+    upstream.failing = True
+    with StubServer(upstream) as server:
+        controller, _ = make_controller(monkeypatch, server,
+                                        hedging={'apple': HedgePolicy(max_delay=0.1, max_ratio=1)},
+                                        circuit_breakers={'apple': CircuitBreakerPolicy(failure_threshold=2)})
+        with pytest.raises(ProviderUnavailable):
+            controller.verify_receipt('apple', 'receipt')
+    assert controller.hedgers['apple'].stats()['hedged_total'] == 1
+    assert controller.breakers['apple'].state == OPEN
+
+
+def test_hedge_isnt_sent_without_token_of_rate_limit(monkeypatch):
+    upstream = Upstream(slow_first=0.3)
+    with StubServer(upstream) as server:
+        controller, _ = make_controller(monkeypatch, server, rate_limits={'apple': RateLimit(rate=1, burst=1)},
+                                        hedging={'apple': HedgePolicy(max_delay=0.1, max_ratio=1)})
+        with pytest.raises(ProviderUnavailable):
+            controller.verify_receipt('apple', 'receipt')
+    assert upstream.requests == 1
+    assert controller.hedgers['apple'].stats()['hedged_total'] == 0
+    assert controller.schedulers['apple'].stats()['admitted_total'] == 1
+
+
+def test_hedge_answer_is_returned_before_slow_request():
+    hedger = Hedger('apple', HedgePolicy(max_delay=0.1, max_ratio=1))
+    calls = []
+
+    def request(receipt):
+        calls.append(receipt)
+        time.sleep(2 if len(calls) == 1 else 0.01)
+        return {'receipt': receipt, 'call': len(calls)}
+
+    started = time.monotonic()
+    assert hedger.call(request, 'receipt') == {'receipt': 'receipt', 'call': 2}
+    # answer of hedge is taken at about hedge delay, slow request is left in its thread
+    assert time.monotonic() - started < 0.5
+    assert hedger.stats()['hedge_won_total'] == 1
+
+
+def test_hedge_delay_follows_percentile_of_latencies():
+    hedger = Hedger('apple', HedgePolicy(percentile=0.9, min_delay=0.05, max_delay=1, window=100))
+    assert hedger.delay() == 1
+    for i in range(100):
+        hedger.observe(0.1 if i % 10 else 0.5)
+    assert hedger.delay() == 0.5
+    for i in range(100):
+        hedger.observe(0.01)
+    assert hedger.delay() == 0.05
+
+
+def test_async_hedge_cancels_slower_request():
+    hedger = Hedger('apple', HedgePolicy(max_delay=0.05, max_ratio=1))
+    calls = []
+
+    async def request(receipt):
+        calls.append(receipt)
+        try:
+            await asyncio.sleep(10 if len(calls) == 1 else 0.01)
+        except asyncio.CancelledError:
+            calls.append('cancelled')
+            raise
+        return {'receipt': receipt}
+
+    async def run():
+        result = await hedger.acall(request, 'receipt')
+        await asyncio.sleep(0)
+        return result
+
+    assert asyncio.run(run()) == {'receipt': 'receipt'}
+    assert calls == ['receipt', 'receipt', 'cancelled']
+    assert hedger.stats()['hedge_won_total'] == 1
+
+
+def test_circuit_breaker_fails_fast_and_serves_last_known_result(monkeypatch):
+    upstream = Upstream()
+    with StubServer(upstream) as server:
+        controller, sink = make_controller(monkeypatch, server, circuit_breakers={
+            'apple': CircuitBreakerPolicy(failure_threshold=2, open_seconds=0.2)})
+        breaker = controller.breakers['apple']
+        known = controller.verify_receipt('apple', 'receipt')
+        # bad receipt is answer of healthy provider
+        with pytest.raises(VerificationFailed):
+            controller.verify_receipt('apple', 'bad')
+
+        upstream.failing = True
+        with pytest.raises(ProviderUnavailable):
+            controller.verify_receipt('apple', 'other')
+        stale = controller.verify_receipt('apple', 'receipt')
+        assert stale == known and stale.is_stale and not known.is_stale
+        assert breaker.state == OPEN
+        requests = upstream.requests
+        with pytest.raises(CircuitOpen):
+            controller.verify_receipt('apple', 'other')
+        stale = controller.verify_receipt('apple', 'receipt')
+        assert stale == known and stale.is_stale and not known.is_stale
+        assert upstream.requests == requests
+        assert 'subinapp_circuit_breaker_state{provider="apple"} 2' in render_prometheus(sink, breakers=[breaker])
+
+        upstream.failing = False
+        time.sleep(0.2)
+        controller.verify_receipt('apple', 'other')
+        assert breaker.state == CLOSED
+    assert breaker.stats()['opened_total'] == 1
+    assert breaker.stats()['served_stale_total'] == 2
+    assert sink.counters[('apple', 'breaker_open')] == 1
+    assert sink.counters[('apple', 'breaker_half_open')] == 1
+    assert sink.counters[('apple', 'breaker_closed')] == 1
+    assert sink.counters[('apple', 'breaker_rejected')] == 2
+    assert sink.counters[('apple', 'provider_unavailable')] == 2
+
+
+def test_client_errors_of_google_dont_open_breaker():
+    class Controller(SubscriptionsBasicController):
+        pass
+
+    config = GoogleVerifierConfig(bundle_id='com.company.myapp', private_key_path=KEY_PATH)
+    Controller.configure(SubscriptionManagerConfig(apple=None, google=config), lazy=True,
+                         circuit_breakers={'google': CircuitBreakerPolicy(failure_threshold=2)})
+    token_manager = GoogleTokenManager(KEY_PATH, fetch_token=lambda: ('token', 3600))
+    verifier = google.Verifier(Controller.config, token_manager=token_manager)
+
+    def gone(*args, **kwargs):
+        raise HttpError(httplib2.Response({'status': 410}), b'{}')
+
+    verifier.verifier.verify_with_result = gone
+    Controller.verifiers = namedtuple('Verifiers', ['google'])(google=verifier)
+    receipt = json.dumps({'purchaseToken': 'token', 'productId': 'com.product'})
+    for _ in range(5):
+        with pytest.raises(VerificationFailed) as error:
+            Controller.verify_receipt('google', receipt)
+        assert not isinstance(error.value, ProviderUnavailable)
+    assert Controller.breakers['google'].state == CLOSED
+
+
+def test_unavailable_google_opens_breaker_unless_it_throttles():
+    class Controller(SubscriptionsBasicController):
+        pass
+
+    config = GoogleVerifierConfig(bundle_id='com.company.myapp', private_key_path=KEY_PATH)
+    Controller.configure(SubscriptionManagerConfig(apple=None, google=config), lazy=True,
+                         circuit_breakers={'google': CircuitBreakerPolicy(failure_threshold=2)})
+    token_manager = GoogleTokenManager(KEY_PATH, fetch_token=lambda: ('token', 3600))
+    verifier = google.Verifier(Controller.config, token_manager=token_manager)
+    headers = {'status': 503}
+
+    def unavailable(*args, **kwargs):
+        raise HttpError(httplib2.Response(headers), b'{}')
+
+    verifier.verifier.verify_with_result = unavailable
+    Controller.verifiers = namedtuple('Verifiers', ['google'])(google=verifier)
+    receipt = json.dumps({'purchaseToken': 'token', 'productId': 'com.product'})
+    headers['retry-after'] = '1'
+    for _ in range(3):
+        with pytest.raises(ProviderThrottled):
+            Controller.verify_receipt('google', receipt)
+    assert Controller.breakers['google'].state == CLOSED
+
+    del headers['retry-after']
+    for _ in range(2):
+        with pytest.raises(ProviderUnavailable) as error:
+            Controller.verify_receipt('google', receipt)
+        assert not isinstance(error.value, CircuitOpen)
+    assert Controller.breakers['google'].state == OPEN
+    with pytest.raises(CircuitOpen):
+        Controller.verify_receipt('google', receipt)
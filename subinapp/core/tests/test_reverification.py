@@ -0,0 +1,136 @@
+import asyncio
+from datetime import datetime
+
+from subinapp.core.cache import InMemoryCache
+from subinapp.core.controllers import SubscriptionsBasicController, AsyncSubscriptionsController
+from subinapp.core.resilience import CircuitBreaker
+from subinapp.core.reverification import ReverificationScheduler, FileCheckpointStore
+from subinapp.core.tests import stubs
+from subinapp.core.tests.stubs import google_response
+from subinapp.interface.entities import StoredSubscription, VerifiedSubscriptionInfo, ReverificationCheckpoint, \
+    CircuitBreakerPolicy
+from subinapp.interface.exceptions import VerificationFailed, ProviderUnavailable
+
+NOW = 1600000000
+HOUR = 3600
+
+
+class RenewingVerifier:
+    """Subscriptions with even tokens are renewed for a month"""
+    metrics = None
+
+    def __init__(self):
+        self.receipts = []
+
+    def verify(self, receipt):
+        self.receipts.append(receipt)
+        if receipt == 'bad':
+            raise VerificationFailed('Bad receipt')
+        expiration = int(receipt) * HOUR + NOW
+        if int(receipt) % 2 == 0:
+            expiration += 30 * 24 * HOUR
+        return google_response(receipt, expiration_ms=expiration * 1000)
+
+
+class AsyncRenewingVerifier(RenewingVerifier):
+    async def verify(self, receipt):
+        return super(AsyncRenewingVerifier, self).verify(receipt)
+
+
+def make_controller(controller_class, verifier):
+    return stubs.make_controller(controller_class, {'google': verifier})
+
+
+def stored(hours_to_expiration: int, receipt: str = None) -> StoredSubscription:
+    receipt = receipt or str(hours_to_expiration)
+    return StoredSubscription(provider='google', receipt=receipt, subscription_info=VerifiedSubscriptionInfo(
+        product_id='com.product', purchase_token=receipt,
+        expiration_date=datetime.fromtimestamp(NOW + hours_to_expiration * HOUR), is_renewable=True))
+
+
+SUBSCRIPTIONS = [stored(hours) for hours in (20, -100, 5, 500, -3, 1, 24)]
+
+
+def test_subscriptions_in_window_are_verified_by_expiration():
+    verifier = RenewingVerifier()
+    scheduler = ReverificationScheduler(make_controller(SubscriptionsBasicController, verifier), concurrency=1)
+    results = list(scheduler.sweep(iter(SUBSCRIPTIONS), now=NOW))
+    assert verifier.receipts == ['-3', '1', '5', '20', '24']
+    assert [result.is_changed for result in results] == [False, False, False, True, True]
+    assert scheduler.stats() == {'scanned_total': 7, 'skipped_total': 2, 'resumed_total': 0, 'changed_total': 2}
+    assert scheduler.checkpoints.load() is None
+
+
+def test_interrupted_sweep_is_resumed():
+    verifier = RenewingVerifier()
+    scheduler = ReverificationScheduler(make_controller(SubscriptionsBasicController, verifier), checkpoint_every=1,
+                                        concurrency=1)
+    sweep = scheduler.sweep(SUBSCRIPTIONS + [stored(2, 'bad')], now=NOW)
+    assert next(sweep).stored.receipt == '-3'
+    assert next(sweep).stored.receipt == '1'
+    # result of '1' isn't confirmed by next call, so it is verified again
+    sweep.close()
+    assert scheduler.checkpoints.load().verified == 1
+
+    verifier.receipts = []
+    results = list(scheduler.sweep(reversed(SUBSCRIPTIONS + [stored(2, 'bad')]), now=NOW + HOUR))
+    assert verifier.receipts == ['1', 'bad', '5', '20', '24']
+    assert isinstance(results[1].error, VerificationFailed)
+    assert not results[1].is_changed
+    assert scheduler.resumed == 1
+    assert scheduler.checkpoints.load() is None
+
+
+def test_outdated_checkpoint_is_ignored(tmp_path):
+    checkpoints = FileCheckpointStore(str(tmp_path / 'checkpoint.json'))
+    checkpoints.save(ReverificationCheckpoint(started_at=NOW - 48 * HOUR, expiration=NOW + 10 * HOUR,
+                                              provider='google', purchase_token='10', verified=10))
+    assert checkpoints.load().verified == 10
+    verifier = RenewingVerifier()
+    scheduler = ReverificationScheduler(make_controller(SubscriptionsBasicController, verifier), checkpoints)
+    list(scheduler.sweep(SUBSCRIPTIONS, now=NOW))
+    assert len(verifier.receipts) == 5
+    assert checkpoints.load() is None
+
+
+def test_cached_and_last_known_results_are_not_reverification():
+    class UnstableVerifier(RenewingVerifier):
+        failing = False
+
+        def verify(self, receipt):
+            self.receipts.append(receipt)
+            if self.failing:
+                raise ProviderUnavailable('Google is unavailable')
+            # far from expiration, so result is cached
+            return google_response(receipt, expiration_ms=4102444800000)
+
+    verifier = UnstableVerifier()
+    controller = make_controller(SubscriptionsBasicController, verifier)
+    controller.cache = InMemoryCache()
+    controller.breakers = {'google': CircuitBreaker('google', CircuitBreakerPolicy(failure_threshold=1))}
+    controller.verify_receipt('google', '1')
+    assert controller.verify_receipt('google', '1').subscription_info.purchase_token == '1'
+    scheduler = ReverificationScheduler(controller)
+    assert [result.is_verified for result in scheduler.sweep([stored(1)], now=NOW)] == [True]
+    assert verifier.receipts == ['1', '1']
+
+    verifier.failing = True
+    results = list(scheduler.sweep([stored(1)], now=NOW))
+    assert verifier.receipts == ['1', '1', '1']
+    assert isinstance(results[0].error, ProviderUnavailable)
+    assert results[0].processed_receipt is None and not results[0].is_changed
+
+
+def test_async_sweep():
+    async def subscriptions():
+        for subscription in SUBSCRIPTIONS:
+            yield subscription
+
+    async def run():
+        verifier = AsyncRenewingVerifier()
+        scheduler = ReverificationScheduler(make_controller(AsyncSubscriptionsController, verifier),
+                                            before_expiration=10 * HOUR, after_expiration=0)
+        results = [result async for result in scheduler.asweep(subscriptions(), now=NOW)]
+        assert [result.stored.receipt for result in results] == ['1', '5']
+
+    asyncio.run(run())
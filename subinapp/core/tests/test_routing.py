@@ -0,0 +1,59 @@
+from subinapp.core.providers.apple import Verifier as AVerifier
+from subinapp.core.routing import EnvironmentRouter, SANDBOX, PRODUCTION
+from subinapp.core.tests.stubs import StubServer
+from subinapp.interface.entities import SubscriptionManagerConfig, AppleVerifierConfig, AppleExtraArgs
+
+SANDBOX_RESPONSE = {
+    'status': 0,
+    'environment': 'Sandbox',
+    'receipt': {'bundle_id': 'com.company.myapp', 'application_version': '42'},
+    'latest_receipt_info': [{'original_transaction_id': '1000000001'}],
+}
+
+
+def sandbox_handler(method, path, body):
+    if path == '/production':
+        return 200, {'status': 21007}
+    return 200, SANDBOX_RESPONSE
+
+
+def make_verifier(url: str, router: EnvironmentRouter = None) -> AVerifier:
+    config = AppleVerifierConfig(bundle_id='com.company.myapp', extra=AppleExtraArgs())
+    verifier = AVerifier(SubscriptionManagerConfig(apple=config, google=None), router=router)
+    verifier.verifier.production_url = url + '/production'
+    verifier.verifier.sandbox_url = url + '/sandbox'
+    return verifier
+
+
+def test_apple_verifier_learns_environment_of_receipt():
+    with StubServer(sandbox_handler) as server:
+        verifier = make_verifier(server.url)
+        assert verifier.verify('sandbox-receipt') == SANDBOX_RESPONSE
+        assert server.requests_count == 2
+        assert verifier.verify('sandbox-receipt') == SANDBOX_RESPONSE
+        assert server.requests_count == 3
+        # unknown receipt goes to production first
+        verifier.verify('another-receipt')
+        assert server.requests_count == 5
+    assert verifier.router.stats()['hits_total'] == 1
+
+
+def test_apple_verifier_routes_by_learned_transaction():
+    # e.g. keys of decoded receipt
+    router = EnvironmentRouter(key_extractor=lambda receipt: ['original_transaction:{}'.format(receipt.split(':')[0])])
+    with StubServer(sandbox_handler) as server:
+        verifier = make_verifier(server.url, router=router)
+        verifier.verify('1000000001:first')
+        assert server.requests_count == 2
+        verifier.verify('1000000001:renewed')
+        assert server.requests_count == 3
+
+
+def test_router_evicts_least_recently_used_keys():
+    router = EnvironmentRouter(max_size=2)
+    router.remember(['a'], SANDBOX)
+    router.remember(['b'], PRODUCTION)
+    assert router.lookup(['a']) == SANDBOX
+    router.remember(['c'], PRODUCTION)
+    assert router.lookup(['b']) is None
+    assert router.lookup(['x', 'a']) == SANDBOX
@@ -0,0 +1,123 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+from subinapp.core.controllers import SubscriptionsBasicController
+from subinapp.core.metrics import Metrics, InMemoryHistogramSink
+from subinapp.core.scheduling import ProviderScheduler, AsyncProviderScheduler, INTERACTIVE, BACKGROUND, \
+    retry_after_seconds
+from subinapp.core.tests.stubs import make_controller
+from subinapp.interface.entities import RateLimit
+from subinapp.interface.exceptions import RateLimitExceeded, ProviderThrottled
+
+
+def test_requests_are_paced_by_rate():
+    scheduler = ProviderScheduler('google', RateLimit(rate=50, burst=2))
+    started = time.monotonic()
+    for _ in range(6):
+        scheduler.acquire()
+    # two requests are sent at once, others are paced
+    assert 0.07 < time.monotonic() - started < 0.5
+    assert scheduler.stats()['admitted_total'] == 6
+
+
+def test_interactive_requests_go_first():
+    scheduler = ProviderScheduler('google', RateLimit(rate=10, burst=1))
+    scheduler.acquire()
+    order = []
+
+    def acquire(priority, name):
+        scheduler.acquire(priority)
+        order.append(name)
+
+    threads = [threading.Thread(target=acquire, args=(BACKGROUND, 'background'))]
+    threads[0].start()
+    time.sleep(0.02)
+    threads.append(threading.Thread(target=acquire, args=(INTERACTIVE, 'interactive')))
+    threads[1].start()
+    for thread in threads:
+        thread.join(5)
+    assert order == ['interactive', 'background']
+
+
+def test_requests_are_rejected_fast():
+    scheduler = ProviderScheduler('google', RateLimit(rate=1, burst=1, max_wait=0.5))
+    scheduler.acquire()
+    started = time.monotonic()
+    with pytest.raises(RateLimitExceeded):
+        # next token is in one second
+        scheduler.acquire()
+    assert time.monotonic() - started < 0.1
+
+    scheduler = ProviderScheduler('google', RateLimit(rate=5, burst=1, max_queue=1))
+    scheduler.acquire()
+    waiting = threading.Thread(target=scheduler.acquire)
+    waiting.start()
+    time.sleep(0.02)
+    with pytest.raises(RateLimitExceeded):
+        scheduler.acquire()
+    waiting.join(5)
+    assert scheduler.stats()['rejected_total'] == 1
+
+
+def test_throttling_slows_down_requests():
+    scheduler = ProviderScheduler('google', RateLimit(rate=100, burst=10, min_rate=10))
+    with pytest.raises(ProviderThrottled):
+        with scheduler.slot():
+            raise ProviderThrottled('Too many requests', retry_after=0.2)
+    assert scheduler.rate == 50
+    assert scheduler.stats()['paused_seconds'] > 0.1
+    started = time.monotonic()
+    with scheduler.slot():
+        pass
+    assert time.monotonic() - started > 0.15
+    assert scheduler.rate == 51
+
+
+def test_async_scheduler_orders_by_priority():
+    async def run():
+        scheduler = AsyncProviderScheduler('apple', RateLimit(rate=20, burst=1))
+        await scheduler.acquire()
+        order = []
+
+        async def acquire(priority, name):
+            await scheduler.acquire(priority)
+            order.append(name)
+
+        background = asyncio.ensure_future(acquire(BACKGROUND, 'background'))
+        await asyncio.sleep(0.01)
+        await asyncio.gather(acquire(INTERACTIVE, 'interactive'), background)
+        assert order == ['interactive', 'background']
+
+    asyncio.run(run())
+
+
+class ThrottledVerifier:
+    metrics = None
+
+    def verify(self, receipt):
+        raise ProviderThrottled('Google Play responded with status %s', 429, retry_after=1)
+
+
+def test_controller_reports_throttling():
+    sink = InMemoryHistogramSink()
+    Controller = make_controller(SubscriptionsBasicController, {'google': ThrottledVerifier()}, metrics=Metrics([sink]))
+    scheduler = ProviderScheduler('google', RateLimit(rate=10))
+    scheduler.metrics = Controller.metrics
+    Controller.schedulers = {'google': scheduler}
+
+    with pytest.raises(ProviderThrottled):
+        Controller.verify_receipt('google', 'receipt')
+    assert scheduler.stats()['throttled_total'] == 1
+    assert sink.counters[('google', 'throttled')] == 1
+    assert sink.counters[('google', 'rate_limited')] == 1
+    assert sink.durations[('google', 'queue')].count == 1
+
+
+def test_retry_after_header():
+    assert retry_after_seconds('120') == 120
+    assert retry_after_seconds(None) is None
+    assert retry_after_seconds('Wed, 21 Oct 2015 07:28:00 GMT') == 0
+    assert retry_after_seconds('soon') is None
@@ -0,0 +1,56 @@
+import json
+from datetime import datetime
+
+from subinapp.interface.entities import ProcessedReceipt, VerifiedSubscriptionInfo, SerializationOptions, \
+    ProviderResponse
+from subinapp.interface.utils import project_fields
+
+INFO = VerifiedSubscriptionInfo(product_id='com.product', purchase_token='token',
+                                expiration_date=datetime.now(), is_renewable=True)
+APPLE_RESPONSE = {
+    'status': 0,
+    'receipt': {'bundle_id': 'com.company.myapp', 'in_app': [{'product_id': 'com.product'}]},
+    'latest_receipt_info': [{'product_id': 'com.product', 'transaction_id': '1', 'is_trial_period': 'false'}],
+}
+
+
+def test_processed_receipt_is_serialized_lazily():
+    result = ProcessedReceipt(provider='apple', subscription_info=INFO,
+                              raw_receipt='MIIT0QYJKoZIhvcNAQcCoIITwjCCE74=', raw_provider_response=APPLE_RESPONSE)
+    assert result.__dict__['_receipt'] is None
+    assert result.__dict__['_provider_response'] is None
+    assert json.loads(result.receipt) == 'MIIT0QYJKoZIhvcNAQcCoIITwjCCE74='
+    assert json.loads(result.provider_response) == APPLE_RESPONSE
+    assert result.provider_response is result.provider_response
+    # decoded values aren't kept next to serialized ones
+    assert result.raw_receipt is None and result.raw_provider_response is None
+
+
+def test_processed_receipt_keeps_raw_values():
+    body = json.dumps(APPLE_RESPONSE, indent=2).encode('utf-8')
+    result = ProcessedReceipt(provider='apple', subscription_info=INFO,
+                              raw_receipt='MIIT0QYJ', raw_provider_response=ProviderResponse(APPLE_RESPONSE, raw=body),
+                              serialization=SerializationOptions(keep_raw=True))
+    assert result.receipt == b'MIIT0QYJ'
+    assert result.provider_response is body
+    # explicitly given values are kept
+    assert ProcessedReceipt('google', INFO, b'receipt', b'response').provider_response == b'response'
+
+
+def test_provider_response_projection():
+    options = SerializationOptions(exclude_fields=('receipt.in_app', 'latest_receipt_info.is_trial_period'))
+    assert json.loads(options.serialize_provider_response(APPLE_RESPONSE)) == {
+        'status': 0,
+        'receipt': {'bundle_id': 'com.company.myapp'},
+        'latest_receipt_info': [{'product_id': 'com.product', 'transaction_id': '1'}],
+    }
+    assert project_fields(APPLE_RESPONSE, include=('status', 'latest_receipt_info.transaction_id')) == {
+        'status': 0,
+        'latest_receipt_info': [{'transaction_id': '1'}],
+    }
+    # keys keep order of source, so serialized projection is stable
+    options = SerializationOptions(include_fields=('latest_receipt_info', 'receipt.bundle_id', 'status'))
+    projected = json.loads(options.serialize_provider_response(APPLE_RESPONSE))
+    assert list(projected) == ['status', 'receipt', 'latest_receipt_info']
+    # source is not changed
+    assert 'in_app' in APPLE_RESPONSE['receipt']
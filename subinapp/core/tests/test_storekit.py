@@ -0,0 +1,161 @@
+import base64
+import datetime
+import json
+import time
+
+import pytest
+from cryptography import x509
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import ec
+from cryptography.hazmat.primitives.asymmetric.utils import decode_dss_signature
+from cryptography.x509.oid import NameOID
+
+from subinapp.core.controllers import SubscriptionsBasicController
+from subinapp.core.notifications import NotificationPipeline
+from subinapp.core.providers.storekit import APPLE_LEAF_OID, APPLE_INTERMEDIATE_OID
+from subinapp.interface.entities import SubscriptionManagerConfig, StoreKitVerifierConfig
+from subinapp.interface.exceptions import VerificationFailed
+
+NOW_MS = int(time.time() * 1000)
+
+
+def make_certificate(name: str, key, issuer_name: str, issuer_key, ca: bool, oid=None) -> x509.Certificate:
+    now = datetime.datetime.now(datetime.timezone.utc)
+    builder = (
+        x509.CertificateBuilder()
+        .subject_name(x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, name)]))
+        .issuer_name(x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, issuer_name)]))
+        .public_key(key.public_key())
+        .serial_number(x509.random_serial_number())
+        .not_valid_before(now - datetime.timedelta(days=1))
+        .not_valid_after(now + datetime.timedelta(days=1))
+        .add_extension(x509.BasicConstraints(ca=ca, path_length=None), critical=True)
+    )
+    if oid is not None:
+        builder = builder.add_extension(x509.UnrecognizedExtension(oid, b'\x05\x00'), critical=False)
+    return builder.sign(issuer_key, hashes.SHA256())
+
+
+class CertificateAuthority:
+    """Chain of root, intermediate and leaf like App Store signing chain"""
+
+    def __init__(self, directory, name: str = 'Test Root CA'):
+        self.root_key = ec.generate_private_key(ec.SECP256R1())
+        self.root = make_certificate(name, self.root_key, name, self.root_key, ca=True)
+        intermediate_key = ec.generate_private_key(ec.SECP256R1())
+        self.intermediate = make_certificate('Test WWDR', intermediate_key, name, self.root_key, ca=True,
+                                             oid=APPLE_INTERMEDIATE_OID)
+        self.leaf_key = ec.generate_private_key(ec.SECP256R1())
+        self.leaf = make_certificate('Test App Store', self.leaf_key, 'Test WWDR', intermediate_key, ca=False,
+                                     oid=APPLE_LEAF_OID)
+        self.root_path = str(directory / 'root.pem')
+        with open(self.root_path, 'wb') as f:
+            f.write(self.root.public_bytes(serialization.Encoding.PEM))
+
+    def sign(self, payload: dict) -> str:
+        def encode(data: bytes) -> str:
+            return base64.urlsafe_b64encode(data).rstrip(b'=').decode('ascii')
+
+        header = {'alg': 'ES256', 'x5c': [base64.b64encode(certificate.public_bytes(serialization.Encoding.DER))
+                                          .decode('ascii') for certificate in (self.leaf, self.intermediate, self.root)]}
+        signing_input = '{}.{}'.format(encode(json.dumps(header).encode()), encode(json.dumps(payload).encode()))
+        r, s = decode_dss_signature(self.leaf_key.sign(signing_input.encode('ascii'), ec.ECDSA(hashes.SHA256())))
+        return '{}.{}'.format(signing_input, encode(r.to_bytes(32, 'big') + s.to_bytes(32, 'big')))
+
+
+@pytest.fixture(scope='module')
+def authority(tmp_path_factory):
+    return CertificateAuthority(tmp_path_factory.mktemp('storekit'))
+
+
+def transaction(**fields) -> dict:
+    return dict({
+        'transactionId': '2000000001', 'originalTransactionId': '1000000001', 'bundleId': 'com.company.myapp',
+        'productId': 'com.product.monthly', 'type': 'Auto-Renewable Subscription', 'environment': 'Production',
+        'purchaseDate': NOW_MS, 'expiresDate': NOW_MS + 30 * 24 * 3600 * 1000, 'signedDate': NOW_MS,
+    }, **fields)
+
+
+def renewal_info(**fields) -> dict:
+    return dict({'originalTransactionId': '1000000001', 'autoRenewStatus': 1, 'environment': 'Production',
+                 'signedDate': NOW_MS}, **fields)
+
+
+def make_controller(authority: CertificateAuthority, **config):
+    class Controller(SubscriptionsBasicController):
+        pass
+
+    Controller.configure(SubscriptionManagerConfig(apple=None, google=None, storekit=StoreKitVerifierConfig(
+        bundle_id='com.company.myapp', root_certificates=(authority.root_path,), **config)))
+    return Controller
+
+
+def test_signed_transaction_is_verified_locally(authority):
+    controller = make_controller(authority)
+    receipt = json.dumps({'signedTransactionInfo': authority.sign(transaction()),
+                          'signedRenewalInfo': authority.sign(renewal_info())})
+    result = controller.verify_receipt('storekit', receipt)
+    info = result.subscription_info
+    assert info.product_id == 'com.product.monthly'
+    assert info.purchase_token == '2000000001'
+    assert info.is_renewable is True
+    assert info.expiration_date == datetime.datetime.fromtimestamp((NOW_MS + 30 * 24 * 3600 * 1000) / 1000)
+
+    # transaction without renewal info
+    result = controller.verify_receipt('storekit', authority.sign(transaction(transactionId='2000000002')))
+    assert result.subscription_info.is_renewable is False
+    # chain is verified once
+    assert controller.verifiers.storekit.verifier.stats() == {'chain_hits_total': 2, 'chain_misses_total': 1,
+                                                              'chains': 1}
+
+
+def test_invalid_transactions_are_rejected(authority, tmp_path):
+    controller = make_controller(authority, allow_sandbox=False)
+    signed = authority.sign(transaction())
+    header, payload, signature = signed.split('.')
+    forged_payload = base64.urlsafe_b64encode(json.dumps(transaction(expiresDate=NOW_MS * 2)).encode())
+    other_authority = CertificateAuthority(tmp_path, 'Other Root CA')
+    bad_receipts = [
+        'garbage',
+        '{}.{}.{}'.format(header, forged_payload.rstrip(b'=').decode('ascii'), signature),
+        other_authority.sign(transaction()),
+        authority.sign(transaction(bundleId='com.other.app')),
+        authority.sign(transaction(environment='Sandbox')),
+        json.dumps({'signedTransactionInfo': signed,
+                    'signedRenewalInfo': authority.sign(renewal_info(originalTransactionId='1'))}),
+    ]
+    for receipt in bad_receipts:
+        with pytest.raises(VerificationFailed):
+            controller.verify_receipt('storekit', receipt)
+
+
+def test_certificates_without_apple_extensions_are_rejected(authority, tmp_path):
+    other_authority = CertificateAuthority(tmp_path)
+    other_authority.intermediate = authority.root
+    controller = make_controller(authority)
+    with pytest.raises(VerificationFailed):
+        controller.verify_receipt('storekit', other_authority.sign(transaction()))
+
+    controller = make_controller(other_authority, require_apple_extensions=False)
+    other_authority.intermediate = make_certificate('Test WWDR', ec.generate_private_key(ec.SECP256R1()),
+                                                    'Test Root CA', other_authority.root_key, ca=True)
+    with pytest.raises(VerificationFailed):
+        # leaf isn't issued by intermediate
+        controller.verify_receipt('storekit', other_authority.sign(transaction()))
+
+
+def test_signed_notification_is_decoded(authority):
+    controller = make_controller(authority)
+    body = json.dumps({'signedPayload': authority.sign({
+        'notificationType': 'DID_CHANGE_RENEWAL_STATUS', 'subtype': 'AUTO_RENEW_DISABLED',
+        'notificationUUID': '0b1c6a5e-0000-4000-8000-000000000001', 'signedDate': NOW_MS,
+        'data': {'bundleId': 'com.company.myapp', 'environment': 'Production',
+                 'signedTransactionInfo': authority.sign(transaction()),
+                 'signedRenewalInfo': authority.sign(renewal_info(autoRenewStatus=0))},
+    })})
+    pipeline = NotificationPipeline(controller)
+    updates = list(pipeline.process([('storekit', body), ('storekit', body)]))
+    assert len(updates) == 1
+    assert updates[0].notification.notification_type == 'DID_CHANGE_RENEWAL_STATUS.AUTO_RENEW_DISABLED'
+    assert updates[0].subscription_info.is_renewable is False
+    assert not updates[0].verified_with_provider
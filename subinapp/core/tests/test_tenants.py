@@ -0,0 +1,103 @@
+import json
+import os
+
+import pytest
+
+from subinapp.core.cache import InMemoryCache
+from subinapp.core.providers import google
+from subinapp.core.providers.apple import PooledAppStoreValidator
+from subinapp.core.tenants import MultiTenantController
+from subinapp.core.tests.stubs import StubServer
+from subinapp.core.tokens import GoogleTokenManager
+from subinapp.interface.entities import SubscriptionManagerConfig, AppleVerifierConfig, AppleExtraArgs, \
+    GoogleVerifierConfig
+from subinapp.interface.exceptions import UndefinedTenant, UndefinedProvider
+
+KEY_PATH = os.path.join(os.path.dirname(__file__), 'keyfile.json')
+EXPIRES_MS = str(4102444800000)
+
+
+def handler(method, path, body):
+    # product of application is known by its shared secret
+    app = json.loads(body)['password']
+    return 200, {
+        'status': 0,
+        'environment': 'Production',
+        'latest_receipt_info': [{'product_id': '{}.monthly'.format(app), 'transaction_id': '1',
+                                 'original_transaction_id': '1', 'expires_date_ms': EXPIRES_MS}],
+        'pending_renewal_info': [{'product_id': '{}.monthly'.format(app), 'auto_renew_status': '1'}],
+    }
+
+
+def config(app: str) -> SubscriptionManagerConfig:
+    return SubscriptionManagerConfig(
+        apple=AppleVerifierConfig(bundle_id='com.{}'.format(app), extra=AppleExtraArgs(shared_secret=app)),
+        google=GoogleVerifierConfig(bundle_id='com.{}'.format(app), private_key_path=KEY_PATH))
+
+
+@pytest.fixture
+def server(monkeypatch):
+    with StubServer(handler) as server:
+        monkeypatch.setattr(PooledAppStoreValidator, 'production_url', server.url + '/production')
+        yield server
+
+
+def test_tenants_share_resources_and_are_isolated(server):
+    configs = {app: config(app) for app in ('first', 'second')}
+    controller = MultiTenantController(configs, cache=InMemoryCache())
+    first = controller.verify_receipt('first', 'apple', 'receipt')
+    second = controller.verify_receipt('second', 'apple', 'receipt')
+    # the same receipt isn't taken from cache of other application
+    assert first.subscription_info.product_id == 'first.monthly'
+    assert second.subscription_info.product_id == 'second.monthly'
+    assert controller.verify_receipt('first', 'apple', 'receipt') is first
+    assert server.requests_count == 2
+
+    first_controller, second_controller = controller.controller('first'), controller.controller('second')
+    first_verifier, second_verifier = first_controller.verifiers.apple, second_controller.verifiers.apple
+    assert first_verifier is not second_verifier
+    assert first_verifier.verifier.transport is second_verifier.verifier.transport
+    assert first_verifier.router is second_verifier.router
+    assert first_controller.parsers is second_controller.parsers
+    assert first_controller.metrics is controller.metrics
+    # verifiers of google aren't created until they are used
+    assert not first_controller.verifiers.is_loaded('google')
+    assert controller.stats() == {'tenants': 2, 'created_total': 2, 'evicted_total': 0, 'shared_resources': 2}
+
+    with pytest.raises(UndefinedTenant):
+        controller.verify_receipt('third', 'apple', 'receipt')
+    with pytest.raises(UndefinedProvider):
+        controller.verify_receipt('first', 'storekit', 'receipt')
+    controller.close()
+
+
+def test_least_recently_used_tenants_are_evicted(server):
+    loaded = []
+
+    def get_config(app: str):
+        loaded.append(app)
+        return config(app)
+
+    controller = MultiTenantController(get_config, max_tenants=2)
+    for app in ('a', 'b', 'a', 'c', 'a', 'b'):
+        assert controller.verify_receipt(app, 'apple', 'receipt').subscription_info.product_id == app + '.monthly'
+    # b was evicted by c, then c by b
+    assert loaded == ['a', 'b', 'c', 'b']
+    assert controller.stats() == {'tenants': 2, 'created_total': 4, 'evicted_total': 2, 'shared_resources': 2}
+    results = list(controller.verify_receipts('c', [('apple', 'receipt-1'), ('apple', 'receipt-2')]))
+    assert all(result.is_verified for result in results)
+    controller.evict('c')
+    assert controller.stats()['tenants'] == 1
+    controller.close()
+
+
+def test_applications_of_one_account_share_token_manager():
+    controller = MultiTenantController({app: config(app) for app in ('first', 'second')})
+    token_manager = GoogleTokenManager(KEY_PATH, fetch_token=lambda: ('token', 3600))
+    # manager of service account is created once, here it is created without requests to Google
+    key, _ = google.shared_resources(config('first').google)['token_manager']
+    controller.resources.get(key, lambda: token_manager)
+    verifiers = [controller.controller(app).verifiers.google for app in ('first', 'second')]
+    assert verifiers[0] is not verifiers[1]
+    assert verifiers[0].token_manager is verifiers[1].token_manager is token_manager
+    assert len(controller.resources) == 1
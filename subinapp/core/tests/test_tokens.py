@@ -0,0 +1,96 @@
+import multiprocessing
+import os
+import time
+
+from subinapp.core.tokens import GoogleTokenManager, FileTokenCache
+
+
+class CountingFetcher:
+    def __init__(self, expires_in: float = 3600, counter_path: str = None):
+        self.expires_in = expires_in
+        self.counter_path = counter_path
+        self.calls = 0
+
+    def __call__(self):
+        self.calls += 1
+        if self.counter_path:
+            with open(self.counter_path, 'a') as f:
+                f.write('{}\n'.format(os.getpid()))
+        return 'token-{}'.format(self.calls), self.expires_in
+
+
+def test_token_is_refreshed_ahead_of_expiration():
+    fetcher = CountingFetcher(expires_in=100)
+    manager = GoogleTokenManager('/some/file/path/file.json', refresh_margin=10, fetch_token=fetcher)
+    assert manager.valid_token() is None
+    assert manager.get_token() == 'token-1'
+    assert manager.get_token() == 'token-1'
+    assert manager.refresh().value == 'token-1'
+    assert fetcher.calls == 1
+    # token is still valid, but it's time to refresh it
+    manager.refresh_margin = 200
+    assert manager.get_token() == 'token-1'
+    assert manager.refresh().value == 'token-2'
+    metrics = manager.metrics()
+    assert metrics['refreshes_total'] == 2
+    assert 0 <= metrics['token_age_seconds'] < 5
+    assert 95 < metrics['token_ttl_seconds'] <= 100
+
+
+def test_background_refresh_is_started_by_first_use():
+    fetcher = CountingFetcher()
+    manager = GoogleTokenManager('/some/file/path/file.json', fetch_token=fetcher, start_on_first_use=True)
+    assert manager._thread is None and fetcher.calls == 0
+    try:
+        assert manager.get_token() == 'token-1'
+        assert manager._thread.is_alive()
+    finally:
+        manager.stop()
+    # stopped manager isn't restarted
+    manager.get_token()
+    assert manager._thread is None
+    assert fetcher.calls == 1
+
+def test_background_refresh():
+    fetcher = CountingFetcher()
+    manager = GoogleTokenManager('/some/file/path/file.json', fetch_token=fetcher)
+    manager.start()
+    try:
+        for _ in range(100):
+            if manager.valid_token():
+                break
+            time.sleep(0.01)
+        assert manager.valid_token() == 'token-1'
+    finally:
+        manager.stop()
+
+
+def test_token_is_shared_through_file_cache(tmp_path):
+    cache_path = str(tmp_path / 'token.json')
+    first_fetcher, second_fetcher = CountingFetcher(), CountingFetcher()
+    first = GoogleTokenManager('/some/file/path/file.json', cache=FileTokenCache(cache_path), fetch_token=first_fetcher)
+    second = GoogleTokenManager('/some/file/path/file.json', cache=FileTokenCache(cache_path),
+                                fetch_token=second_fetcher)
+    assert first.get_token() == second.get_token() == 'token-1'
+    assert first_fetcher.calls == 1
+    assert second_fetcher.calls == 0
+    assert second.metrics()['shared_tokens_used_total'] == 1
+
+
+def _get_token_in_process(cache_path: str, counter_path: str):
+    manager = GoogleTokenManager('/some/file/path/file.json', cache=FileTokenCache(cache_path),
+                                 fetch_token=CountingFetcher(counter_path=counter_path))
+    manager.get_token()
+
+
+def test_token_is_requested_by_one_process(tmp_path):
+    cache_path = str(tmp_path / 'token.json')
+    counter_path = str(tmp_path / 'fetches.txt')
+    context = multiprocessing.get_context('fork')
+    processes = [context.Process(target=_get_token_in_process, args=(cache_path, counter_path)) for _ in range(8)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+    with open(counter_path) as f:
+        assert len(f.readlines()) == 1
@@ -0,0 +1,67 @@
+import json
+import threading
+
+from subinapp.core.providers.apple import Verifier as AVerifier
+from subinapp.core.tests.stubs import StubServer, make_certificate
+from subinapp.interface.entities import SubscriptionManagerConfig, AppleVerifierConfig, AppleExtraArgs
+
+APPLE_RESPONSE = {'status': 0, 'latest_receipt_info': []}
+
+
+def make_verifier(url: str, certificate: str, **extra) -> AVerifier:
+    config = AppleVerifierConfig(bundle_id='com.company.myapp',
+                                 extra=AppleExtraArgs(shared_secret='4rjFaspQ3419S9vXx', **extra))
+    verifier = AVerifier(SubscriptionManagerConfig(apple=config, google=None))
+    verifier.verifier.production_url = url + '/production'
+    verifier.verifier.sandbox_url = url + '/sandbox'
+    verifier.transport.session.verify = certificate
+    return verifier
+
+
+def test_apple_verifier_reuses_tls_connections(tmp_path):
+    certificate = make_certificate(str(tmp_path))
+
+    def handler(method, path, body):
+        assert json.loads(body)['receipt-data'] == 'receipt'
+        if path == '/production':
+            return 200, {'status': 21007}
+        return 200, APPLE_RESPONSE
+
+    with StubServer(handler, certificate=certificate) as server:
+        verifier = make_verifier(server.url, certificate[0])
+        for _ in range(10):
+            response = verifier.verify('receipt')
+            assert response == APPLE_RESPONSE
+            assert json.loads(response.raw) == APPLE_RESPONSE
+    stats = verifier.transport.stats
+    assert stats.requests == 20
+    # both environments are on the same stub host
+    assert stats.new_connections == 1
+    assert stats.reuse_ratio == 0.95
+
+
+def test_apple_verifier_retries_temporary_failures(tmp_path):
+    certificate = make_certificate(str(tmp_path))
+    statuses = [503, 200]
+
+    def handler(method, path, body):
+        return statuses.pop(0), APPLE_RESPONSE
+
+    with StubServer(handler, certificate=certificate) as server:
+        verifier = make_verifier(server.url, certificate[0], retry_backoff=0)
+        assert verifier.verify('receipt') == APPLE_RESPONSE
+        assert server.requests_count == 2
+
+
+def test_apple_verifier_waits_for_free_connection(tmp_path):
+    certificate = make_certificate(str(tmp_path))
+    with StubServer(lambda *args: (200, APPLE_RESPONSE), delay=0.1, certificate=certificate) as server:
+        verifier = make_verifier(server.url, certificate[0], pool_size=1)
+        threads = [threading.Thread(target=verifier.verify, args=('receipt',)) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    stats = verifier.transport.stats.as_dict()
+    assert stats['new_connections_total'] == 1
+    assert stats['wait_seconds_max'] >= 0.2
@@ -0,0 +1,226 @@
+"""
+Access tokens of Google service account refreshed ahead of expiration
+"""
+
+import fcntl
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Callable, Optional, Tuple, Dict
+
+import httplib2
+from oauth2client.service_account import ServiceAccountCredentials
+
+from subinapp.core.forking import register_after_fork
+from subinapp.interface.api import BaseTokenCache
+from subinapp.interface.entities import AccessToken
+
+log = logging.getLogger(__name__)
+
+GOOGLE_AUTH_SCOPE = 'https://www.googleapis.com/auth/androidpublisher'
+
+# Returns new token and seconds before its expiration
+TokenFetcher = Callable[[], Tuple[str, float]]
+
+
+class FileTokenCache(BaseTokenCache):
+    """
+    Keeps token in json file, processes are synchronized with flock on file next to it
+    File is replaced atomically, so it can be read without lock
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.lock_path = path + '.lock'
+        self._thread_lock = threading.Lock()
+        register_after_fork(self)
+
+    def _after_fork(self):
+        self._thread_lock = threading.Lock()
+
+    def load(self) -> Optional[AccessToken]:
+        try:
+            with open(self.path) as f:
+                return AccessToken(**json.load(f))
+        except (OSError, ValueError, TypeError):
+            return None
+
+    def store(self, token: AccessToken):
+        tmp_path = '{}.{}.tmp'.format(self.path, os.getpid())
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'w') as f:
+            json.dump({'value': token.value, 'issued_at': token.issued_at, 'expires_at': token.expires_at}, f)
+        os.replace(tmp_path, self.path)
+
+    @contextmanager
+    def lock(self):
+        # flock is held by open file, so threads of one process are locked separately
+        with self._thread_lock:
+            fd = os.open(self.lock_path, os.O_RDWR | os.O_CREAT, 0o600)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+                yield
+            finally:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+                os.close(fd)
+
+
+class GoogleTokenManager:
+    """
+    Provides access token of service account
+    With start() token is refreshed in background thread before it expires,
+        so requests don't wait for token exchange, with start_on_first_use it is started by first get_token()
+    With cache token is shared between processes, it is requested by one of them
+    Background refreshing started before fork is restarted in child process
+    """
+
+    def __init__(self, private_key_path: str,
+                 cache: Optional[BaseTokenCache] = None,
+                 refresh_margin: float = 300,
+                 http_timeout: float = 15,
+                 fetch_token: Optional[TokenFetcher] = None,
+                 start_on_first_use: bool = False):
+        """
+        :param private_key_path: Path to json service key
+        :param cache: Storage to share token between processes
+        :param refresh_margin: Token is refreshed when less seconds than that are left before expiration
+        :param http_timeout: Timeout of token exchange request
+        :param fetch_token: Function requesting new token, service key is used by default
+        :param start_on_first_use: Start background refreshing when token is needed first time,
+            so manager that is never used doesn't request tokens
+        """
+        self.private_key_path = private_key_path
+        self.cache = cache
+        self.refresh_margin = refresh_margin
+        self.http_timeout = http_timeout
+        self.start_on_first_use = start_on_first_use
+        self._fetch_token = fetch_token or self._fetch_token_with_key
+        self._credentials = None
+        self._token: Optional[AccessToken] = None
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        # metrics
+        self.refreshes = 0
+        self.refresh_failures = 0
+        self.shared_tokens_used = 0
+        self.last_refresh_duration: Optional[float] = None
+        register_after_fork(self)
+
+    def _after_fork(self):
+        # thread isn't copied to child, lock could be held by it at the moment of fork
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+        if self._thread is not None:
+            self._thread = None
+            self.start()
+
+    def _fetch_token_with_key(self) -> Tuple[str, float]:
+        if self._credentials is None:
+            self._credentials = ServiceAccountCredentials.from_json_keyfile_name(self.private_key_path,
+                                                                                 GOOGLE_AUTH_SCOPE)
+        self._credentials.refresh(httplib2.Http(timeout=self.http_timeout))
+        expires_in = (self._credentials.token_expiry - datetime.utcnow()).total_seconds()
+        return self._credentials.access_token, expires_in
+
+    def _is_fresh(self, token: Optional[AccessToken]) -> bool:
+        """Token is fresh if it shouldn't be refreshed yet"""
+        return token is not None and token.expires_at - time.time() > self.refresh_margin
+
+    def valid_token(self) -> Optional[str]:
+        """Returns current token if it isn't expired, never waits for token exchange"""
+        token = self._token
+        if token is not None and token.expires_at > time.time():
+            return token.value
+        return None
+
+    def get_token(self) -> str:
+        """
+        Returns valid token
+        Waits for token exchange only if there is no valid token at all
+        Starts background refreshing, if it should be started on first use
+        """
+        if self.start_on_first_use and self._thread is None and not self._stop_event.is_set():
+            with self._lock:
+                if self._thread is None:
+                    self.start()
+        return self.valid_token() or self.refresh().value
+
+    def refresh(self, force: bool = False) -> AccessToken:
+        """
+        Gets new token, from shared cache if other process already refreshed it
+        :param force: Request new token even if current is fresh
+        """
+        with self._lock:
+            if not force and self._is_fresh(self._token):
+                return self._token
+            if self.cache is None:
+                self._token = self._request_token()
+                return self._token
+            with self.cache.lock():
+                shared = self.cache.load()
+                if not force and self._is_fresh(shared):
+                    self.shared_tokens_used += 1
+                    self._token = shared
+                    return shared
+                self._token = self._request_token()
+                self.cache.store(self._token)
+                return self._token
+
+    def _request_token(self) -> AccessToken:
+        started = time.monotonic()
+        try:
+            value, expires_in = self._fetch_token()
+        except Exception:
+            self.refresh_failures += 1
+            raise
+        self.refreshes += 1
+        self.last_refresh_duration = time.monotonic() - started
+        now = time.time()
+        log.info('Google access token is refreshed, expires in %s seconds', int(expires_in))
+        return AccessToken(value=value, issued_at=now, expires_at=now + expires_in)
+
+    def start(self):
+        """Starts background refreshing of token"""
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._refresh_loop, name='subinapp-google-token', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stops background refreshing of token"""
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _refresh_loop(self):
+        failures = 0
+        while not self._stop_event.is_set():
+            try:
+                token = self.refresh()
+                failures = 0
+                delay = max(token.expires_at - time.time() - self.refresh_margin, 1)
+            except Exception as e:
+                log.warning('Failed to refresh Google access token: %s', e)
+                failures += 1
+                delay = min(2 ** failures, 60)
+            self._stop_event.wait(delay)
+
+    def metrics(self) -> Dict[str, Optional[float]]:
+        """Current state of token and counters of refreshes"""
+        token = self._token
+        now = time.time()
+        return {
+            'token_age_seconds': now - token.issued_at if token else None,
+            'token_ttl_seconds': token.expires_at - now if token else None,
+            'refreshes_total': self.refreshes,
+            'refresh_failures_total': self.refresh_failures,
+            'shared_tokens_used_total': self.shared_tokens_used,
+            'last_refresh_duration_seconds': self.last_refresh_duration,
+        }
@@ -0,0 +1,170 @@
+"""
+Pooled keep-alive HTTP transport for requests to providers
+"""
+
+import threading
+import time
+from typing import Dict, Union
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from urllib3.util.retry import Retry
+
+from subinapp.core.deadlines import current_deadline
+from subinapp.core.forking import register_after_fork
+
+# Statuses of temporary failures, requests are retried on them
+RETRY_STATUSES = (500, 502, 503, 504)
+
+
+class PoolStats:
+    """
+    Counters of connection pool
+    requests - number of connections taken from pool (retries are counted too)
+    new_connections - number of opened connections
+    wait_time - total seconds spent waiting for free connection
+    """
+
+    def __init__(self):
+        self.requests = 0
+        self.new_connections = 0
+        self.wait_time = 0.0
+        self.max_wait_time = 0.0
+        self._lock = threading.Lock()
+        register_after_fork(self)
+
+    def _after_fork(self):
+        self._lock = threading.Lock()
+
+    def add_request(self, wait_time: float):
+        with self._lock:
+            self.requests += 1
+            self.wait_time += wait_time
+            self.max_wait_time = max(self.max_wait_time, wait_time)
+
+    def add_connection(self):
+        with self._lock:
+            self.new_connections += 1
+
+    @property
+    def reuse_ratio(self) -> float:
+        """Part of requests sent over already opened connection"""
+        if not self.requests:
+            return 0.0
+        return max(0.0, 1 - self.new_connections / self.requests)
+
+    def as_dict(self) -> Dict[str, float]:
+        return {
+            'requests_total': self.requests,
+            'new_connections_total': self.new_connections,
+            'reuse_ratio': self.reuse_ratio,
+            'wait_seconds_total': self.wait_time,
+            'wait_seconds_max': self.max_wait_time,
+            'wait_seconds_avg': self.wait_time / self.requests if self.requests else 0.0,
+        }
+
+
+def _stats_pool_class(base: type, stats: PoolStats) -> type:
+    """Connection pool class reporting to stats"""
+
+    class StatsConnectionPool(base):
+        def _get_conn(self, timeout=None):
+            started = time.monotonic()
+            try:
+                return super(StatsConnectionPool, self)._get_conn(timeout)
+            finally:
+                stats.add_request(time.monotonic() - started)
+
+        def _new_conn(self):
+            stats.add_connection()
+            return super(StatsConnectionPool, self)._new_conn()
+
+    return StatsConnectionPool
+
+
+class _StatsAdapter(HTTPAdapter):
+    def __init__(self, stats: PoolStats, **kwargs):
+        self.stats = stats
+        super(_StatsAdapter, self).__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        super(_StatsAdapter, self).init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            'http': _stats_pool_class(HTTPConnectionPool, self.stats),
+            'https': _stats_pool_class(HTTPSConnectionPool, self.stats),
+        }
+
+
+class DeadlineRetry(Retry):
+    """Failed request isn't retried after deadline of current verification"""
+
+    def is_exhausted(self) -> bool:
+        deadline = current_deadline()
+        return super(DeadlineRetry, self).is_exhausted() or (deadline is not None and deadline.expired)
+
+
+class PooledTransport:
+    """
+    Session with limited pool of keep-alive connections per host
+    Requests wait for free connection when pool is exhausted
+    Can be shared by verifiers, it is thread safe
+    Connections opened before fork are left to parent process, child opens its own
+    """
+
+    def __init__(self, pool_size: int = 10,
+                 connect_timeout: float = 3.05,
+                 read_timeout: float = 15,
+                 max_retries: int = 2,
+                 retry_backoff: float = 0.3,
+                 verify: Union[bool, str] = True):
+        """
+        :param pool_size: Max number of connections to one host
+        :param connect_timeout: Seconds to wait for connection
+        :param read_timeout: Seconds to wait for response
+        :param max_retries: Retries of failed connections and temporary failures of server
+        :param retry_backoff: Backoff factor of delay between retries
+        :param verify: Check TLS certificate or path to CA bundle
+        """
+        self.timeout = (connect_timeout, read_timeout)
+        self.pool_size = pool_size
+        self.verify = verify
+        self.stats = PoolStats()
+        self.retry = DeadlineRetry(total=max_retries,
+                                   backoff_factor=retry_backoff,
+                                   status_forcelist=RETRY_STATUSES,
+                                   # verification requests are POST, but they are safe to repeat
+                                   allowed_methods=None,
+                                   raise_on_status=False)
+        self.session = self._make_session()
+        register_after_fork(self)
+
+    def _make_session(self) -> requests.Session:
+        adapter = _StatsAdapter(self.stats, pool_connections=4, pool_maxsize=self.pool_size,
+                                pool_block=True, max_retries=self.retry)
+        session = requests.Session()
+        session.verify = self.verify
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        return session
+
+    def _after_fork(self):
+        # connections of parent's session must not be shared with child
+        self.session = self._make_session()
+
+    def post(self, url: str, body: bytes, headers: Dict[str, str] = None) -> requests.Response:
+        """
+        Sends request over pooled connection
+        Timeouts of each attempt are cut to time left before deadline of current verification
+        :raises requests.RequestException: Request failed after retries
+        :raises DeadlineExceeded: There is no time left for request
+        """
+        timeout = self.timeout
+        deadline = current_deadline()
+        if deadline is not None:
+            timeout = tuple(deadline.cap(part, 'request to {}'.format(url)) for part in timeout)
+        # verify is passed explicitly, otherwise REQUESTS_CA_BUNDLE overrides it
+        return self.session.post(url, data=body, headers=headers, timeout=timeout, verify=self.session.verify)
+
+    def close(self):
+        self.session.close()
@@ -6,11 +6,25 @@ import dataclasses
 import logging
 from abc import ABC, abstractmethod
 from datetime import datetime
+from typing import Optional, ContextManager, Mapping
 
-from subinapp.interface.entities import VerifiedSubscriptionInfo, SubscriptionManagerConfig
+from subinapp.interface.entities import VerifiedSubscriptionInfo, SubscriptionManagerConfig, ProcessedReceipt, \
+    AccessToken, ReverificationCheckpoint
 from subinapp.interface.exceptions import ConfigurationIsMissing
 
 
+def _get_provider_config(config: SubscriptionManagerConfig, provider: str):
+    """
+    Returns configuration of provider from common config
+    :raises ConfigurationIsMissing: No configuration for provider
+    """
+    provider_config = getattr(config, provider)
+    if not provider_config:
+        raise ConfigurationIsMissing(
+            "No configuration for provider '%s'", provider)
+    return provider_config
+
+
 class BaseVerifier(ABC):
     """
     Verifies receipt
@@ -26,6 +40,8 @@ class BaseVerifier(ABC):
     provider: str = None
     # configuration for provider
     provider_config = None
+    # sink of metrics, set by controller
+    metrics: Optional['BaseMetricsSink'] = None
 
     def __init__(self, config: SubscriptionManagerConfig):
         """
@@ -37,14 +53,19 @@ class BaseVerifier(ABC):
         if not self.verifier_class or not self.provider:
             raise ConfigurationIsMissing(
                 "Some class parameters wasn't set. Check if verifier_class and provider are set in class Definition")
-        provider_config = getattr(config, self.provider)
-        if not provider_config:
-            raise ConfigurationIsMissing(
-                "No configuration for provider '%s'", self.provider)
+        provider_config = _get_provider_config(config, self.provider)
         self.provider_config = provider_config
         config_dict = dataclasses.asdict(provider_config)
         config_dict.pop('extra', None)
-        self.verifier = self.verifier_class(**config_dict)
+        self.verifier = self.verifier_class(**self.get_verifier_kwargs(config_dict))
+
+    def get_verifier_kwargs(self, config_dict: dict) -> dict:
+        """
+        Arguments for verifier_class constructor
+        Override to pass something besides provider configuration
+        :param config_dict: Provider configuration without extra
+        """
+        return config_dict
 
     @abstractmethod
     def verify(self, receipt: str) -> dict:
@@ -58,6 +79,59 @@ class BaseVerifier(ABC):
         :return: Raw dict from provider's response
         """
 
+    def warm(self):
+        """
+        Loads credentials and other resources needed by first verification
+        Does nothing by default
+        """
+
+
+class AsyncBaseVerifier(ABC):
+    """
+    Verifies receipt without blocking the event loop
+    Asyncio counterpart of BaseVerifier, so all requests to provider
+        are made by verifier itself and not by inapppy
+    In child classes set provider
+    Provider should be same as field with configuration for provider
+        in SubscriptionManagerConfig
+    """
+
+    # apple, google or like that
+    provider: str = None
+    # configuration for provider
+    provider_config = None
+    # sink of metrics, set by controller
+    metrics: Optional['BaseMetricsSink'] = None
+
+    def __init__(self, config: SubscriptionManagerConfig):
+        """
+        Checks if class is configured right
+        and if config for provider is present
+        """
+        if not self.provider:
+            raise ConfigurationIsMissing(
+                "Some class parameters wasn't set. Check if provider is set in class Definition")
+        self.provider_config = _get_provider_config(config, self.provider)
+
+    @abstractmethod
+    async def verify(self, receipt: str) -> dict:
+        """
+        Main method to call
+        Same as BaseVerifier.verify, but is awaited
+        :raises VerificationFailed: Receipt is not valid
+        :param receipt: Receipt from device
+        :return: Raw dict from provider's response
+        """
+
+    def warm(self):
+        """
+        Loads credentials and other resources needed by first verification
+        Does nothing by default
+        """
+
+    async def close(self):
+        """Releases connections and other resources opened by verifier"""
+
 
 class BaseParser(ABC):
     """Parse response from provider"""
@@ -68,6 +142,7 @@ class BaseParser(ABC):
         :param provider_response: Response from provider as dict
         :return: VerifiedSubscriptionInfo with main info about subscription
         """
+        provider_response = self.prepare(provider_response)
         return VerifiedSubscriptionInfo(
             product_id=self.detect_product_id(provider_response),
             purchase_token=self.detect_purchase_token(provider_response),
@@ -75,11 +150,19 @@ class BaseParser(ABC):
             is_renewable=self.detect_is_renewable(provider_response),
         )
 
+    def prepare(self, provider_response: dict) -> Mapping:
+        """Response that is passed to detect methods, e.g. view with values that are found once for all of them"""
+        return provider_response
+
     @abstractmethod
     def detect_expiration_date(self, provider_response: dict) -> datetime:
         """Get subscription expiration date"""
         ...
 
+    def detect_expiration_timestamp(self, provider_response: dict) -> float:
+        """Get subscription expiration as POSIX timestamp, bulk parsing uses it instead of datetime of each row"""
+        return self.detect_expiration_date(provider_response).timestamp()
+
     @abstractmethod
     def detect_product_id(self, provider_response: dict) -> str:
         """Get subscription product_id"""
@@ -94,3 +177,109 @@ class BaseParser(ABC):
     def detect_purchase_token(self, provider_response: dict) -> str:
         """Get purchase token as unique identifier of subscription"""
         ...
+
+
+class BaseReceiptCache(ABC):
+    """
+    Storage of verification results
+    Implement it to share results between workers (e.g. with Redis or memcached),
+        serialization of ProcessedReceipt is up to implementation
+    """
+
+    @abstractmethod
+    def get(self, key: str) -> Optional[ProcessedReceipt]:
+        """Get result by key or None if it is missing or expired"""
+        ...
+
+    @abstractmethod
+    def set(self, key: str, value: ProcessedReceipt, ttl: float):
+        """Store result for ttl seconds"""
+        ...
+
+    @abstractmethod
+    def delete(self, key: str):
+        """Remove result if it is stored"""
+        ...
+
+
+class BaseDeduplicationStore(ABC):
+    """
+    Keys of processed events, e.g. notifications of providers
+    Implement it with shared storage (e.g. SET NX in Redis) to deduplicate events between workers
+    """
+
+    @abstractmethod
+    def add(self, key: str, ttl: float) -> bool:
+        """Store key for ttl seconds, returns False if it is already stored"""
+        ...
+
+    @abstractmethod
+    def discard(self, key: str):
+        """Remove key, so event is processed again when it is redelivered"""
+        ...
+
+
+class BaseCheckpointStore(ABC):
+    """
+    Storage of progress of re-verification sweep
+    Implement it with database of application to resume sweep in other process
+    """
+
+    @abstractmethod
+    def load(self) -> Optional[ReverificationCheckpoint]:
+        """Get stored checkpoint or None if sweep isn't in progress"""
+        ...
+
+    @abstractmethod
+    def save(self, checkpoint: ReverificationCheckpoint):
+        """Replace stored checkpoint"""
+        ...
+
+    @abstractmethod
+    def clear(self):
+        """Remove checkpoint when sweep is completed"""
+        ...
+
+
+class BaseTokenCache(ABC):
+    """
+    Storage of access token shared by processes
+    Lock is held while token is refreshed, so only one process requests new token
+    """
+
+    @abstractmethod
+    def load(self) -> Optional[AccessToken]:
+        """Get stored token or None"""
+        ...
+
+    @abstractmethod
+    def store(self, token: AccessToken):
+        """Replace stored token"""
+        ...
+
+    @abstractmethod
+    def lock(self) -> ContextManager:
+        """Exclusive lock for all processes using the cache"""
+        ...
+
+
+class BaseMetricsSink(ABC):
+    """
+    Receiver of metrics of verification process
+    Stages are 'verify', 'parse', 'serialize', 'queue' (waiting for rate limit) and others reported by verifiers
+    """
+
+    @abstractmethod
+    def observe_duration(self, provider: str, stage: str, seconds: float):
+        """Time spent by stage"""
+        ...
+
+    @abstractmethod
+    def increment(self, provider: str, event: str, value: int = 1):
+        """Counter of events e.g. outcomes of verification"""
+        ...
+
+    @abstractmethod
+    def observe_size(self, provider: str, payload: str, size: int):
+        """Size of payload in bytes"""
+        ...
@@ -2,9 +2,12 @@
 Classes that are used in process of subscription check
 """
 
-from dataclasses import dataclass
+from array import array
+from dataclasses import dataclass, field
 from datetime import datetime
-from typing import Optional
+from typing import Optional, Tuple, Any, Dict, List
+
+from subinapp.interface.utils import dump_json, project_fields
 
 
 @dataclass
@@ -13,9 +16,75 @@ class AppleExtraArgs:
     Extra arguments for calling verification method
     exclude_old_transactions - Remove old transactions from validation response
     shared_secret - Short string with secret to use with auto-renewable subscriptions
+    pool_size - Max number of keep-alive connections to App Store host
+    connect_timeout - Seconds to wait for connection to App Store
+    read_timeout - Seconds to wait for response from App Store
+    max_retries - Retries of failed connections and temporary failures of App Store
+    retry_backoff - Backoff factor of delay between retries
+    learn_environment - Remember environment (Production or Sandbox) of verified receipts
+        and send next requests for them directly there
+    environment_cache_size - Max number of remembered receipts and transactions
+    decode_receipts - Decode receipts locally before request to App Store,
+        malformed receipts and receipts of other applications are rejected without request,
+        original transactions of receipt are used to choose environment.
+        Legacy transaction receipts (iOS 6 style) aren't supported by decoder
     """
     shared_secret: Optional[str] = None
     exclude_old_transactions: bool = True
+    pool_size: int = 10
+    connect_timeout: float = 3.05
+    read_timeout: float = 15
+    max_retries: int = 2
+    retry_backoff: float = 0.3
+    learn_environment: bool = True
+    environment_cache_size: int = 100000
+    decode_receipts: bool = False
+
+
+@dataclass
+class AppleInAppPurchase:
+    """
+    In-app purchase from App Store receipt decoded locally
+
+    product_id - identifier of product
+    transaction_id - identifier of transaction
+    original_transaction_id - identifier of first transaction of subscription
+    purchase_date - time of purchase or renewal
+    expires_date - expiration of subscription, None for other products
+    cancellation_date - time of refund
+    quantity - number of purchased items
+    web_order_line_item_id - identifier of subscription purchase across devices
+    """
+
+    product_id: str
+    transaction_id: str
+    original_transaction_id: Optional[str] = None
+    purchase_date: Optional[datetime] = None
+    expires_date: Optional[datetime] = None
+    cancellation_date: Optional[datetime] = None
+    quantity: int = 1
+    web_order_line_item_id: Optional[int] = None
+
+
+@dataclass
+class AppleReceipt:
+    """
+    Fields of App Store receipt decoded locally
+    Signature of receipt isn't checked, so fields can be used only before verification with App Store,
+        e.g. to reject receipt or to choose environment
+
+    bundle_id - bundle id of application
+    application_version - version (CFBundleVersion) of application
+    original_application_version - version of application that was originally purchased
+    creation_date - time when receipt was created
+    in_app - in-app purchases of receipt
+    """
+
+    bundle_id: str
+    application_version: Optional[str] = None
+    original_application_version: Optional[str] = None
+    creation_date: Optional[datetime] = None
+    in_app: Tuple[AppleInAppPurchase, ...] = ()
 
 
 @dataclass
@@ -36,6 +105,17 @@ class AppleVerifierConfig:
     sandbox: bool = False
 
 
+@dataclass
+class GoogleExtraArgs:
+    """
+    Extra arguments of Google verifier
+    token_cache_path - Path to file to share access token between processes, it's not shared if None
+    token_refresh_margin - Access token is refreshed in background when less seconds than that are left
+    """
+    token_cache_path: Optional[str] = None
+    token_refresh_margin: float = 300
+
+
 @dataclass
 class GoogleVerifierConfig:
     """
@@ -44,10 +124,32 @@ class GoogleVerifierConfig:
     bundle_id - Bundle ID of mobile application
         e.g. com.company.awesomapp
     private_key_path - Path to service key to check payments
+    extra - Additional parameters for verification process, that shouldn't be provided into verifier constructor
     """
 
     bundle_id: str
     private_key_path: str
+    extra: Optional[GoogleExtraArgs] = None
+
+
+@dataclass
+class StoreKitVerifierConfig:
+    """
+    Required fields for local verification of StoreKit 2 signed transactions (JWS)
+
+    bundle_id - Bundle ID of mobile application
+    root_certificates - Paths to trusted root certificates in PEM or DER, e.g. Apple Root CA - G3
+    allow_sandbox - Accept transactions made in Sandbox environment
+    require_apple_extensions - Certificates of chain must have extensions of App Store signing certificates,
+        disable it only for certificates issued by own CA in tests
+    chain_cache_size - Max number of verified certificate chains kept in memory
+    """
+
+    bundle_id: str
+    root_certificates: Tuple[str, ...]
+    allow_sandbox: bool = True
+    require_apple_extensions: bool = True
+    chain_cache_size: int = 100
 
 
 @dataclass
@@ -58,6 +160,63 @@ class SubscriptionManagerConfig:
 
     apple: Optional[AppleVerifierConfig]
     google: Optional[GoogleVerifierConfig]
+    storekit: Optional[StoreKitVerifierConfig] = None
+
+
+@dataclass
+class RateLimit:
+    """
+    Limit of requests to provider
+    rate - Requests per second
+    burst - Max number of requests sent at once after idle time
+    max_queue - Max number of requests waiting for their turn, others are rejected at once
+    max_wait - Max seconds to wait for turn, requests expected to wait longer are rejected at once
+    min_rate - Rate isn't decreased lower than that when provider throttles requests
+    max_backoff - Max seconds of pause after provider throttled requests
+    """
+    rate: float
+    burst: int = 10
+    max_queue: int = 1000
+    max_wait: float = 5
+    min_rate: float = 1
+    max_backoff: float = 60
+
+
+@dataclass
+class HedgePolicy:
+    """
+    Hedging of slow requests to provider: if there is no answer in time, the same request is sent again
+        and the first answer is taken
+    percentile - Request is hedged after this percentile of recent latencies of provider
+    min_delay - Min seconds before hedging
+    max_delay - Max seconds before hedging, it's used until enough latencies are known
+    window - Number of recent latencies used for percentile
+    max_ratio - Max share of requests that are hedged, so hedges don't overload slow provider
+    max_workers - Max number of threads sending hedged requests of sync controllers
+    """
+    percentile: float = 0.95
+    min_delay: float = 0.05
+    max_delay: float = 2
+    window: int = 1000
+    max_ratio: float = 0.1
+    max_workers: int = 64
+
+
+@dataclass
+class CircuitBreakerPolicy:
+    """
+    Failing fast while provider is failing
+    failure_threshold - Number of consecutive failures of provider that opens breaker
+    open_seconds - Seconds when requests aren't sent after breaker is opened, then probe requests are sent
+    half_open_requests - Max number of probe requests at once
+    serve_stale - Return last successful result of receipt instead of failure while provider is unavailable
+    stale_size - Max number of last successful results kept for that
+    """
+    failure_threshold: int = 5
+    open_seconds: float = 30
+    half_open_requests: int = 1
+    serve_stale: bool = True
+    stale_size: int = 10000
 
 
 @dataclass
@@ -77,6 +236,94 @@ class VerifiedSubscriptionInfo:
     is_renewable: bool
 
 
+@dataclass
+class AccessToken:
+    """
+    OAuth access token
+
+    value - token to use in Authorization header
+    issued_at - unix time when token was received
+    expires_at - unix time when token expires
+    """
+
+    value: str
+    issued_at: float
+    expires_at: float
+
+
+class ProviderResponse(dict):
+    """
+    Decoded response from provider
+    raw - body of response as it was received
+    """
+
+    def __init__(self, *args, raw: Optional[bytes] = None, **kwargs):
+        super(ProviderResponse, self).__init__(*args, **kwargs)
+        self.raw = raw
+
+
+@dataclass
+class SerializationOptions:
+    """
+    Settings of ProcessedReceipt serialization
+
+    keep_raw - keep receipt and provider response as they were received without json encoding
+        (raw response is used only if verifier returned ProviderResponse with raw body)
+    include_fields - paths of provider response fields to keep, all are kept if None
+        nested fields are separated with dots e.g. 'receipt.bundle_id'
+    exclude_fields - paths of provider response fields to drop e.g. 'receipt.in_app'
+    """
+
+    keep_raw: bool = False
+    include_fields: Optional[Tuple[str, ...]] = None
+    exclude_fields: Tuple[str, ...] = ()
+
+    def serialize_receipt(self, receipt: str) -> bytes:
+        if self.keep_raw:
+            return receipt.encode('utf-8')
+        return dump_json(receipt)
+
+    def serialize_provider_response(self, provider_response: dict) -> bytes:
+        if self.include_fields is None and not self.exclude_fields:
+            raw = getattr(provider_response, 'raw', None)
+            if self.keep_raw and raw is not None:
+                return raw
+            return dump_json(provider_response)
+        return dump_json(project_fields(provider_response, self.include_fields, self.exclude_fields))
+
+
+class _LazyPayload:
+    """
+    Field of ProcessedReceipt serialized on first access
+    Value given to constructor is used as is, if it is None source is serialized and dropped after that
+    """
+
+    def __init__(self, name: str, source: str, serialize: str):
+        self.name = '_' + name
+        self.source = source
+        self.serialize = serialize
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            # default value of dataclass field
+            return None
+        value = instance.__dict__.get(self.name)
+        if value is None:
+            source = getattr(instance, self.source)
+            if source is None:
+                # source may be dropped by serialization in other thread after it set value
+                return instance.__dict__.get(self.name)
+            value = getattr(instance.serialization, self.serialize)(source)
+            instance.__dict__[self.name] = value
+            # result kept in cache doesn't hold both decoded and serialized values
+            setattr(instance, self.source, None)
+        return value
+
+    def __set__(self, instance, value: Optional[bytes]):
+        # descriptor itself is passed by dataclass constructor as default
+        instance.__dict__[self.name] = None if value is self else value
+
+
 @dataclass
 class ProcessedReceipt:
     """
@@ -84,11 +331,202 @@ class ProcessedReceipt:
 
     provider - provider name
     subscription_info - result of subscription extraction
-    receipt - result of utf-8 encoded json.dumps on input receipt string
-    provider_response - result of utf-8 encoded json.dumps on raw response from provider string
+    receipt - utf-8 encoded json of input receipt string (or receipt itself with serialization.keep_raw)
+    provider_response - utf-8 encoded json of response from provider (or raw response with serialization.keep_raw)
+    raw_receipt - receipt as it was received from device, None after receipt is serialized
+    raw_provider_response - decoded response from provider, None after provider_response is serialized
+    serialization - options of serialization
+    is_stale - it is last known result of receipt returned while provider is unavailable, not a new verification
+
+    receipt and provider_response are serialized from raw values on first access, if they weren't set
+    """
+
+    provider: str
+    subscription_info: VerifiedSubscriptionInfo
+    receipt: bytes = field(default=_LazyPayload('receipt', 'raw_receipt', 'serialize_receipt'), repr=False)
+    provider_response: bytes = field(
+        default=_LazyPayload('provider_response', 'raw_provider_response', 'serialize_provider_response'),
+        repr=False)
+    raw_receipt: Optional[str] = field(default=None, repr=False, compare=False)
+    raw_provider_response: Optional[Any] = field(default=None, repr=False, compare=False)
+    serialization: SerializationOptions = field(default_factory=SerializationOptions, repr=False, compare=False)
+    is_stale: bool = field(default=False, compare=False)
+
+
+@dataclass
+class BatchVerificationResult:
+    """
+    Result of verification of one receipt from batch
+
+    index - position of receipt in batch
+    provider - provider name
+    processed_receipt - result of verification if it succeeded
+    error - exception raised during verification of receipt if it failed
+    """
+
+    index: int
+    provider: str
+    processed_receipt: Optional[ProcessedReceipt] = None
+    error: Optional[BaseException] = None
+
+    @property
+    def is_verified(self) -> bool:
+        return self.error is None
+
+
+@dataclass
+class ReparsedBatch:
+    """
+    Subscription info parsed from batch of archived provider responses, stored by columns
+    Columns of repeated strings are dictionary encoded: array of codes and tuple of values of codes
+
+    offset - position of first row of batch in whole input
+    providers - provider names, provider_codes - code of provider of each row
+    products - product ids, product_codes - code of product id of each row, failed rows have product id None
+    purchase_tokens - purchase token of each row, None for failed rows
+    expiration - expiration as POSIX timestamp ('d' array), nan for failed rows
+    is_renewable - renewable flag ('b' array)
+    errors - messages of parsing errors by position of row in batch
+    """
+
+    offset: int
+    providers: Tuple[str, ...]
+    provider_codes: array
+    products: Tuple[Optional[str], ...]
+    product_codes: array
+    purchase_tokens: List[Optional[str]]
+    expiration: array
+    is_renewable: array
+    errors: Dict[int, str] = field(default_factory=dict)
+
+    def __len__(self) -> int:
+        return len(self.provider_codes)
+
+    def subscription_info(self, position: int) -> Optional[VerifiedSubscriptionInfo]:
+        """Row of batch as VerifiedSubscriptionInfo, None if it wasn't parsed"""
+        if position in self.errors:
+            return None
+        return VerifiedSubscriptionInfo(
+            product_id=self.products[self.product_codes[position]],
+            purchase_token=self.purchase_tokens[position],
+            expiration_date=datetime.fromtimestamp(self.expiration[position]),
+            is_renewable=bool(self.is_renewable[position]),
+        )
+
+    def to_numpy(self) -> Dict[str, Any]:
+        """
+        Columns as numpy arrays, expiration is converted to datetime64[ms] for whole batch at once (NaT if failed)
+        :raises ImportError: numpy isn't installed
+        """
+        import numpy
+
+        # arrays are taken by buffer protocol without copying
+        return {
+            'provider': numpy.array(self.providers, dtype=object)[numpy.asarray(self.provider_codes)],
+            'product_id': numpy.array(self.products, dtype=object)[numpy.asarray(self.product_codes)],
+            'purchase_token': numpy.array(self.purchase_tokens, dtype=object),
+            'expiration': (numpy.asarray(self.expiration) * 1000).astype('datetime64[ms]'),
+            'is_renewable': numpy.asarray(self.is_renewable).astype(bool),
+        }
+
+
+@dataclass
+class ProviderNotification:
+    """
+    Decoded notification from provider about change of subscription
+
+    provider - provider name
+    notification_id - unique id of notification, same for its redeliveries
+    notification_type - type of notification as provider names it, e.g. DID_RENEW or SUBSCRIPTION_CANCELED
+    provider_response - data of subscription in format of provider response if notification contains it
+    receipt - receipt to verify with provider if notification doesn't contain data of subscription
+    """
+
+    provider: str
+    notification_id: str
+    notification_type: str
+    provider_response: Optional[dict] = None
+    receipt: Optional[str] = None
+
+
+@dataclass
+class SubscriptionUpdate:
+    """
+    Result of processing of notification
+
+    notification - decoded notification, None if it couldn't be decoded
+    subscription_info - actual state of subscription, None for notifications not about subscriptions
+    verified_with_provider - data of subscription was requested from provider
+    error - exception raised during processing of notification if it failed
     """
 
     provider: str
+    notification: Optional[ProviderNotification] = None
+    subscription_info: Optional[VerifiedSubscriptionInfo] = None
+    verified_with_provider: bool = False
+    error: Optional[BaseException] = None
+
+    @property
+    def is_processed(self) -> bool:
+        return self.error is None
+
+
+@dataclass
+class StoredSubscription:
+    """
+    Subscription kept by application, input of re-verification
+
+    provider - provider name
+    receipt - receipt to verify with provider
+    subscription_info - last known state of subscription
+    """
+
+    provider: str
+    receipt: str
     subscription_info: VerifiedSubscriptionInfo
-    receipt: bytes
-    provider_response: bytes
+
+
+@dataclass
+class ReverificationCheckpoint:
+    """
+    Progress of interrupted sweep of re-verification
+
+    started_at - unix time of start of sweep, window of sweep is counted from it
+    expiration - unix time of expiration of last re-verified subscription,
+        subscriptions are re-verified in order of (expiration, provider, purchase_token)
+    provider - provider of last re-verified subscription
+    purchase_token - purchase token of last re-verified subscription
+    verified - number of re-verified subscriptions
+    failed - number of subscriptions that failed re-verification
+    """
+
+    started_at: float
+    expiration: float = float('-inf')
+    provider: str = ''
+    purchase_token: str = ''
+    verified: int = 0
+    failed: int = 0
+
+
+@dataclass
+class ReverificationResult:
+    """
+    Result of re-verification of stored subscription
+
+    stored - subscription as it was stored
+    processed_receipt - result of verification if it succeeded
+    error - exception raised during verification if it failed
+    """
+
+    stored: StoredSubscription
+    processed_receipt: Optional[ProcessedReceipt] = None
+    error: Optional[BaseException] = None
+
+    @property
+    def is_verified(self) -> bool:
+        return self.error is None
+
+    @property
+    def is_changed(self) -> bool:
+        """Subscription was renewed, lapsed or its renewal was turned on or off"""
+        return self.is_verified and self.processed_receipt.subscription_info != self.stored.subscription_info
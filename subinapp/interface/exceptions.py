@@ -2,6 +2,8 @@
 Description of exceptions that can be thrown during subscription verification
 """
 
+from typing import Optional
+
 
 class ConfigurationIsMissing(BaseException):
     """No configuration given to setup verification process"""
@@ -11,9 +13,40 @@ class VerificationFailed(BaseException):
     """Provided receipt wasn't verified, so it's bad or something wrong with settings"""
 
 
+class ProviderUnavailable(VerificationFailed):
+    """Provider failed or didn't answer, so receipt wasn't checked, it may be valid"""
+
+
+class CircuitOpen(ProviderUnavailable):
+    """Request isn't sent, because provider is failing and circuit breaker is open"""
+
+
 class ParsingFailed(BaseException):
     """Exception occurred during parsing"""
 
 
 class UndefinedProvider(BaseException):
     """Provider is not available from current controller"""
+
+
+class UndefinedTenant(BaseException):
+    """Application is not known to multi-tenant controller"""
+
+
+class RateLimitExceeded(BaseException):
+    """Receipt wasn't verified because of rate limit of provider, it should be verified later"""
+
+
+class ProviderThrottled(RateLimitExceeded):
+    """Provider rejected request because too many requests were sent"""
+
+    def __init__(self, *args, retry_after: Optional[float] = None):
+        """
+        :param retry_after: Seconds to wait before next request if provider told it
+        """
+        super(ProviderThrottled, self).__init__(*args)
+        self.retry_after = retry_after
+
+
+class DeadlineExceeded(BaseException):
+    """Verification wasn't finished before deadline given by caller, so it was abandoned"""
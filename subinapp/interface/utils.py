@@ -1,4 +1,6 @@
+import json
 import logging
+from typing import Any, Iterable, Optional
 
 from subinapp.interface.exceptions import ParsingFailed
 
@@ -30,3 +32,53 @@ def parsing_exception(provider: str, item_to_extract: str):
         return proxy_exception
 
     return decorator
+
+
+def dump_json(value: Any) -> bytes:
+    """Compact utf-8 encoded json"""
+    return json.dumps(value, separators=(',', ':')).encode('utf-8')
+
+
+def project_fields(value: Any, include: Optional[Iterable[str]] = None, exclude: Iterable[str] = ()) -> Any:
+    """
+    Returns copy of json-like value with chosen fields only
+    Paths of nested fields are separated with dots, e.g. 'receipt.in_app'
+    Path is applied to each item of list, so 'latest_receipt_info.product_id' works too
+    Given value is not changed
+    :param value: Decoded json
+    :param include: Paths of fields to keep, everything is kept if not set
+    :param exclude: Paths of fields to drop
+    """
+    if include is not None:
+        value = _include(value, [path.split('.') for path in include])
+    for path in exclude:
+        value = _exclude(value, path.split('.'))
+    return value
+
+
+def _include(value: Any, paths: list) -> Any:
+    if isinstance(value, list):
+        return [_include(item, paths) for item in value]
+    if not isinstance(value, dict):
+        return value
+    wanted = {path[0] for path in paths}
+    result = {}
+    for key in value:
+        if key not in wanted:
+            continue
+        nested = [path[1:] for path in paths if path[0] == key]
+        result[key] = value[key] if [] in nested else _include(value[key], nested)
+    return result
+
+
+def _exclude(value: Any, path: list) -> Any:
+    if isinstance(value, list):
+        return [_exclude(item, path) for item in value]
+    if not isinstance(value, dict) or path[0] not in value:
+        return value
+    result = dict(value)
+    if len(path) == 1:
+        del result[path[0]]
+    else:
+        result[path[0]] = _exclude(value[path[0]], path[1:])
+    return result